@@ -1,12 +1,46 @@
+import argparse
 import asyncio
+import concurrent.futures
+import functools
 import logging
+import multiprocessing
+import os
 import random
 import re
+import secrets
 import socketio
+import tempfile
 import uvicorn
 
+import engine
+from bot import BotPlayer
+from replay import RecordingGame
+from shard import Hub, ShardError, ShardManager, UnixBus, shard_for
+from timers import TimerWheel
+
 NAME_RE = re.compile("^[a-zA-Z0-9_-]+$")
 
+# Engine work runs on these threads, never on the event loop
+ENGINE_THREADS = 4
+# Most actions a room runs before sending out the events
+MAX_ACTION_BATCH = 16
+# Seconds between room updates, the changes in between are sent together
+UPDATE_INTERVAL = 0.05
+# Seconds that the seat of a player who lost the connection during a game is
+# kept for them to resume
+GRACE_PERIOD = 60
+# Seconds players have to answer a query before the game answers for them
+QUERY_TIMEOUT = 15
+
+executor = concurrent.futures.ThreadPoolExecutor(ENGINE_THREADS)
+# Query timeouts of every room
+timers = TimerWheel()
+
+# This process is shard SHARD of SHARDS, and owns the rooms whose code is
+# SHARD modulo SHARDS. See shard.py.
+SHARD = 0
+SHARDS = 1
+
 sio = socketio.AsyncServer(async_mode='asgi')
 app = socketio.ASGIApp(sio, static_files={
     '/': 'templates/index.html',
@@ -20,10 +54,8 @@ def is_valid_name(name : str, for_room=None):
         return False
     if len(name) > 20:
         return False
-    if for_room:
-        for pl in for_room.players:
-            if pl is not None and pl.name == name:
-                return False
+    if for_room and name in for_room.names:
+        return False
     return name
 
 class AppError(Exception):
@@ -41,114 +73,589 @@ class Player(object):
         self.room = None
         self.slot = None
         self.seat = None
+        # Bots have no connection and are played by a bot.BotPlayer
+        self.bot = False
+        # Resumes the seat after a lost connection, see Room.resume
+        self.token = secrets.token_urlsafe(16)
+        # Removes the player once the grace period is over
+        self.expiry = None
 
 class Room(object):
     def __init__(self, name):
         self.name = name
         self.players = [None] * 4
+        self.names = set()
         self.game = None
+        # Players by seat in the game
+        self.seats = [None] * 4
+        # Game actions are queued and run one batch at a time by the worker,
+        # so the game is only ever touched by one thread
+        self.actions = asyncio.Queue()
+        self.worker = None
+        # Room updates are sent by the flusher once per UPDATE_INTERVAL at
+        # most, as a diff against the last state sent. Players who joined
+        # since get the whole state instead.
+        self.dirty = False
+        self.flusher = None
+        self.sent_state = {"config": None, "players": [None] * 4}
+        self.fresh = set()
+        # Player by token
+        self.tokens = {}
+        # Answers the open queries when they time out
+        self.timed_queries = ()
+        self.query_timer = None
+
+    async def start(self):
+        if self.game is not None:
+            raise AppError("Game has already started")
+        if any(pl is None for pl in self.players):
+            raise AppError("Room is not full")
+        self.game = RecordingGame(random.getrandbits(64))
+        game_players = [BotPlayer(self.game, pl.name) if pl.bot else engine.Player(self.game, pl.name)
+                        for pl in self.players]
+        def start_game():
+            # The game shuffles the list it gets
+            self.game.start_game(list(game_players))
+            for pl, game_pl in zip(self.players, game_players):
+                pl.seat = game_pl.idx
+                self.seats[game_pl.idx] = pl
+        self.submit(None, start_game)
+
+    def submit(self, sid, fun, *args):
+        # Queue a call to run on an engine thread. Errors are sent to sid.
+        self.actions.put_nowait((sid, functools.partial(fun, *args)))
+        if self.worker is None:
+            self.worker = asyncio.get_running_loop().create_task(self._work())
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.actions.get()]
+            while len(batch) < MAX_ACTION_BATCH and not self.actions.empty():
+                batch.append(self.actions.get_nowait())
+            try:
+                frames, errors, queries = await loop.run_in_executor(
+                    executor, self._run_batch, batch)
+                self._time_queries(queries)
+                await self._send(frames, errors)
+            finally:
+                for item in batch:
+                    self.actions.task_done()
+
+    def _run_batch(self, batch):
+        # Runs on an engine thread. The events of every action are popped
+        # right after it, as the game expects, and all of them are encoded
+        # together at the end.
+        events = []
+        errors = []
+        resumes = []
+        for sid, fun in batch:
+            try:
+                result = fun()
+            except engine.InvalidActionError as e:
+                errors.append((sid, str(e)))
+                result = None
+            except Exception:
+                logging.exception("Action failed in room %s", self.name)
+                errors.append((sid, "Action failed"))
+                result = None
+            events.extend(self.game.pop_events())
+            if isinstance(result, engine.ResumeEvent):
+                resumes.append((len(events), result))
+        self._run_bots(events)
+        frames = None
+        if events or resumes:
+            fanout = engine.EventFanout(len(self.seats))
+            frames = fanout.encode(events)
+            # A resuming player gets the view and the events after it
+            for pos, view in resumes:
+                after = fanout.encode(events[pos:])[view.seat]
+                frames[view.seat] = b"[" + view.encode() + (
+                    b"]" if after == b"[]" else b"," + after[1:])
+        queries = tuple(self.game.open_queries) if self.game is not None else ()
+        return frames, errors, queries
+
+    def _run_bots(self, events):
+        # Bots see the events of the batch and answer their queries as soon
+        # as they open, so only the players' queries are left open after it
+        if self.game is None:
+            return
+        bots = [p for p in self.game.players if isinstance(p, BotPlayer)]
+        seen = 0
+        while bots:
+            for idx, ev in events[seen:]:
+                for bot in bots:
+                    if idx is None or idx == bot.idx:
+                        bot.record(idx, ev.get_for_player(bot.idx))
+            seen = len(events)
+            try:
+                if not any(bot.act() for bot in bots):
+                    return
+            except Exception:
+                logging.exception("Bot failed in room %s", self.name)
+                return
+            finally:
+                events.extend(self.game.pop_events())
+
+    def _time_queries(self, queries):
+        # Start the timeout when the open queries change
+        if queries == self.timed_queries:
+            return
+        if self.query_timer is not None:
+            timers.cancel(self.query_timer)
+            self.query_timer = None
+        self.timed_queries = queries
+        if queries:
+            self.query_timer = timers.schedule(QUERY_TIMEOUT, self._queries_expired, queries)
+
+    def _queries_expired(self, queries):
+        self.query_timer = None
+        self.submit(None, self._auto_answer, queries)
+
+    def _auto_answer(self, queries):
+        # Unless the queries were answered while this was waiting in the queue
+        if tuple(self.game.open_queries) == queries:
+            self.game.auto_answer()
+
+    async def _send(self, frames, errors):
+        # One emit per player for the whole batch
+        emits = []
+        if frames is not None:
+            for pl, frame in zip(self.seats, frames):
+                if pl is not None and pl.sid is not None and frame != b"[]":
+                    emits.append(sio.emit("game_events", frame.decode(), to=pl.sid))
+        for sid, msg in errors:
+            if sid is not None:
+                emits.append(sio.emit("server_error", msg, to=sid))
+        await asyncio.gather(*emits)
+
+    async def drain(self):
+        # Wait until every queued action has run and its events were sent
+        await self.actions.join()
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        if self.flusher is not None:
+            self.flusher.cancel()
+            self.flusher = None
+        if self.query_timer is not None:
+            timers.cancel(self.query_timer)
+            self.query_timer = None
+        for pl in self.tokens.values():
+            if pl.expiry is not None:
+                pl.expiry.cancel()
+                pl.expiry = None
 
     async def update(self):
         if not any([pl.host for pl in self.players if pl is not None]):
-            valid_slots = [i for i, pl in enumerate(self.players) if pl is not None]
+            valid_slots = [i for i, pl in enumerate(self.players) if pl is not None and not pl.bot]
             self.players[valid_slots[0]].host = True
 
-        await sio.emit("room_update", {
+        self.dirty = True
+        if self.flusher is None:
+            self.flusher = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(UPDATE_INTERVAL)
+        self.flusher = None
+        await self.flush()
+
+    def get_state(self):
+        return {
             "config": None,
             "players": [
                 None if pl is None else
-                {"name": pl.name, "archetype": None, "host": pl.host, "ready": pl.ready}
+                {"name": pl.name, "archetype": None, "host": pl.host, "ready": pl.ready,
+                 "connected": pl.sid is not None, "bot": pl.bot}
                 for pl in self.players
             ]
-        }, to=self.name)
+        }
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        state = self.get_state()
+        # Slots that changed, by slot number, and the config if it changed
+        diff = {}
+        players = {str(i): pl for i, (pl, sent) in
+                   enumerate(zip(state["players"], self.sent_state["players"]))
+                   if pl != sent}
+        if players:
+            diff["players"] = players
+        if state["config"] != self.sent_state["config"]:
+            diff["config"] = state["config"]
+        self.sent_state = state
+        fresh = list(self.fresh)
+        self.fresh.clear()
+
+        emits = []
+        if fresh:
+            emits.append(sio.emit("room_update", state, to=fresh))
+        if diff and any(pl is not None and pl.sid not in fresh for pl in self.players):
+            emits.append(sio.emit("room_diff", diff, to=self.name, skip_sid=fresh))
+        await asyncio.gather(*emits)
 
     async def join(self, pl):
+        if self.game is not None:
+            raise AppError("Game has already started")
         if not is_valid_name(pl.name, self):
             raise AppError("Name is not valid")
-        empty_slots = [i for i, pl in enumerate(self.players) if pl is None]
-        if not empty_slots:
+        if None not in self.players:
             raise AppError("Room is full")
-        idx = empty_slots[0]
+        try:
+            lobby.add_player(pl)
+        except engine.LobbyError:
+            raise AppError("Already in a room")
+        idx = self.players.index(None)
         pl.slot = idx
         pl.room = self
         self.players[idx] = pl
-        async with sio.session(pl.sid) as sess:
-            sess['player'] = pl
+        self.names.add(pl.name)
+        self.tokens[pl.token] = pl
+        await self._enter(pl)
+
+    async def add_bot(self, name):
+        if self.game is not None:
+            raise AppError("Game has already started")
+        if not is_valid_name(name, self):
+            raise AppError("Name is not valid")
+        if None not in self.players:
+            raise AppError("Room is full")
+        pl = Player(None, name)
+        pl.bot = True
+        pl.ready = True
+        idx = self.players.index(None)
+        pl.slot = idx
+        pl.room = self
+        self.players[idx] = pl
+        self.names.add(pl.name)
+        await self.update()
+
+    async def _enter(self, pl):
+        self.fresh.add(pl.sid)
         await sio.emit("enter_room", {
             "code": self.name,
             "nickname": pl.name,
-            "lobby_idx": pl.slot
+            "lobby_idx": pl.slot,
+            "token": pl.token
         }, to=pl.sid)
-        sio.enter_room(pl.sid, self.name)
+        await sio.enter_room(pl.sid, self.name)
         await self.update()
 
+    async def suspend(self, pl):
+        # The player lost the connection during a game. The seat is kept for
+        # GRACE_PERIOD, for the player to resume with their token.
+        lobby.remove_player(pl.sid)
+        self.fresh.discard(pl.sid)
+        pl.sid = None
+        pl.expiry = asyncio.get_running_loop().create_task(self._expire(pl))
+        await self.update()
+
+    async def _expire(self, pl):
+        await asyncio.sleep(GRACE_PERIOD)
+        pl.expiry = None
+        await self.leave(pl)
+
+    async def resume(self, sid, token):
+        pl = self.tokens.get(token)
+        if pl is None or pl.sid is not None:
+            raise AppError("There is no seat to resume")
+        if lobby.get_player(sid) is not None:
+            raise AppError("Already in a room")
+        if pl.expiry is not None:
+            pl.expiry.cancel()
+            pl.expiry = None
+        pl.sid = sid
+        lobby.add_player(pl)
+        await self._enter(pl)
+        # The whole state in one event, instead of the events so far
+        if self.game is not None and pl.seat is not None:
+            self.submit(sid, self.game.get_resume_view, pl.seat)
+
     async def leave(self, pl):
-        for i, player in enumerate(self.players):
-            if pl == player:
-                sio.leave_room(pl.sid, self.name)
-                self.players[i] = None
-                if all(pl is None for pl in self.players):
-                    del rooms[self.name]
-                    break
-                await self.update()
-                break
+        if pl.room is not self or self.players[pl.slot] is not pl:
+            return
+        if pl.sid is not None:
+            await sio.leave_room(pl.sid, self.name)
+            lobby.remove_player(pl.sid)
+            self.fresh.discard(pl.sid)
+        if pl.expiry is not None:
+            pl.expiry.cancel()
+            pl.expiry = None
+        self.players[pl.slot] = None
+        self.names.discard(pl.name)
+        del self.tokens[pl.token]
+        if all(p is None or p.bot for p in self.players):
+            self.close()
+            lobby.close_room(self.name)
+            return
+        await self.update()
+
+# The rooms of this shard, and the players in them by sid wherever they are
+# connected
+lobby = engine.Lobby()
+# Shard of the room of every client connected to this shard
+routes : dict[str, int] = {}
+
+# Game actions a client can send, as functions from the sender's seat and
+# the action data to the Game method name and its arguments. The seat is
+# always the sender's own. Turn actions only go through if the seat has the
+# matching open query, and answers to calls and ron go through the game's
+# arbiter, which makes the winning ones.
+def _discard(seat, d):
+    riichi = bool(d.get('riichi'))
+    query = 'riichi_query' if riichi else 'discard_query'
+    return ('answer_query', (seat, query, 'discard_tile', seat, d['tile'], riichi))
 
-rooms : dict[str, Room] = {}
+GAME_ACTIONS = {
+    'discard': _discard,
+    'chi': lambda seat, d: ('answer_call', (seat, 'call_chi', d['tiles'])),
+    'pon': lambda seat, d: ('answer_call', (seat, 'call_pon', d['tiles'])),
+    'open_kan': lambda seat, d: ('answer_call', (seat, 'call_open_kan', d['tiles'])),
+    'kan': lambda seat, d: ('answer_query', (seat, 'call_query', 'call_closed_or_added_kan',
+                                             d['tiles'], seat)),
+    'ron': lambda seat, d: ('answer_call', (seat, 'do_ron')),
+    'tsumo': lambda seat, d: ('answer_query', (seat, 'tsumo_query', 'do_tsumo', seat)),
+    'nine_terminals': lambda seat, d: ('answer_query', (seat, 'draw_query', 'do_9tile_draw', seat)),
+    'pass': lambda seat, d: ('answer_call', (seat,)),
+}
 
 
 
 
 
 
+# Events that are handled on a given shard, from the clients connected to any
+# shard
+shard_events = {}
+
+def shard_event(fun):
+    shard_events[fun.__name__] = fun
+    return fun
+
+async def dispatch(shard, event, sid, *args):
+    if shard == SHARD:
+        await shard_events[event](sid, *args)
+    else:
+        await sio.manager.route(shard, event, sid, *args)
+
+async def on_route(event, sid, *args):
+    await shard_events[event](sid, *args)
+
+def shard_codes(shard, shards):
+    # The room codes that a shard owns
+    return range(10000 + (shard - 10000) % shards, 100000, shards)
+
+
 @sio.event
 async def connect(sid, environ, auth):
     pass
 
 @sio.event
 async def create_game(sid, name):
-    async with sio.session(sid) as sess:
-        if 'player' in sess:
-            await sio.emit('server_error', "Already in a room")
-            return
+    if sid in routes:
+        await sio.emit('server_error', "Already in a room", to=sid)
+        return
 
     pl = Player(sid, name)
     if not is_valid_name(name):
-        await sio.emit('server_error', "Name is not valid")
+        await sio.emit('server_error', "Name is not valid", to=sid)
+        return
+    # Rooms are always created on the shard the host is connected to
+    try:
+        r = lobby.open_room(Room)
+    except engine.LobbyError as e:
+        await sio.emit('server_error', str(e), to=sid)
         return
-    r = Room(str(random.randint(10000, 99999)))
-    rooms[r.name] = r
+    routes[sid] = SHARD
     try:
         await r.join(pl)
     except AppError as e:
-        await sio.emit('server_error', e.msg)
+        del routes[sid]
+        lobby.close_room(r.name)
+        await sio.emit('server_error', e.msg, to=sid)
 
     
 @sio.event
 async def join_game(sid, room_code, name):
-    async with sio.session(sid) as sess:
-        if 'player' in sess:
-            await sio.emit('server_error', "Already in a room")
-            return
-
+    if sid in routes:
+        await sio.emit('server_error', "Already in a room", to=sid)
+        return
     try:
-        r = rooms[room_code]
-        pl = Player(sid, name)
-        await r.join(pl)
-    except KeyError:
+        shard = shard_for(room_code, SHARDS)
+    except ShardError:
         await sio.emit('server_error', 'Room does not exist', to=sid)
+        return
+    routes[sid] = shard
+    await dispatch(shard, 'room_join', sid, SHARD, room_code, name)
+
+@shard_event
+async def room_join(sid, origin, room_code, name):
+    r = lobby.get_room(room_code)
+    try:
+        if r is None:
+            raise AppError('Room does not exist')
+        await r.join(Player(sid, name))
+        return
+    except AppError as e:
+        await sio.emit('server_error', e.msg, to=sid)
+    await dispatch(origin, 'unroute', sid)
+
+@shard_event
+async def unroute(sid):
+    routes.pop(sid, None)
+
+
+@sio.event
+async def start_game(sid):
+    if sid not in routes:
+        await sio.emit('server_error', "Not in a room", to=sid)
+        return
+    await dispatch(routes[sid], 'room_start_game', sid)
+
+@shard_event
+async def room_start_game(sid):
+    pl = lobby.get_player(sid)
+    if pl is None or not pl.host:
+        await sio.emit('server_error', "Only the host can start the game", to=sid)
+        return
+    try:
+        await pl.room.start()
     except AppError as e:
         await sio.emit('server_error', e.msg, to=sid)
 
 
+@sio.event
+async def add_bot(sid, name):
+    if sid not in routes:
+        await sio.emit('server_error', "Not in a room", to=sid)
+        return
+    await dispatch(routes[sid], 'room_add_bot', sid, name)
+
+@shard_event
+async def room_add_bot(sid, name):
+    pl = lobby.get_player(sid)
+    if pl is None or not pl.host:
+        await sio.emit('server_error', "Only the host can add bots", to=sid)
+        return
+    try:
+        await pl.room.add_bot(name)
+    except AppError as e:
+        await sio.emit('server_error', e.msg, to=sid)
+
+
+@sio.event
+async def game_action(sid, action, data=None):
+    if sid not in routes:
+        await sio.emit('server_error', "Not in a game", to=sid)
+        return
+    await dispatch(routes[sid], 'room_game_action', sid, action, data)
+
+@shard_event
+async def room_game_action(sid, action, data):
+    pl = lobby.get_player(sid)
+    if pl is None or pl.room.game is None or pl.seat is None:
+        await sio.emit('server_error', "Not in a game", to=sid)
+        return
+    try:
+        name, args = GAME_ACTIONS[action](pl.seat, data or {})
+    except (KeyError, TypeError, AttributeError):
+        await sio.emit('server_error', "Invalid action", to=sid)
+        return
+    pl.room.submit(sid, getattr(pl.room.game, name), *args)
+
+
 @sio.event
 async def disconnect(sid):
-    async with sio.session(sid) as sess:
-        if 'player' in sess:
-            pl = sess['player']
-            await pl.room.leave(pl)
+    if sid in routes:
+        await dispatch(routes.pop(sid), 'room_leave', sid)
+
+@shard_event
+async def room_leave(sid):
+    pl = lobby.get_player(sid)
+    if pl is None:
+        return
+    if pl.room.game is not None:
+        await pl.room.suspend(pl)
+    else:
+        await pl.room.leave(pl)
+
+
+@sio.event
+async def resume_game(sid, room_code, token):
+    if sid in routes:
+        await sio.emit('server_error', "Already in a room", to=sid)
+        return
+    try:
+        shard = shard_for(room_code, SHARDS)
+    except ShardError:
+        await sio.emit('server_error', 'Room does not exist', to=sid)
+        return
+    routes[sid] = shard
+    await dispatch(shard, 'room_resume', sid, SHARD, room_code, token)
 
+@shard_event
+async def room_resume(sid, origin, room_code, token):
+    r = lobby.get_room(room_code)
+    try:
+        if r is None:
+            raise AppError('Room does not exist')
+        await r.resume(sid, token)
+        return
+    except AppError as e:
+        await sio.emit('server_error', e.msg, to=sid)
+    await dispatch(origin, 'unroute', sid)
 
 
+def use_shards(shard, shards, bus):
+    # Make this process one of several shards, before serving any client
+    global SHARD, SHARDS, lobby
+    SHARD = shard
+    SHARDS = shards
+    lobby = engine.Lobby(shard_codes(shard, shards))
+    sio.manager = ShardManager(shard, shards, bus, on_route)
+    sio.manager.set_server(sio)
+    def start():
+        # Listen for routed events right away, not once a client connects
+        sio.manager_initialized = True
+        sio.manager.initialize()
+    app.on_startup = start
+
+def run_shard(shard, shards, hub_path, host, port):
+    use_shards(shard, shards, UnixBus(hub_path))
+    uvicorn.run(app, host=host, port=port)
+
+async def run_hub(path, workers):
+    hub = Hub(path)
+    await hub.start()
+    for w in workers:
+        w.start()
+    try:
+        await asyncio.gather(*[asyncio.to_thread(w.join) for w in workers])
+    finally:
+        await hub.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of shard processes, serving on consecutive ports")
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        uvicorn.run(app, host=args.host, port=args.port)
+        return
+    # Clients may connect to any shard, e.g. through a load balancer over the
+    # ports. Every shard process is a client of the hub run by this process.
+    hub_path = os.path.join(tempfile.mkdtemp(), "hub.sock")
+    workers = [multiprocessing.Process(
+        target=run_shard, args=(i, args.workers, hub_path, args.host, args.port + i))
+        for i in range(args.workers)]
+    asyncio.run(run_hub(hub_path, workers))
 
 if __name__ == "__main__":
-    uvicorn.run(app, host='127.0.0.1', port=5000)
\ No newline at end of file
+    main()
@@ -0,0 +1,152 @@
+# Benchmarks for the engine hot paths, using pytest-benchmark.
+#
+#   python bench_engine.py --save    Run and store a new baseline
+#   python bench_engine.py           Run and compare against the latest
+#                                    baseline, failing if any benchmark's mean
+#                                    is more than REGRESSION_THRESHOLD percent
+#                                    slower
+#
+# Baselines are kept in benchmarks/, which is not checked in: timings are
+# only comparable on the machine they were made on. Save a local baseline
+# with --save on a clean checkout before starting on a change, then compare
+# against it while working.
+# All inputs are generated from fixed seeds, and the shanten and hand value
+# caches are cleared before every round so the cold path is measured.
+
+import os
+import random
+import sys
+
+import pytest
+
+import engine
+from engine import Game, Player, Wall, ShuffledWall, CallComputer
+from engine import Hand, get_shanten_and_ukeire, hand_value_cache
+
+REGRESSION_THRESHOLD = 20
+STORAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+ROUNDS = 20
+
+
+def clear_caches():
+    for cached in [engine._shanten_and_ukeire_for_key, engine._blocks, engine._next_blocks,
+                   engine._combine, engine._part_ukeire]:
+        cached.cache_clear()
+    hand_value_cache.clear()
+
+def make_game(seed):
+    g = Game(ShuffledWall(rng=random.Random(seed)))
+    g.start_game([Player(g, "P{}".format(i)) for i in range(4)], False)
+    return g
+
+def random_hands(seed, n, size=13):
+    rng = random.Random(seed)
+    return [rng.sample(range(136), size) for i in range(n)]
+
+def run_pedantic(benchmark, fun, setup):
+    benchmark.pedantic(fun, setup=setup, rounds=ROUNDS, iterations=1)
+
+
+def test_get_shanten_and_ukeire(benchmark):
+    hands = random_hands(1, 10)
+    def run():
+        for hand in hands:
+            get_shanten_and_ukeire(hand)
+    run_pedantic(benchmark, run, clear_caches)
+
+def test_ask_for_discard(benchmark):
+    g = make_game(2)
+    player = g.players[g.active_player]
+    def setup():
+        clear_caches()
+        player.discard_table = None
+        g.pending_events = []
+    run_pedantic(benchmark, lambda: g._ask_for_discard(player), setup)
+
+def test_check_for_riichi(benchmark):
+    # A closed tenpai hand, so the riichi query is always made
+    g = make_game(3)
+    player = g.players[g.active_player]
+    for t136 in player.hand[:]:
+        player.remove_tile(t136)
+    g.wall.reset()
+    for t136 in engine.tc.one_line_string_to_136_array("123456m234p6799s1z"):
+        player.add_tile(g.wall.take(t136))
+    def setup():
+        clear_caches()
+        player.discard_table = None
+        g.pending_events = []
+    run_pedantic(benchmark, lambda: g._check_for_riichi(player), setup)
+    assert g.pending_events
+
+def test_check_win(benchmark):
+    g = Game()
+    player = Player(g, "A")
+    g.wall.reset()
+    for t136 in engine.tc.one_line_string_to_136_array("234567m234p6799s"):
+        player.add_tile(g.wall.take(t136))
+    win_tile = g.wall.take(engine.tt("8s0"))
+    config = g._get_base_hand_config()
+    config.is_riichi = True
+    run_pedantic(benchmark, lambda: player.check_win(win_tile, [0], config), clear_caches)
+
+def test_call_computer(benchmark):
+    cc = CallComputer()
+    hands = random_hands(3, 50)
+    discards = [h.pop() for h in hands]
+    hands = [Hand(h) for h in hands]
+    def run():
+        for disc136, hand in zip(discards, hands):
+            cc.get_chi_sets(disc136, hand)
+            cc.get_pon_sets(disc136, hand)
+    benchmark(run)
+
+def test_wall_draw(benchmark):
+    w = Wall()
+    w.rng = random.Random(4)
+    run_pedantic(benchmark, lambda: w.draw_many(70, []), w.reset)
+
+def test_wall_draw_prob_sets(benchmark):
+    w = Wall()
+    w.rng = random.Random(5)
+    prob_set = [1.0 + (i % 9) / 10 for i in range(37)]
+    run_pedantic(benchmark, lambda: w.draw_many(70, [prob_set]), w.reset)
+
+def test_discard_tile(benchmark):
+    # Discard and everything that follows, up to the next player's discard
+    # query
+    state = {}
+    def setup():
+        g = make_game(6)
+        clear_caches()
+        evs = g.pop_events()
+        pl, q = [(pl, ev) for pl, ev in evs if ev.name == 'discard_query'][0]
+        state['args'] = (g, pl, q.allowed[-1])
+    def run():
+        g, pl, t136 = state['args']
+        g.discard_tile(pl, t136)
+        g.run_continuation()
+    run_pedantic(benchmark, run, setup)
+
+def test_start_round(benchmark):
+    g = make_game(7)
+    def setup():
+        clear_caches()
+        g.pending_events = []
+    run_pedantic(benchmark, lambda: g.start_round('same'), setup)
+
+
+def main():
+    args = [__file__, "-q", "--benchmark-storage=" + STORAGE]
+    if "--save" in sys.argv[1:]:
+        args.append("--benchmark-autosave")
+    else:
+        args.extend([
+            "--benchmark-compare",
+            "--benchmark-compare-fail=mean:{}%".format(REGRESSION_THRESHOLD)
+        ])
+    args.extend(a for a in sys.argv[1:] if a != "--save")
+    sys.exit(pytest.main(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+from engine import (Game, Player, NewRoundEvent, DiscardEvent, CallEvent,
+                    DoraEvent, Meld, CallQuery, CallArbiter, TERMINALS_AND_HONORS,
+                    get_shanten34, get_discard_table34)
+
+# Tile safety against each opponent, from what one player can see. The
+# levels, safest first:
+#   GENBUTSU  the opponent discarded the tile kind, or it was discarded by
+#             anyone after the opponent declared riichi, so they can't ron it
+#   SUJI      both tiles 3 away (one for 1-3 and 7-9) are genbutsu, so no
+#             two-sided wait can be on it
+#   KABE      every shape that waits on the tile needs a tile kind that is
+#             all visible, or for honors, at least 3 of them are visible
+#   UNSAFE    none of the above
+GENBUTSU = 3
+SUJI = 2
+KABE = 1
+UNSAFE = 0
+
+def _suit_number(t34):
+    # (first tile kind of the suit, number 1-9), or None for honors
+    if t34 >= 27:
+        return None
+    return t34 - t34 % 9, t34 % 9 + 1
+
+def _is_suji(genbutsu, t34):
+    first, n = _suit_number(t34)
+    low = n <= 3 or genbutsu >> (first + n - 4) & 1
+    high = n >= 7 or genbutsu >> (first + n + 2) & 1
+    return bool(low and high)
+
+# Shapes of two tiles that wait on each tile kind, as tile kind offsets
+_SHAPES = [(1, 2), (-1, 1), (-2, -1)]
+WAIT_SHAPES = []
+for _t34 in range(34):
+    if _t34 >= 27:
+        WAIT_SHAPES.append(())
+        continue
+    _first, _n = _suit_number(_t34)
+    WAIT_SHAPES.append(tuple((_t34 + a, _t34 + b) for a, b in _SHAPES
+                             if 1 <= _n + a <= 9 and 1 <= _n + b <= 9))
+
+
+class SafetyIndex(object):
+    # Kept up to date by passing it every event the player gets, with
+    # record(). Each discard or call only changes the tiles it touches, so
+    # asking for the safety of a tile doesn't go through the discards again.
+    def __init__(self, player_idx):
+        self.player_idx = player_idx
+        self.reset()
+
+    def reset(self):
+        # Visible tiles of each kind: discards, melds and dora indicators
+        self.visible = [0] * 34
+        # Bit masks of tile kinds, by opponent
+        self.genbutsu = [0] * 4
+        self.suji = [0] * 4
+        self.is_riichi = [False] * 4
+
+    def record(self, player_idx, ev):
+        if isinstance(ev, NewRoundEvent):
+            self.reset()
+        elif isinstance(ev, DiscardEvent):
+            self._discard(ev.player, ev.tile // 4, ev.is_riichi)
+        elif isinstance(ev, CallEvent):
+            self._call(ev.meld)
+        elif isinstance(ev, DoraEvent):
+            self.visible[ev.tile // 4] += 1
+
+    def _discard(self, discarder, t34, is_riichi):
+        self.visible[t34] += 1
+        bit = 1 << t34
+        for opp in range(4):
+            if opp == discarder or self.is_riichi[opp]:
+                self._add_genbutsu(opp, t34, bit)
+        if is_riichi:
+            self.is_riichi[discarder] = True
+
+    def _add_genbutsu(self, opp, t34, bit):
+        if self.genbutsu[opp] & bit:
+            return
+        self.genbutsu[opp] |= bit
+        if t34 >= 27:
+            return
+        # Only the tiles 3 away can become suji
+        first, n = _suit_number(t34)
+        for m in (n - 3, n + 3):
+            if 1 <= m <= 9 and _is_suji(self.genbutsu[opp], first + m - 1):
+                self.suji[opp] |= 1 << (first + m - 1)
+
+    def _call(self, meld):
+        if meld.kind == Meld.AKAN:
+            # The pon was already seen
+            self.visible[meld.tiles[-1] // 4] += 1
+            return
+        for t136 in meld.tiles:
+            # The called tile was seen as a discard
+            if t136 != meld.called_tile:
+                self.visible[t136 // 4] += 1
+
+    def is_kabe(self, t34, visible):
+        if t34 >= 27:
+            return visible[t34] >= 3
+        return all(visible[a] >= 4 or visible[b] >= 4 for a, b in WAIT_SHAPES[t34])
+
+    def get_safety(self, opponent, hand34=None):
+        # Safety level of every tile kind against the opponent. The player's
+        # own tiles in hand34 count as visible for kabe.
+        visible = self.visible
+        if hand34 is not None:
+            visible = [v + h for v, h in zip(visible, hand34)]
+        genbutsu = self.genbutsu[opponent]
+        suji = self.suji[opponent]
+        table = []
+        for t34 in range(34):
+            if genbutsu >> t34 & 1:
+                table.append(GENBUTSU)
+            elif suji >> t34 & 1:
+                table.append(SUJI)
+            elif self.is_kabe(t34, visible):
+                table.append(KABE)
+            else:
+                table.append(UNSAFE)
+        return table
+
+    def get_danger(self, hand34=None):
+        # For every tile kind, the lowest safety level against any opponent in
+        # riichi, or None if nobody is
+        tables = [self.get_safety(opp, hand34) for opp in range(4)
+                  if opp != self.player_idx and self.is_riichi[opp]]
+        if not tables:
+            return None
+        return [min(levels) for levels in zip(*tables)]
+
+
+# Tile kinds that make a pon a yaku, besides the seat and round wind
+DRAGONS = (31, 32, 33)
+
+class BotPlayer(Player):
+    # A player that answers its own queries with act(). Discards go for the
+    # lowest shanten and then the most tiles left that lower it, counting
+    # only the tiles the player can see. Calls are only made when they keep
+    # a yaku, and when an opponent is in riichi the bot folds with the
+    # safest tile unless it is close to tenpai.
+    # Feed it the events it gets with record(), so it can keep track of
+    # the visible tiles.
+
+    # Folds against riichi when the best discard leaves this many shanten
+    FOLD_SHANTEN = 2
+    # Only riichi with this many draws left
+    RIICHI_DRAWS = 4
+
+    def __init__(self, game, name):
+        self.safety = SafetyIndex(-1)
+        super().__init__(game, name)
+
+    # The safety index leaves out the bot's own seat, so it follows the seat
+    # whenever the game assigns one
+    @property
+    def idx(self):
+        return self._idx
+
+    @idx.setter
+    def idx(self, idx):
+        self._idx = idx
+        self.safety.player_idx = idx
+
+    def record(self, player_idx, ev):
+        self.safety.record(player_idx, ev)
+
+    def act(self):
+        # Answers the open queries of this player on the game. Returns False
+        # if there was nothing to answer.
+        game = self.game
+        by_name = {}
+        for idx, query in game.open_queries:
+            if idx == self.idx:
+                by_name.setdefault(query.kind if query.name == 'call_query' else query.name, query)
+        if not by_name or game.has_answered(self.idx):
+            return False
+        if 'discard_query' in by_name:
+            self._act_turn(by_name)
+        else:
+            self._act_reaction(by_name)
+        return True
+
+    def _act_turn(self, by_name):
+        game = self.game
+        if 'tsumo_query' in by_name and self.wants_tsumo(by_name['tsumo_query']):
+            game.do_tsumo(self.idx)
+            return
+        if 'draw_query' in by_name and self.wants_draw(by_name['draw_query']):
+            game.do_9tile_draw(self.idx)
+            return
+        if CallQuery.KAN in by_name:
+            choice = self.choose_call(by_name[CallQuery.KAN])
+            if choice:
+                game.call_closed_or_added_kan(choice, self.idx)
+                return
+        if 'riichi_query' in by_name:
+            t136 = self.choose_riichi(by_name['riichi_query'])
+            if t136 is not None:
+                game.discard_tile(self.idx, t136, True)
+                return
+        game.discard_tile(self.idx, self.choose_discard(by_name['discard_query']))
+
+    def _act_reaction(self, by_name):
+        # Ron beats kan and pon, which beat chi
+        game = self.game
+        if 'ron_query' in by_name and self.wants_ron(by_name['ron_query']):
+            game.answer_call(self.idx, 'do_ron')
+            return
+        for kind in [CallQuery.KAN, CallQuery.PON, CallQuery.CHI]:
+            if kind in by_name:
+                choice = self.choose_call(by_name[kind])
+                if choice:
+                    game.answer_call(self.idx, CallArbiter.CALL_METHODS[kind], choice)
+                    return
+        game.answer_call(self.idx)
+
+    def remaining34(self):
+        # Tiles of each kind that are neither in the hand nor visible
+        hand34 = self.hand.tiles34
+        return [4 - h - v for h, v in zip(hand34, self.safety.visible)]
+
+    def _efficiency_table(self):
+        # (shanten, tiles left that lower it) after discarding each kind
+        remaining = self.remaining34()
+        return {t34: (shanten, sum(remaining[t] for t in ukeire)) for t34, (shanten, ukeire)
+                in get_discard_table34(self.hand.tiles34).items()}
+
+    def choose_discard(self, query):
+        table = self._efficiency_table()
+        danger = None if self.is_riichi else self.safety.get_danger(self.hand.tiles34)
+        if danger is None:
+            def key(t136):
+                shanten, left = table[t136 // 4]
+                return (shanten, -left, _keep_value(t136 // 4))
+        elif min(s for s, left in table.values()) >= self.FOLD_SHANTEN:
+            def key(t136):
+                shanten, left = table[t136 // 4]
+                return (-danger[t136 // 4], shanten, -left)
+        else:
+            def key(t136):
+                shanten, left = table[t136 // 4]
+                return (shanten, -danger[t136 // 4], -left)
+        return min(query.allowed, key=key)
+
+    def choose_riichi(self, query):
+        # Riichi on the wait with the most tiles left, if any are left
+        if self.game.remaining_draws < self.RIICHI_DRAWS:
+            return None
+        remaining = self.remaining34()
+        def left(item):
+            t136, wait = item
+            return sum(remaining[t] for t in wait.tiles)
+        t136, wait = max(zip(query.allowed, query.waits), key=left)
+        if left((t136, wait)) == 0:
+            return None
+        return t136
+
+    def wants_tsumo(self, query):
+        return True
+
+    def wants_ron(self, query):
+        return True
+
+    def wants_draw(self, query):
+        # Goes for kokushi with 11 kinds or more
+        tiles34 = self.hand.tiles34
+        return sum(1 for t in TERMINALS_AND_HONORS if tiles34[t]) < 11
+
+    def _yaku_kinds(self):
+        round_wind = 27 + Game.WIND_ORDER.index(self.game.wind)
+        seat_wind = 27 + Game.WIND_ORDER.index(self.game.get_player_wind(self))
+        return set(DRAGONS + (round_wind, seat_wind))
+
+    def choose_call(self, query):
+        # The tiles of the call to make, or None
+        if self.is_riichi:
+            return None
+        tiles34 = self.hand.tiles34
+        if query.from_who is None:
+            # Closed or added kan on our own turn, if it doesn't set us back
+            current = _best_shanten(tiles34)
+            for choice in query.choices:
+                t34 = choice[0] // 4
+                after = _without(tiles34, [t34] * tiles34[t34])
+                if get_shanten34(after) <= current:
+                    return choice
+            return None
+
+        if self.safety.get_danger() is not None and \
+           get_shanten34(tiles34) >= self.FOLD_SHANTEN:
+            return None
+        # Calls need a yaku, which here is a yakuhai pon or kan
+        yaku = self._yaku_kinds()
+        has_yaku = any(m.tiles[0] // 4 in yaku for m in self.melds if m.kind != Meld.CHI)
+        called = self.game.players[query.from_who].discards[query.discard_idx].tile
+        if not has_yaku and (query.kind == CallQuery.CHI or called // 4 not in yaku):
+            return None
+
+        current = get_shanten34(tiles34)
+        best = None
+        for choice in query.choices:
+            after = _without(tiles34, [t136 // 4 for t136 in choice if t136 != called])
+            if query.kind == CallQuery.KAN:
+                # The replacement tile makes up for the kan
+                shanten = get_shanten34(after)
+                better = shanten <= current
+            else:
+                shanten = _best_shanten(after)
+                # A yakuhai pon is worth it even if it isn't faster
+                better = shanten < current or (not has_yaku and shanten == current)
+            if better and (best is None or shanten < best[0]):
+                best = (shanten, choice)
+        return best[1] if best is not None else None
+
+
+def _best_shanten(tiles34):
+    # Shanten after the best discard
+    return min(s for s, ukeire in get_discard_table34(tiles34, False).values())
+
+def _without(tiles34, kinds):
+    tiles34 = list(tiles34)
+    for t34 in kinds:
+        tiles34[t34] -= 1
+    return tiles34
+
+def _keep_value(t34):
+    # Between equal discards, honors go first, then terminals
+    if t34 >= 27:
+        return 0
+    n = t34 % 9
+    return 1 if n in (0, 8) else 2
@@ -1,7 +1,11 @@
 
+import collections
+import copy
+import functools
 import itertools
 import json
 import random
+import threading
 import traceback
 
 from mahjong.shanten import Shanten
@@ -18,24 +22,470 @@ from tile import Tile, Tile34, to_tiles, tt, tile34_string_to_136_array
 
 
 
+# Shanten and ukeire from per-suit block tables. A hand is split into the
+# three suits and the honors, and for every distinct set of counts in one of
+# them the best ways to make sets, partial sets and a pair are worked out once
+# and cached, along with bit masks of the tiles that would improve them. The
+# shanten of a hand is then a small combination of four table lookups, and
+# its ukeire a few mask lookups per part instead of a shanten per tile kind.
+# This is the regular hand shanten of the mahjong lib, plus chiitoitsu and
+# kokushi for closed hands. Unlike counting with the lib, tile kinds the hand
+# already holds all four of are never ukeire, as none are left to draw.
+MAX_SETS = 4
+# Block value of a split that can't be made
+NO_SPLIT = -100
+TERMINALS_AND_HONORS = (0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33)
+# (first tile kind, whether sequences can be made) of each part of a hand
+HAND_PARTS = ((0, True), (9, True), (18, True), (27, False))
+
+NO_BLOCKS = ((0,) * (MAX_SETS + 1), (NO_SPLIT,) * (MAX_SETS + 1))
+
+@functools.lru_cache(maxsize=1 << 18)
+def _blocks(counts, seq):
+    # For no pair and for a pair, the best 2*sets + partial sets the counts
+    # can be split into with at most b sets and partial sets, for every b.
+    # The first tile is left out or taken in each possible block, and the
+    # rest is split the same way.
+    i = 0
+    while i < len(counts) and counts[i] == 0:
+        i += 1
+    if i == len(counts):
+        return NO_BLOCKS
+    c = counts[i:]
+    best = ([NO_SPLIT] * (MAX_SETS + 1), [NO_SPLIT] * (MAX_SETS + 1))
+    def take(offsets, value, pair):
+        rest = list(c)
+        for o in offsets:
+            rest[o] -= 1
+        blocks = _blocks(tuple(rest), seq)
+        for p in range(2 - pair):
+            before = blocks[p]
+            after = best[p + pair]
+            for b in range(MAX_SETS + 1):
+                v = before[b]
+                if value and b and before[b - 1] + value > v:
+                    v = before[b - 1] + value
+                if v > after[b]:
+                    after[b] = v
+    take((0,), 0, 0)
+    if c[0] >= 2:
+        take((0, 0), 0, 1)
+        take((0, 0), 1, 0)
+    if c[0] >= 3:
+        take((0, 0, 0), 2, 0)
+    if seq:
+        has1 = len(c) > 1 and c[1] > 0
+        has2 = len(c) > 2 and c[2] > 0
+        if has1 and has2:
+            take((0, 1, 2), 2, 0)
+        if has1:
+            take((0, 1), 1, 0)
+        if has2:
+            take((0, 2), 1, 0)
+    return (tuple(best[0]), tuple(best[1]))
+
+@functools.lru_cache(maxsize=65536)
+def _next_blocks(counts, seq):
+    # Like _blocks after adding one more tile, as bit masks of the tiles
+    # that get each value or more, by pair, b and value. There is no fifth
+    # tile of a kind to add.
+    masks = [[[0] * (2 * MAX_SETS + 1) for b in range(MAX_SETS + 1)] for pair in (0, 1)]
+    for j, n in enumerate(counts):
+        if n == 4:
+            continue
+        added = _blocks(counts[:j] + (n + 1,) + counts[j + 1:], seq)
+        for pair in (0, 1):
+            for b in range(MAX_SETS + 1):
+                by_value = masks[pair][b]
+                for v in range(added[pair][b] + 1):
+                    by_value[v] |= 1 << j
+    return tuple(tuple(tuple(by_value) for by_value in by_b) for by_b in masks)
+
+@functools.lru_cache(maxsize=65536)
+def _combine(f, g):
+    # Blocks of two parts of a hand together. Most parts of a hand are the
+    # same from one turn to the next, so the results are cached too.
+    f0, f1 = f
+    g0, g1 = g
+    out0 = []
+    out1 = []
+    for b in range(MAX_SETS + 1):
+        best0 = best1 = NO_SPLIT
+        for a in range(b + 1):
+            c = b - a
+            v = f0[a] + g0[c]
+            if v > best0:
+                best0 = v
+            v = max(f0[a] + g1[c], f1[a] + g0[c])
+            if v > best1:
+                best1 = v
+        out0.append(best0)
+        out1.append(best1)
+    return (tuple(out0), tuple(out1))
+
+def _value(f, g, sets):
+    # Best value of two parts with sets blocks between them, counting the
+    # pair as one
+    f0, f1 = f
+    g0, g1 = g
+    best = NO_SPLIT
+    for b in range(sets + 1):
+        a = sets - b
+        v = max(f0[a] + g0[b], f0[a] + g1[b] + 1, f1[a] + g0[b] + 1)
+        if v > best:
+            best = v
+    return best
+
+def _at(by_value, v):
+    if v > 2 * MAX_SETS:
+        return 0
+    return by_value[max(v, 0)]
+
+@functools.lru_cache(maxsize=65536)
+def _part_ukeire(part, seq, rest, sets, value):
+    # Mask of the tiles of the part that bring the regular hand to the
+    # value, given the blocks of the rest of the hand
+    masks0, masks1 = _next_blocks(part, seq)
+    r0, r1 = rest
+    mask = 0
+    for b in range(sets + 1):
+        a = sets - b
+        mask |= _at(masks0[b], value - r0[a]) | _at(masks1[b], value - r0[a] - 1) | \
+            _at(masks0[b], value - r1[a] - 1)
+    return mask
+
+def _regular_ukeire(parts, rests, sets, value):
+    # Tile kinds that bring the regular hand to the value, given the blocks
+    # of the rest of the hand for each part
+    ukeire = []
+    for part, rest, (first, seq) in zip(parts, rests, HAND_PARTS):
+        mask = _part_ukeire(part, seq, rest, sets, value)
+        while mask:
+            low = mask & -mask
+            ukeire.append(first + low.bit_length() - 1)
+            mask ^= low
+    return ukeire
+
+def _chiitoitsu_shanten(pairs, kinds):
+    if pairs == 7:
+        return -1
+    return 6 - pairs + max(0, 7 - kinds)
+
+def _kokushi_shanten(yao_kinds, yao_pairs):
+    return 13 - yao_kinds - (1 if yao_pairs else 0)
+
+def _closed_counts(tiles34):
+    pairs = sum(1 for n in tiles34 if n >= 2)
+    kinds = sum(1 for n in tiles34 if n)
+    yao_kinds = sum(1 for t in TERMINALS_AND_HONORS if tiles34[t])
+    yao_pairs = sum(1 for t in TERMINALS_AND_HONORS if tiles34[t] >= 2)
+    return pairs, kinds, yao_kinds, yao_pairs
+
+def _closed_ukeire(tiles34, shanten, counts):
+    # Tile kinds that lower a 13 tile hand below shanten as chiitoitsu or
+    # kokushi
+    pairs, kinds, yao_kinds, yao_pairs = counts
+    ukeire = []
+    if _chiitoitsu_shanten(pairs, kinds) == shanten:
+        ukeire.extend(t34 for t34, n in enumerate(tiles34)
+                      if n == 1 or (n == 0 and kinds < 7))
+    if _kokushi_shanten(yao_kinds, yao_pairs) == shanten:
+        ukeire.extend(t34 for t34 in TERMINALS_AND_HONORS
+                      if tiles34[t34] == 0 or (tiles34[t34] == 1 and not yao_pairs))
+    return ukeire
+
+def _hand_blocks(tiles34):
+    parts = [tuple(tiles34[first:first + (9 if seq else 7)]) for first, seq in HAND_PARTS]
+    return parts, [_blocks(part, seq) for part, (first, seq) in zip(parts, HAND_PARTS)]
+
+def get_shanten34(tiles34):
+    # Shanten of a hand of any size. Chiitoitsu and kokushi only count for
+    # 13 and 14 tiles.
+    n = sum(tiles34)
+    parts, blocks = _hand_blocks(tiles34)
+    total = _combine(_combine(blocks[0], blocks[1]), blocks[2])
+    shanten = 2 * (n // 3) - _value(total, blocks[3], n // 3)
+    if n >= 13:
+        pairs, kinds, yao_kinds, yao_pairs = _closed_counts(tiles34)
+        shanten = min(shanten, _chiitoitsu_shanten(pairs, kinds),
+                      _kokushi_shanten(yao_kinds, yao_pairs))
+    return shanten
+
+@functools.lru_cache(maxsize=65536)
+def _shanten_and_ukeire_for_key(key34):
+    parts, blocks = _hand_blocks(key34)
+    # The blocks of every part but one, for each part
+    before = [NO_BLOCKS]
+    for g in blocks[:-1]:
+        before.append(_combine(before[-1], g))
+    rests = [None] * len(blocks)
+    after = NO_BLOCKS
+    for i in reversed(range(len(blocks))):
+        rests[i] = _combine(before[i], after)
+        after = _combine(after, blocks[i])
+    n = sum(key34)
+    sets = (n + 1) // 3
+    shanten = 2 * sets - _value(rests[0], blocks[0], sets)
+    if n == 13:
+        counts = _closed_counts(key34)
+        shanten = min(shanten, _chiitoitsu_shanten(counts[0], counts[1]),
+                      _kokushi_shanten(counts[2], counts[3]))
+    ukeire = _regular_ukeire(parts, rests, sets, 2 * sets - shanten + 1)
+    if n == 13:
+        ukeire = sorted(set(ukeire).union(_closed_ukeire(key34, shanten, counts)))
+    return shanten, tuple(ukeire)
+
+def get_shanten_and_ukeire34(tiles34):
+    # Shanten of a hand of 3n+1 tiles and the tile kinds that lower it. Cached
+    # on the 34 tuple, so hands seen before (e.g. the same 13 tiles after
+    # drawing and discarding the same tile) cost a single lookup.
+    base_shanten, uke = _shanten_and_ukeire_for_key(tuple(tiles34))
+    return (base_shanten, [Tile34(t) for t in uke])
+
+def get_discard_table34(tiles34, with_ukeire=True):
+    # For every tile kind in a hand of 3n+2 tiles, the shanten and ukeire of
+    # the hand without one of it. Every discard only changes one part, so the
+    # blocks of the other parts are combined once for all of them.
+    n = sum(tiles34)
+    sets = n // 3
+    closed = n == 14
+    parts, blocks = _hand_blocks(tiles34)
+    count = len(HAND_PARTS)
+    # Blocks of every two parts, and of every part but one
+    both = {}
+    for s in range(count):
+        for r in range(s + 1, count):
+            both[s, r] = both[r, s] = _combine(blocks[s], blocks[r])
+    others = []
+    for s in range(count):
+        x, y, z = [i for i in range(count) if i != s]
+        others.append(_combine(both[x, y], blocks[z]))
+    if closed:
+        pairs, kinds, yao_kinds, yao_pairs = _closed_counts(tiles34)
+
+    table = {}
+    for s, (part, (first, seq)) in enumerate(zip(parts, HAND_PARTS)):
+        for j, c in enumerate(part):
+            if c == 0:
+                continue
+            t34 = first + j
+            less = part[:j] + (c - 1,) + part[j + 1:]
+            g = _blocks(less, seq)
+            shanten = 2 * sets - _value(others[s], g, sets)
+            if closed:
+                is_yao = t34 in TERMINALS_AND_HONORS
+                counts = (pairs - (c == 2), kinds - (c == 1),
+                          yao_kinds - (is_yao and c == 1), yao_pairs - (is_yao and c == 2))
+                shanten = min(shanten, _chiitoitsu_shanten(counts[0], counts[1]),
+                              _kokushi_shanten(counts[2], counts[3]))
+            if not with_ukeire:
+                table[t34] = (shanten, None)
+                continue
+            new_parts = parts[:s] + [less] + parts[s + 1:]
+            rests = []
+            for r in range(count):
+                if r == s:
+                    rests.append(others[s])
+                else:
+                    x, y = [i for i in range(count) if i != s and i != r]
+                    rests.append(_combine(both[x, y], g))
+            ukeire = _regular_ukeire(new_parts, rests, sets, 2 * sets - shanten + 1)
+            if closed:
+                hand13 = list(tiles34)
+                hand13[t34] -= 1
+                ukeire = sorted(set(ukeire).union(_closed_ukeire(hand13, shanten, counts)))
+            table[t34] = (shanten, tuple(ukeire))
+    return table
+
 def get_shanten_and_ukeire(tiles136):
     assert len(tiles136) in [13, 10, 7, 4, 1]
-    
-    shan = Shanten()
-    tiles34 = tc.to_34_array(tiles136)
-    base_shanten = shan.calculate_shanten(tiles34)
-    uke = []
-    # Check if adding any tile lowers the shanten
-    for t in range(34):
-        tiles_copy = tiles34[:]
-        tiles_copy[t] += 1
-        new_shanten = shan.calculate_shanten(tiles_copy)
-        if new_shanten < base_shanten:
-            uke.append(Tile34(t))
-    return (base_shanten, uke)
+    return get_shanten_and_ukeire34(tc.to_34_array(tiles136))
+
+class Hand(list):
+    # The tiles of a hand, in the order they came in. Alongside the list it
+    # keeps a 136-bit occupancy mask and 34 and 37 count arrays, which are
+    # all updated with a single delta whenever a tile enters or leaves the
+    # hand. Membership is a bit test, and the count arrays can be read
+    # directly instead of converting the whole hand every time.
+    # tiles34 and tiles37 must not be changed from outside.
+    def __init__(self, tiles=()):
+        super().__init__()
+        self.mask = 0
+        self.tiles34 = [0]*34
+        self.tiles37 = [0]*37
+        for t136 in tiles:
+            self.append(t136)
+
+    def __reduce__(self):
+        # The default list pickling appends the items before the state is set
+        return (Hand, (list(self),))
+
+    def copy(self):
+        hand = Hand.__new__(Hand)
+        list.extend(hand, self)
+        hand.mask = self.mask
+        hand.tiles34 = self.tiles34[:]
+        hand.tiles37 = self.tiles37[:]
+        return hand
+
+    @staticmethod
+    def to_t37(t136):
+        if t136 in AKA_DORA_SET:
+            return Wall.FIVES[t136 // 4]
+        return t136 // 4
+
+    def __contains__(self, t136):
+        return isinstance(t136, int) and 0 <= t136 < 136 and (self.mask >> t136) & 1 == 1
+
+    def _add(self, t136):
+        bit = 1 << t136
+        if self.mask & bit:
+            raise ValueError("{} is already in the hand".format(t136))
+        self.mask |= bit
+        self.tiles34[t136 // 4] += 1
+        self.tiles37[self.to_t37(t136)] += 1
+
+    def _discount(self, t136):
+        self.mask &= ~(1 << t136)
+        self.tiles34[t136 // 4] -= 1
+        self.tiles37[self.to_t37(t136)] -= 1
+
+    def append(self, t136):
+        self._add(t136)
+        super().append(t136)
+
+    def insert(self, idx, t136):
+        self._add(t136)
+        super().insert(idx, t136)
+
+    def extend(self, tiles):
+        for t136 in tiles:
+            self.append(t136)
+
+    def __iadd__(self, tiles):
+        self.extend(tiles)
+        return self
+
+    def remove(self, t136):
+        if t136 not in self:
+            raise ValueError("{} is not in the hand".format(t136))
+        super().remove(t136)
+        self._discount(t136)
+
+    def pop(self, idx=-1):
+        t136 = super().pop(idx)
+        self._discount(t136)
+        return t136
+
+    def clear(self):
+        super().clear()
+        self.mask = 0
+        self.tiles34 = [0]*34
+        self.tiles37 = [0]*37
+
+    def __setitem__(self, idx, value):
+        raise TypeError("Hand tiles can only be added or removed")
+
+    def __delitem__(self, idx):
+        raise TypeError("Hand tiles can only be added or removed")
+
+    def __imul__(self, n):
+        raise TypeError("Hand tiles can only be added or removed")
+
+    def get_shanten_and_ukeire(self):
+        assert len(self) in [13, 10, 7, 4, 1]
+        return get_shanten_and_ukeire34(self.tiles34)
+
+    def get_discard_table(self):
+        # Map from every tile kind in the hand to the shanten and ukeire of the
+        # hand without one of that tile. Duplicates are evaluated only once.
+        assert len(self) in [14, 11, 8, 5, 2]
+        return {t34: (shanten, [Tile34(t) for t in ukeire])
+                for t34, (shanten, ukeire) in get_discard_table34(self.tiles34).items()}
+
+
+class LRUCache(object):
+    # Bounded least recently used cache. Counts hits and misses so the size
+    # can be tuned from the stats.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "maxsize": self.maxsize
+        }
+
+# Results of HandCalculator.estimate_hand_value, see Player.check_win
+hand_value_cache = LRUCache(maxsize=8192)
+
+AKA_DORA_SET = frozenset(constants.AKA_DORA_LIST)
+
+def canonical_tile(t136):
+    # The hand calculator only cares about the kind of a tile and whether it
+    # is a red five, so map all other copies of a tile to the same id
+    if t136 in AKA_DORA_SET:
+        return t136
+    return t136 | 3
+
+def canonical_tiles(tiles136):
+    return tuple(sorted(canonical_tile(t) for t in tiles136))
+
+def hand_config_key(config):
+    # Every field of the config that the calculator reads, so only configs
+    # that give the same result share a key. The yaku are the same for all.
+    if config is None:
+        return None
+    fields = tuple(sorted((name, value) for name, value in vars(config).items()
+                          if name not in ('yaku', 'options')))
+    return fields + (tuple(sorted(vars(config.options).items())),)
+
+def copy_hand_response(result):
+    # The cached result is shared, callers get their own copy to change
+    result = copy.copy(result)
+    if result.cost is not None:
+        result.cost = dict(result.cost)
+    if result.yaku is not None:
+        result.yaku = list(result.yaku)
+    if result.fu_details is not None:
+        result.fu_details = [dict(d) for d in result.fu_details]
+    return result
 
 
 class Win(object):
+    __slots__ = ('player_idx', 'hand', 'win_tile', 'melds', 'dora_ind',
+                 'ura_dora_ind', 'han', 'fu', 'yaku', 'level', 'total',
+                 'points')
+
     def __init__(self,
                  player_idx,
                  hand,
@@ -62,7 +512,7 @@ class Win(object):
         self.total = total
         self.points = points
     def __repr__(self):
-        return "({})".format(self.__dict__)
+        return "({})".format(wire_fields(self))
 
 class Meld(object):
     CHI = "chi"
@@ -77,6 +527,7 @@ class Meld(object):
         MKAN: LibMeld.KAN, # open
         AKAN: LibMeld.SHOUMINKAN
     }
+    __slots__ = ('kind', 'tiles', 'called_from', 'called_tile')
 
     def __init__(self, kind, tiles136, called_from=None, called_tile136=None):
         self.kind = kind
@@ -106,6 +557,8 @@ class Meld(object):
 
 
 class Discard(object):
+    __slots__ = ('tile', 'is_tsumogiri', 'is_riichi', 'called')
+
     def __init__(self, tile136, is_tsumogiri=False, is_riichi=False):
         self.tile = tile136
         self.is_tsumogiri = is_tsumogiri
@@ -114,6 +567,11 @@ class Discard(object):
     
     def call_tile(self, player_idx):
         self.called = player_idx
+
+    def clone(self):
+        d = Discard(self.tile, self.is_tsumogiri, self.is_riichi)
+        d.called = self.called
+        return d
     
     def __repr__(self):
         return "({}{}{}{})".format(
@@ -139,104 +597,150 @@ class Draw(object):
 class NoValidTilesError(Exception):
     pass
 
+class WallError(Exception):
+    pass
+
 class CallComputer(object):
+    # Finds the tile sets a hand can chi or pon a discard with. The patterns
+    # of 37-tiles every call needs are built once per discard kind, and are
+    # checked against the count arrays that Hand keeps up to date.
     def __init__(self, red_five_enabled=True):
-        self.red_five_enabled = True
-
-    def t136_to_t37(self, tiles136):
-        t37 = [0]*37
-        for t136 in tiles136:
-            if self.red_five_enabled and t136 in constants.AKA_DORA_LIST:
-                t37[Wall.FIVES[t136//4]] += 1
+        self.red_five_enabled = red_five_enabled
+        # The tiles that count as each 37-tile, in id order
+        self.candidates = []
+        for t37 in range(37):
+            if t37 >= 34:
+                self.candidates.append((Wall.FIVES_INV[t37] * 4,))
+            elif red_five_enabled and t37 in Wall.FIVES:
+                self.candidates.append(tuple(t37*4 + i for i in range(4)
+                                             if t37*4 + i not in AKA_DORA_SET))
             else:
-                t37[t136//4] += 1
-        return t37
-
-    def get_t37_poss(self, t34list):
-        poss = []
-        t37 = [0]*37
-        for t in t34list:
-            t37[t] += 1
-        poss.append(t37)
-        if self.red_five_enabled:
-            for red_34 in Wall.FIVES:
-                if red_34 in t34list:
-                    red_t37 = t37[:]
-                    red_t37[red_34] -= 1
-                    red_t37[Wall.FIVES[red_34]] += 1
-                    poss.append(red_t37)
-        return poss
-
-
-
-    def compute_possible_calls(self, possible37, tiles136):
-        def pop_match(fun, l):
-            for i in range(len(l)):
-                if fun(l[i]):
-                    r = l[i]
-                    del l[i]
-                    return r
-            return None
-        tiles136 = tiles136[:]
-
-        # Determine if we have these tiles on hand and filter the possibilities
-        tiles37 = self.t136_to_t37(tiles136)
-
-        def has_req_tiles(poss37):
-            for i in range(len(poss37)):
-                if tiles37[i] < poss37[i]:
-                    return False
-            return True
-        possible37 = filter(has_req_tiles, possible37)
-
-        # Map the possibility maps to sets of 136 that we have on hand
-        def poss37_to_tiles136(poss37):
-            result136 = []
-            avail136 = tiles136[:]
-            for i in range(len(poss37)):
-                count = poss37[i]
-                while count > 0:
-                    def match_t136_t37(t136):
-                        # Return true if this t136 is the i'th t37
-                        if self.red_five_enabled and t136 in constants.AKA_DORA_LIST:
-                            return Wall.FIVES[t136//4] == i
-                        else:
-                            return t136//4 == i
-                    result136.append(Tile(pop_match(match_t136_t37, avail136)))
-                    count -= 1
-            return result136
-        possible136 = map(poss37_to_tiles136, possible37)
-        return list(possible136)
+                self.candidates.append(tuple(t37*4 + i for i in range(4)))
+        self.pon_patterns = [self._make_patterns([[t34, t34]]) for t34 in range(34)]
+        self.chi_patterns = [self._make_patterns(self._chi_shapes(t34)) for t34 in range(34)]
 
-    def get_pon_sets(self, disc136, tiles136):
-        possible37 = self.get_t37_poss([disc136//4]*2)
-        return self.compute_possible_calls(possible37, tiles136)
-    
-    def get_chi_sets(self, disc136, tiles136):
-        disc34 = disc136//4
-        
+    @staticmethod
+    def _chi_shapes(disc34):
         if disc34 >= 27:
             return []
-        
         tidx = disc34 % 9
-        possible37 = []
+        shapes = []
         if tidx >= 2: # left chi
-            possible37.extend(self.get_t37_poss([disc34-2, disc34-1]))
+            shapes.append([disc34-2, disc34-1])
         if tidx >= 1 and tidx <= 7: # middle chi
-            possible37.extend(self.get_t37_poss([disc34-1, disc34+1]))
+            shapes.append([disc34-1, disc34+1])
         if tidx <= 6: # right chi
-            possible37.extend(self.get_t37_poss([disc34+1, disc34+2]))
-        
-        return self.compute_possible_calls(possible37, tiles136)
+            shapes.append([disc34+1, disc34+2])
+        return shapes
+
+    def _make_patterns(self, shapes):
+        # Each pattern is a tuple of (t37, count), in t37 order. Every shape
+        # is followed by its variant with a red five, if it has a five.
+        patterns = []
+        for t34list in shapes:
+            counts = collections.Counter(t34list)
+            patterns.append(tuple(sorted(counts.items())))
+            if not self.red_five_enabled:
+                continue
+            for red_34 in Wall.FIVES:
+                if red_34 in counts:
+                    red = counts.copy()
+                    red[red_34] -= 1
+                    red[Wall.FIVES[red_34]] += 1
+                    patterns.append(tuple(sorted((t, n) for t, n in red.items() if n)))
+        return patterns
+
+    def _match(self, patterns, tiles136):
+        hand = tiles136 if isinstance(tiles136, Hand) else Hand(tiles136)
+        counts = hand.tiles37 if self.red_five_enabled else hand.tiles34
+        mask = hand.mask
+        possible136 = []
+        for pattern in patterns:
+            if not all(counts[t37] >= n for t37, n in pattern):
+                continue
+            # Use the lowest tiles of each kind we have
+            tiles = []
+            for t37, n in pattern:
+                for t136 in self.candidates[t37]:
+                    if (mask >> t136) & 1:
+                        tiles.append(Tile(t136))
+                        n -= 1
+                        if n == 0:
+                            break
+            possible136.append(tiles)
+        return possible136
+
+    def get_pon_sets(self, disc136, tiles136):
+        return self._match(self.pon_patterns[disc136//4], tiles136)
+
+    def get_chi_sets(self, disc136, tiles136):
+        return self._match(self.chi_patterns[disc136//4], tiles136)
+
+class FenwickTree(object):
+    # Binary indexed tree over a list of weights. Updating a weight and
+    # picking the slot that holds a given point of the total are O(log n).
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.tree = [0] + list(weights)
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(weights)
+        self.top = 1
+        while self.top * 2 <= self.size:
+            self.top *= 2
+
+    def copy(self):
+        tree = FenwickTree.__new__(FenwickTree)
+        tree.size = self.size
+        tree.tree = self.tree[:]
+        tree.total = self.total
+        tree.top = self.top
+        return tree
+
+    def add(self, idx, delta):
+        self.total += delta
+        i = idx + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, x):
+        # Return the slot idx where sum(weights[:idx]) <= x < sum(weights[:idx+1])
+        pos = 0
+        step = self.top
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self.tree[nxt] <= x:
+                pos = nxt
+                x -= self.tree[nxt]
+            step //= 2
+        return pos
 
 class Wall(object):
     # Map from real 5 tile to the fake slot in the map
     FIVES = {4: 34, 13: 35, 22: 36}
     FIVES_INV = {34: 4, 35: 13, 36: 22}
+    # Weighted trees kept per round, and multipliers kept between rounds
+    MAX_WEIGHTED_TREES = 8
+    MAX_MULTIPLIERS = 256
 
-    def __init__(self, has_red_five=True):
+    def __init__(self, has_red_five=True, rng=None):
         self.has_red_five = has_red_five
+        self.rng = rng if rng is not None else random
         self.available = []
+        # Cumulative weights of the available tiles, plus one tree for each
+        # of the last MAX_WEIGHTED_TREES combinations of probability sets
+        # drawn with this round. Every change to the wall updates them all.
+        self.counts = None
+        self.weighted = collections.OrderedDict()
+        # Combined multipliers for the probability sets, kept between rounds
+        self.multipliers = LRUCache(self.MAX_MULTIPLIERS)
+        # Set when the arrays are shared with a snapshot, see snapshot()
+        self._shared = False
+        # State of the rngs, if they haven't been used since it was read
+        self._rng_state = None
         #self.pool
     
     def reset(self):
@@ -246,6 +750,63 @@ class Wall(object):
                 self.available[five] -= 1
             for red_five in self.FIVES.values():
                 self.available[red_five] = 1
+        self.counts = FenwickTree(self.available)
+        self.weighted = collections.OrderedDict()
+        self._shared = False
+        self._rng_state = None
+
+    # A snapshot shares the arrays with the wall, and the wall copies them
+    # before its next change, so taking one doesn't copy anything. The rng
+    # states are only read again once the rngs have been used.
+    def snapshot(self):
+        self._shared = True
+        if self._rng_state is None:
+            self._rng_state = tuple(rng.getstate() for rng in self._rngs())
+        return dict(vars(self))
+
+    def restore(self, state):
+        rng_state = self._rng_state
+        vars(self).update(state)
+        # If the rngs weren't used since the state was read, they are as
+        # they were
+        if rng_state is not self._rng_state:
+            for rng, s in zip(self._rngs(), self._rng_state):
+                rng.setstate(s)
+
+    def _rngs(self):
+        return (self.rng,)
+
+    def _own(self):
+        # Copy the arrays shared with a snapshot before changing them
+        if not self._shared:
+            return
+        self.available = self.available[:]
+        self.counts = self.counts.copy()
+        self.weighted = collections.OrderedDict(
+            (key, (mult, tree.copy())) for key, (mult, tree) in self.weighted.items())
+        self._shared = False
+    
+    def _update(self, t37, delta):
+        self.available[t37] += delta
+        self.counts.add(t37, delta)
+        for mult, tree in self.weighted.values():
+            tree.add(t37, delta * mult[t37])
+    
+    def _get_weighted_tree(self, key):
+        if key in self.weighted:
+            self.weighted.move_to_end(key)
+            return self.weighted[key][1]
+        mult = self.multipliers.get(key)
+        if mult is None:
+            mult = [1.0]*37
+            for prob_set in key:
+                mult = [x * y for x, y in zip(mult, prob_set)]
+            self.multipliers.put(key, mult)
+        tree = FenwickTree([n * m for n, m in zip(self.available, mult)])
+        self.weighted[key] = (mult, tree)
+        if len(self.weighted) > self.MAX_WEIGHTED_TREES:
+            self.weighted.popitem(last=False)
+        return tree
     
     def tiles34_to_tiles37(self, t34):
         t34 = t34[:]
@@ -261,8 +822,8 @@ class Wall(object):
                 t136 = self.draw(prob_sets)
                 l.append(t136)
             except (NoValidTilesError):
-                # Return the tiles before raising
-                self.replace_many(l)
+                # Return the tiles before raising, last drawn first
+                self.replace_many(reversed(l))
                 raise
         return l
     
@@ -270,25 +831,32 @@ class Wall(object):
         for t in t136:
             self.replace(t)
     
+    def t136_to_t37(self, t136):
+        t34 = t136 // 4
+        if self.has_red_five and t34 in self.FIVES and t136 % 4 == 0:
+            return self.FIVES[t34]
+        return t34
+
     # Pass probability modifier sets with multipliers for the tile types
     # apply all sets and then pick tile
     # special case for 0 prob? how to solve
-    def draw(self, prob_sets):
-        # Compute the cumulative weights
-        weights = [float(n) for n in self.available]
-        for prob_set in prob_sets:
-            weights = map(lambda x, y: x * y, weights, prob_set)
-        
-        t37types = [i for i in range(37)]
-        try:
-            t37 = random.choices(t37types, weights=weights)[0]
-        except (ValueError):
-            # All weights were 0: no tiles available based on the weights and
-            # given probability modifiers
-            raise NoValidTilesError()
+    # The kind is where the tile is drawn from: 'hand', 'wall', 'deadwall',
+    # 'dora' or 'uradora'. It doesn't matter here, since this wall is only
+    # a pool of tile counts. See ShuffledWall.
+    def draw(self, prob_sets, kind='wall'):
+        self._own()
+        if not prob_sets:
+            # Plain draw, weighted by the tile counts only
+            if self.counts.total <= 0:
+                raise NoValidTilesError()
+            self._rng_state = None
+            t37 = self.counts.find(self.rng.randrange(self.counts.total))
+        else:
+            key = tuple(map(tuple, prob_sets))
+            t37 = self._draw_weighted(key)
         
         assert self.available[t37] > 0
-        self.available[t37] -= 1
+        self._update(t37, -1)
         
         # Get the t34 for tile class, but use t37 for index to get the right
         # tile in the case of red 5
@@ -298,22 +866,188 @@ class Wall(object):
         
         return t136
     
-    def take(self, t136):
+    def _draw_weighted(self, key):
+        tree = self._get_weighted_tree(key)
+        self._rng_state = None
+        for attempt in range(2):
+            if tree.total > 0:
+                t37 = tree.find(self.rng.random() * tree.total)
+                if t37 < 37 and self.available[t37] > 0 and self.weighted[key][0][t37] > 0:
+                    return t37
+            # The float sums can drift after many updates, so rebuild the tree
+            # from scratch before giving up
+            del self.weighted[key]
+            tree = self._get_weighted_tree(key)
+        # All weights were 0: no tiles available based on the weights and
+        # given probability modifiers
+        raise NoValidTilesError()
+    
+    def take(self, t136, kind='wall'):
         t34 = t136 // 4
-        is_red_five = self.has_red_five and t34 in self.FIVES and t136 % 4 == 0
-        t37 = t34 if not is_red_five else self.FIVES[t34]
+        t37 = self.t136_to_t37(t136)
         if self.available[t37] == 0:
             raise NoValidTilesError()
-        self.available[t37] -= 1
+        self._own()
+        self._update(t37, -1)
         # remap the tile to the one we just pulled
-        t136 = t34 * 4 + (0 if is_red_five else (3 - self.available[t37]))
+        t136 = t34 * 4 + (0 if t37 >= 34 else (3 - self.available[t37]))
         return t136
 
     def replace(self, t136):
-        t34 = t136 // 4
-        is_red_five = self.has_red_five and t34 in self.FIVES and t136 % 4 == 0
-        t37 = t34 if not is_red_five else self.FIVES[t34]
-        self.available[t37] += 1
+        self._own()
+        self._update(self.t136_to_t37(t136), 1)
+
+class ShuffledWall(Wall):
+    # A physical wall. All 136 tiles are shuffled once per round, and every
+    # draw just moves a pointer. The last 14 tiles are the dead wall, laid out
+    # as 4 rinshan tiles followed by pairs of dora and ura dora indicators.
+    #
+    # Each round is shuffled from a round seed taken from the given rng, so a
+    # round can be reproduced with reset(round_seed). Drawing with prob_sets
+    # still works, it picks the tile by weight and swaps it into the position
+    # being drawn.
+    DEAD_WALL_SIZE = 14
+    RINSHAN_COUNT = 4
+    INDICATOR_COUNT = 5
+    # The part of the wall a drawn tile came from, stored in drawn as its
+    # index plus one
+    PARTS = ('wall', 'deadwall', 'dora', 'uradora')
+
+    def __init__(self, has_red_five=True, rng=None):
+        super().__init__(has_red_five)
+        self.seed_rng = rng if rng is not None else random.Random()
+        self.round_seed = None
+        self.tiles = []
+        self.positions = []
+        self.drawn = None
+        self.live_pos = 0
+        self.dead_pos = 0
+        self.next_pos = {}
+
+    def reset(self, round_seed=None):
+        super().reset()
+        if round_seed is None:
+            round_seed = self.seed_rng.getrandbits(64)
+        self.round_seed = round_seed
+        self.rng = random.Random(round_seed)
+        self.tiles = list(range(136))
+        self.rng.shuffle(self.tiles)
+        self.positions = [0]*136
+        for pos, t136 in enumerate(self.tiles):
+            self.positions[t136] = pos
+        self.drawn = bytearray(136)
+        self.live_pos = 0
+        self.dead_pos = 136 - self.DEAD_WALL_SIZE
+        # How many tiles have been drawn from each part of the dead wall
+        self.next_pos = {'deadwall': 0, 'dora': 0, 'uradora': 0}
+
+    def _rngs(self):
+        return (self.seed_rng, self.rng)
+
+    def _own(self):
+        if not self._shared:
+            return
+        super()._own()
+        self.tiles = self.tiles[:]
+        self.positions = self.positions[:]
+        self.drawn = bytearray(self.drawn)
+        self.next_pos = dict(self.next_pos)
+
+    def _part(self, kind):
+        return 'wall' if kind == 'hand' else kind
+
+    def _drawn_count(self, part):
+        return self.live_pos if part == 'wall' else self.next_pos[part]
+
+    def _position(self, part, n):
+        # Position of the nth tile drawn from this part of the wall
+        if part == 'wall':
+            return n
+        if part == 'deadwall':
+            return self.dead_pos + n
+        offset = 0 if part == 'dora' else 1
+        return self.dead_pos + self.RINSHAN_COUNT + n * 2 + offset
+
+    def _get_position(self, kind):
+        # Position of the next tile of this kind, without using it
+        part = self._part(kind)
+        n = self._drawn_count(part)
+        if part == 'wall':
+            limit = self.dead_pos
+        elif part == 'deadwall':
+            limit = self.RINSHAN_COUNT
+        else:
+            limit = self.INDICATOR_COUNT
+        if n >= limit:
+            raise NoValidTilesError()
+        return self._position(part, n)
+
+    def _advance(self, part, step=1):
+        if part == 'wall':
+            self.live_pos += step
+        else:
+            self.next_pos[part] += step
+
+    def _move_to(self, t136, pos):
+        # Swap an undrawn tile into the given position
+        other = self.tiles[pos]
+        old_pos = self.positions[t136]
+        self.tiles[pos], self.tiles[old_pos] = t136, other
+        self.positions[t136], self.positions[other] = pos, old_pos
+
+    def _find_undrawn(self, t37):
+        if t37 >= 34:
+            candidates = [self.FIVES_INV[t37] * 4]
+        else:
+            candidates = [t37 * 4 + i for i in range(4)]
+        for t136 in candidates:
+            if not self.drawn[t136] and self.t136_to_t37(t136) == t37:
+                return t136
+        raise NoValidTilesError()
+
+    def _use(self, t136, kind):
+        part = self._part(kind)
+        self._advance(part)
+        self.drawn[t136] = self.PARTS.index(part) + 1
+        self._update(self.t136_to_t37(t136), -1)
+        return t136
+
+    def draw(self, prob_sets, kind='wall'):
+        pos = self._get_position(kind)
+        self._own()
+        if not prob_sets:
+            return self._use(self.tiles[pos], kind)
+        
+        # Biased draw: pick the tile by weight among the undrawn tiles
+        t37 = self._draw_weighted(tuple(map(tuple, prob_sets)))
+        t136 = self._find_undrawn(t37)
+        self._move_to(t136, pos)
+        return self._use(t136, kind)
+
+    def take(self, t136, kind='wall'):
+        pos = self._get_position(kind)
+        t37 = self.t136_to_t37(t136)
+        if self.available[t37] == 0:
+            raise NoValidTilesError()
+        self._own()
+        t136 = self._find_undrawn(t37)
+        self._move_to(t136, pos)
+        return self._use(t136, kind)
+
+    def replace(self, t136):
+        # A tile goes back to the position it was drawn from. Only the last
+        # tile drawn from each part of the wall can be put back, so several
+        # draws have to be undone in reverse order.
+        if not self.drawn[t136]:
+            raise WallError("{} was not drawn".format(t136))
+        part = self.PARTS[self.drawn[t136] - 1]
+        n = self._drawn_count(part) - 1
+        if n < 0 or self.positions[t136] != self._position(part, n):
+            raise WallError("{} was not the last tile drawn from the {}".format(t136, part))
+        self._own()
+        self._advance(part, -1)
+        self.drawn[t136] = 0
+        self._update(self.t136_to_t37(t136), 1)
 
 def shanten_test(p, n=100):
     l = []
@@ -348,25 +1082,62 @@ def shanten_test(p, n=100):
 #  ask_draw
 
 class Wait(object):
+    __slots__ = ('tiles', 'has_yaku', 'is_furiten')
+
     def __init__(self, tiles34, has_yaku, is_furiten):
         self.tiles = tiles34
         self.has_yaku = has_yaku
         self.is_furiten = is_furiten
     def __repr__(self):
-        return "({})".format(self.__dict__)
+        return "({})".format(wire_fields(self))
+
+# Events, melds, discards, wins and waits use __slots__, since a game creates
+# thousands of them. The fields of a slotted class are its slots, base class
+# first, in the order they are listed.
+@functools.lru_cache(maxsize=None)
+def public_slots(cls):
+    names = []
+    for c in reversed(cls.__mro__):
+        names.extend(c.__dict__.get('__slots__', ()))
+    return tuple(n for n in names if not n.startswith('_'))
+
+_UNSET = object()
+
+def wire_fields(obj):
+    # Attributes starting with _ are internal and never sent, and slots that
+    # were never set are left out
+    if hasattr(obj, '__dict__'):
+        return {k: v for k, v in vars(obj).items() if not k.startswith('_')}
+    fields = {}
+    for k in public_slots(type(obj)):
+        v = getattr(obj, k, _UNSET)
+        if v is not _UNSET:
+            fields[k] = v
+    return fields
 
 class Event(object):
+    __slots__ = ('name',)
+
     def __init__(self, name):
         self.name = name
     
+    # Events may return a different event for some players, to hide
+    # information. The same object should be returned for every player that
+    # sees the same thing, so it only has to be encoded once.
     def get_for_player(self, player_idx):
         return self
     
+    def encode(self):
+        return json.dumps(wire_fields(self), default=wire_fields,
+                          separators=(',', ':')).encode()
+    
     def __repr__(self):
-        return "{}({})".format(self.name, self.__dict__)
+        return "{}({})".format(self.name, wire_fields(self))
 
 # A new game has started
 class NewGameEvent(Event):
+    __slots__ = ('player_names', 'points')
+
     def __init__(self, player_names, points):
         super().__init__('ev_new_game')
         self.player_names = list(player_names)
@@ -374,33 +1145,48 @@ class NewGameEvent(Event):
 
 # A new round has started
 class NewRoundEvent(Event):
+    __slots__ = ('wind', 'round', 'bonus', 'hands', 'hand', '_views')
+
     def __init__(self, wind, round, bonus, hands):
         super().__init__('ev_new_round')
         self.wind = wind
         self.round = round
         self.bonus = bonus
         self.hands = list(hands)
+        self._views = {}
     def get_for_player(self, player_idx):
-        nr = NewRoundEvent(self.wind, self.round, self.bonus, None)
-        nr.hand = self.hands[player_idx]
-        del nr.hands
-        return nr
+        if player_idx not in self._views:
+            nr = NewRoundEvent(self.wind, self.round, self.bonus, [])
+            nr.hand = self.hands[player_idx]
+            del nr.hands
+            self._views[player_idx] = nr
+        return self._views[player_idx]
 
 # A tile was drawn
 class TileEvent(Event):
+    __slots__ = ('tile', 'player', '_hidden')
+
     def __init__(self, t136, player):
         super().__init__('ev_tile')
         self.tile = t136
         self.player = player
+        self._hidden = None
     def __repr__(self):
+        if self.tile is None:
+            return "P{} draws a tile".format(self.player)
         return "P{} draws {}".format(self.player, Tile(self.tile))
     def get_for_player(self, player_idx):
         if self.player == player_idx:
             return self
-        return TileEvent(None, self.player)
+        # Everyone else sees the same hidden tile
+        if self._hidden is None:
+            self._hidden = TileEvent(None, self.player)
+        return self._hidden
 
 # A tile was discarded
 class DiscardEvent(Event):
+    __slots__ = ('tile', 'player', 'is_tsumogiri', 'is_riichi')
+
     def __init__(self, t136, player, is_tsumogiri, is_riichi=False):
         super().__init__('ev_discard')
         self.tile = t136
@@ -414,6 +1200,8 @@ class DiscardEvent(Event):
 
 # A call was made
 class CallEvent(Event):
+    __slots__ = ('meld', 'player')
+
     def __init__(self, meld, player):
         super().__init__('ev_call')
         self.meld = meld
@@ -423,18 +1211,24 @@ class CallEvent(Event):
 
 # Round was won
 class WinEvent(Event):
+    __slots__ = ('win',)
+
     def __init__(self, win):
         super().__init__('ev_win')
         self.win = win
 
 # The game is over
 class GameOverEvent(Event):
+    __slots__ = ('points',)
+
     def __init__(self, points):
         super().__init__('ev_game_over')
         self.points = points
 
 # New dora indicator
 class DoraEvent(Event):
+    __slots__ = ('tile',)
+
     def __init__(self, t136):
         super().__init__('ev_dora')
         self.tile = t136
@@ -446,7 +1240,8 @@ class DrawEvent(Event):
     RIICHI = "riichi"
     KAN = "kan"
     EXHAUSTIVE = "exhaustive"
-    
+    __slots__ = ('draw', 'hands', 'nagashi', 'points')
+
     def __init__(self, draw, ex_hands=None, ex_nagashi=None, ex_points=None):
         super().__init__('ev_draw')
         self.draw = draw
@@ -455,6 +1250,8 @@ class DrawEvent(Event):
         self.points = ex_points
 
 class FuritenEvent(Event):
+    __slots__ = ('is_furiten',)
+
     def __init__(self, is_furiten):
         super().__init__('ev_furiten')
         self.is_furiten = is_furiten
@@ -462,39 +1259,54 @@ class FuritenEvent(Event):
 
 
 class QueryEvent(Event):
+    __slots__ = ('optional',)
+
     def __init__(self, name, optional=True):
         super().__init__(name + "_query")
         self.optional = optional
 
 class DiscardQuery(QueryEvent):
+    __slots__ = ('allowed', 'waits')
+
     def __init__(self, allowed, waits):
         super().__init__('discard', False)
         self.allowed = allowed
         self.waits = waits
 
 class RiichiQuery(QueryEvent):
+    __slots__ = ('allowed', 'waits')
+
     def __init__(self, allowed, waits):
         super().__init__('riichi')
         self.allowed = allowed
         self.waits = waits
 
 class DrawQuery(QueryEvent):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__('draw')
 
 class TsumoQuery(QueryEvent):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__('tsumo')
 
 class RonQuery(QueryEvent):
-    def __init__(self, from_player):
+    # chankan is the tile added to a kan when robbing it, otherwise None
+    __slots__ = ('from_player', 'chankan')
+
+    def __init__(self, from_player, chankan=None):
         super().__init__('ron')
         self.from_player = from_player
+        self.chankan = chankan
 
 class CallQuery(QueryEvent):
     CHI = 'chi'
     PON = 'pon'
     KAN = 'kan'
+    __slots__ = ('kind', 'choices', 'from_who', 'discard_idx')
 
     def __init__(self, kind, choices, from_who, discard_idx):
         super().__init__('call')
@@ -503,7 +1315,65 @@ class CallQuery(QueryEvent):
         self.from_who = from_who
         self.discard_idx = discard_idx
 
+# Everything one player can see of a game in progress, so a client can pick
+# the game up again without the events that led there
+class ResumeEvent(Event):
+    __slots__ = ('wind', 'round', 'bonus', 'active_player', 'remaining_draws',
+                 'riichi_sticks', 'dora', 'player_names', 'points', 'is_riichi',
+                 'hand_sizes', 'discards', 'melds', 'seat', 'hand', 'queries')
+
+    def __init__(self, game, player_idx):
+        super().__init__('ev_resume')
+        self.wind = game.wind
+        self.round = game.round
+        self.bonus = game.bonus
+        self.active_player = game.active_player
+        self.remaining_draws = game.remaining_draws
+        self.riichi_sticks = game.riichi_sticks
+        self.dora = list(game.dora_indicators)
+        self.player_names = [p.name for p in game.players]
+        self.points = [p.points for p in game.players]
+        self.is_riichi = [p.is_riichi for p in game.players]
+        self.hand_sizes = [len(p.hand) for p in game.players]
+        self.discards = [list(p.discards) for p in game.players]
+        self.melds = [list(p.melds) for p in game.players]
+        self.seat = player_idx
+        self.hand = list(game.players[player_idx].hand)
+        self.queries = [ev for idx, ev in game.open_queries if idx == player_idx]
+
+class EventFanout(object):
+    # Turns a batch of (player idx, event) pairs into one JSON frame per
+    # player. Public events (player idx None) are shown to everyone, and
+    # every distinct event a player sees is encoded only once, so a public
+    # event is encoded once for the whole table.
+    def __init__(self, player_count=4):
+        self.player_count = player_count
+        self.encode_count = 0
+
+    def encode(self, events):
+        encoded = {}
+        parts = [[] for i in range(self.player_count)]
+        for idx, ev in events:
+            audience = range(self.player_count) if idx is None else [idx]
+            for player_idx in audience:
+                view = ev.get_for_player(player_idx)
+                # Views are kept alive by their event, so the id is stable
+                data = encoded.get(id(view))
+                if data is None:
+                    data = view.encode()
+                    encoded[id(view)] = data
+                    self.encode_count += 1
+                parts[player_idx].append(data)
+        return [b"[" + b",".join(p) + b"]" for p in parts]
+
+
 class Player(object):
+    # Ways to react to another player's discard, see get_reaction_index
+    REACT_CHI = 1
+    REACT_PON = 2
+    REACT_KAN = 4
+    REACT_RON = 8
+
     # todo: protoplayers for characters
     def __init__(self, game, name):
         self.game = game
@@ -511,10 +1381,14 @@ class Player(object):
         self.idx = -1
         self.points = 0
         
-        self.hand = []
+        self.hand = Hand()
+        self._hand_shared = False
+        self.discard_table = None
+        self.reaction_index = None
         self.discards = []
         self.melds = []
         self.ukeire = []
+        self.wait_mask = 0
         self.latest_draw = None
         self.shanten = 0
         self.is_riichi = False
@@ -526,10 +1400,14 @@ class Player(object):
         
     
     def reset_round(self):
-        self.hand = []
+        self.hand = Hand()
+        self._hand_shared = False
+        self.discard_table = None
+        self.reaction_index = None
         self.discards = []
         self.melds = []
         self.ukeire = []
+        self.wait_mask = 0
         self.latest_draw = None
         self.shanten = 0
         self.is_riichi = False
@@ -539,8 +1417,100 @@ class Player(object):
         self.has_pending_dora = False
         self.latest_draw_was_dead_wall = False
     
+    # All changes to the hand should go through these, so the discard table
+    # is dropped when the hand changes
+    def add_tile(self, t136):
+        self._own_hand()
+        self.hand.append(t136)
+        self.discard_table = None
+        self.reaction_index = None
+
+    def remove_tile(self, t136):
+        self._own_hand()
+        self.hand.remove(t136)
+        self.discard_table = None
+        self.reaction_index = None
+
+    def _own_hand(self):
+        # Copy the hand if it is shared with a snapshot
+        if self._hand_shared:
+            self.hand = self.hand.copy()
+            self._hand_shared = False
+
+    # The hand is shared with the snapshot until it changes. Discards and
+    # melds are only appended to, and the ones already in the lists are
+    # replaced instead of changed, so copying the lists is enough. The
+    # discard table and reaction index are never changed once built.
+    def snapshot(self):
+        self._hand_shared = True
+        state = dict(vars(self))
+        state['discards'] = tuple(self.discards)
+        state['melds'] = tuple(self.melds)
+        return state
+
+    def restore(self, state):
+        vars(self).update(state)
+        self.discards = list(self.discards)
+        self.melds = list(self.melds)
+
     def calculate_shanten_and_ukeire(self):
-        self.shanten, self.ukeire = get_shanten_and_ukeire(self.hand)
+        self.shanten, self.ukeire = self.hand.get_shanten_and_ukeire()
+        # Bit n is set if we are in tenpai and tile kind n completes the hand
+        self.wait_mask = 0
+        if self.shanten == 0:
+            for t34 in self.ukeire:
+                self.wait_mask |= 1 << t34
+        self.reaction_index = None
+
+    def is_waiting_on(self, t136):
+        return (self.wait_mask >> (t136 // 4)) & 1 == 1
+
+    def get_reaction_index(self):
+        # For every tile kind, the REACT_ flags for the ways we could react to
+        # another player discarding it. Calls only depend on the hand and ron
+        # on the wait mask, so the index is kept until one of them changes.
+        # Whether a call or ron is actually allowed is up to the game.
+        if self.reaction_index is not None:
+            return self.reaction_index
+
+        hand34 = self.hand.tiles34
+        index = [0]*34
+        for t34 in range(34):
+            reactions = 0
+            if hand34[t34] >= 2:
+                reactions |= self.REACT_PON
+                if hand34[t34] == 3:
+                    reactions |= self.REACT_KAN
+            if t34 < 27:
+                tidx = t34 % 9
+                if (tidx >= 2 and hand34[t34-2] and hand34[t34-1]) or \
+                   (tidx >= 1 and tidx <= 7 and hand34[t34-1] and hand34[t34+1]) or \
+                   (tidx <= 6 and hand34[t34+1] and hand34[t34+2]):
+                    reactions |= self.REACT_CHI
+            if (self.wait_mask >> t34) & 1:
+                reactions |= self.REACT_RON
+            index[t34] = reactions
+        self.reaction_index = index
+        return index
+
+    def get_discard_table(self):
+        # Map from tile kind to (shanten, ukeire, wait) after discarding that
+        # kind, with wait set if the discard leaves us in tenpai.
+        # This is shared by the discard and riichi queries, and is kept until
+        # the hand changes.
+        if self.discard_table is not None:
+            return self.discard_table
+        
+        table = {}
+        for t34, (shanten, ukeire) in self.hand.get_discard_table().items():
+            wait = None
+            if shanten == 0:
+                # TODO: has_yaku calculation
+                furi = self.is_furiten_for_waits(ukeire, [t34])
+                wait = Wait(ukeire, [True]*len(ukeire), furi)
+            table[t34] = (shanten, ukeire, wait)
+        self.discard_table = table
+        return table
 
     def check_win(self, win_tile=None, dora_inds=[], config=None):
         tiles = self.hand[:]
@@ -552,6 +1522,19 @@ class Player(object):
             # If no win tile is given, the latest tile is the win tile
             win_tile = tiles[-1]
         
+        # The same hand is often checked several times, e.g. when checking for
+        # ron and then doing the ron
+        key = (
+            canonical_tiles(tiles),
+            canonical_tile(win_tile),
+            tuple((m.kind, canonical_tiles(m.tiles)) for m in self.melds),
+            tuple(sorted(t // 4 for t in dora_inds)),
+            hand_config_key(config)
+        )
+        result = hand_value_cache.get(key)
+        if result is not None:
+            return copy_hand_response(result)
+        
         # Map from our melds to the mahjong lib melds
         melds = []
         for m in self.melds:
@@ -561,7 +1544,9 @@ class Player(object):
             melds.append(lm)
         
         hc = HandCalculator()
-        return hc.estimate_hand_value(tiles, win_tile, melds, dora_inds, config)
+        result = hc.estimate_hand_value(tiles, win_tile, melds, dora_inds, config)
+        hand_value_cache.put(key, result)
+        return copy_hand_response(result)
     
     def is_furiten_for_waits(self, t34waits, extra_discards34=[]):
         # We are furiten on these waits if any of them are in the discards
@@ -595,8 +1580,125 @@ class PreHandPlayer(Player):
     def populate_initial_hand(self):
         pre136 = tc.one_line_string_to_136_array(self.pre_hand, True)
         pre136 = map(lambda t136: self.game.wall.take(t136), pre136)
-        self.hand.extend(to_tiles(list(pre136)))
+        for t136 in to_tiles(list(pre136)):
+            self.add_tile(t136)
+
 
+class GameSnapshot(object):
+    __slots__ = ('state', 'players', 'wall')
+
+    def __init__(self, state, players, wall):
+        self.state = state
+        self.players = players
+        self.wall = wall
+
+class CallArbiter(object):
+    # Collects the answers to the call and ron queries on a discard, or to
+    # the ron queries on an added kan, and decides which go through. Ron beats
+    # kan and pon, which beat chi, and of two pon or kan the one closer after
+    # the discarding player wins. Every ron goes through.
+    # The outcome is decided as soon as nobody who still has to answer could
+    # change it, so the game doesn't wait for players who can only lose.
+    PASS = 0
+    CHI = 1
+    PON = 2
+    RON = 3
+    PRIORITY = {'call_chi': CHI, 'call_pon': PON, 'call_open_kan': PON, 'do_ron': RON}
+    CALL_METHODS = {CallQuery.CHI: 'call_chi', CallQuery.PON: 'call_pon',
+                    CallQuery.KAN: 'call_open_kan'}
+
+    def __init__(self, game):
+        self.game = game
+        # Answered for these queries only
+        self.open_queries = game.open_queries
+        self.from_player = None
+        # The robbed kan tile, taken from the queries and never from answers
+        self.chankan = None
+        # The query of each method a player can answer with
+        self.allowed = {}
+        for idx, query in game.open_queries:
+            if isinstance(query, RonQuery):
+                method = 'do_ron'
+                from_player = query.from_player
+                self.chankan = query.chankan
+            elif isinstance(query, CallQuery) and query.from_who is not None:
+                method = self.CALL_METHODS[query.kind]
+                from_player = query.from_who
+            else:
+                continue
+            self.allowed.setdefault(idx, {})[method] = query
+            self.from_player = from_player
+        # (priority, method, args) by player
+        self.answers = {}
+
+    def _order(self, idx):
+        return (idx - self.from_player) % 4
+
+    def _rank(self, idx, priority):
+        # Higher wins
+        return (priority, -self._order(idx))
+
+    def pending(self):
+        return [idx for idx in self.allowed if idx not in self.answers]
+
+    def answer(self, player_idx, method=None, *args):
+        # method None passes. Returns whether the outcome is decided.
+        if player_idx not in self.allowed or player_idx in self.answers:
+            raise InvalidActionError("P{} has no call to answer".format(player_idx))
+        if method is None:
+            priority = self.PASS
+        elif method not in self.allowed[player_idx]:
+            raise InvalidActionError("P{} can't answer with {}".format(player_idx, method))
+        else:
+            priority = self.PRIORITY[method]
+            query = self.allowed[player_idx][method]
+            if priority != self.RON and \
+               sorted(args[0]) not in [sorted(c) for c in query.choices]:
+                raise InvalidActionError("P{} can't call {}".format(
+                    player_idx, to_tiles(args[0])))
+        self.answers[player_idx] = (priority, method, args)
+        return self.is_decided()
+
+    def is_decided(self):
+        best = max((self._rank(idx, p) for idx, (p, m, a) in self.answers.items()),
+                   default=(self.PASS, 0))
+        for idx in self.pending():
+            possible = max(self.PRIORITY[m] for m in self.allowed[idx])
+            if best[0] == self.RON:
+                # Waiting for every ron
+                if possible == self.RON:
+                    return False
+            elif self._rank(idx, possible) > best:
+                return False
+        return True
+
+    def resolve(self):
+        # Makes the winning answers on the game, or moves on if all passed
+        answers = sorted(self.answers.items(), key=lambda a: self._rank(a[0], a[1][0]),
+                         reverse=True)
+        if not answers or answers[0][1][0] == self.PASS:
+            self.game.run_continuation()
+            return
+        idx, (priority, method, args) = answers[0]
+        if priority == self.RON:
+            rons = [i for i, (p, m, a) in answers if p == self.RON]
+            self.game.do_ron(rons, self.from_player, self.chankan)
+        else:
+            getattr(self.game, method)(args[0], idx, self.from_player)
+
+def game_action(fun):
+    # Marks the methods that act on the game. Queries that are open when an
+    # action starts are answered or void once it adds its first event.
+    @functools.wraps(fun)
+    def action(self, *args, **kwargs):
+        if self._action_depth == 0:
+            self._new_action = True
+        self._action_depth += 1
+        try:
+            return fun(self, *args, **kwargs)
+        finally:
+            self._action_depth -= 1
+    return action
 
 class InvalidActionError(Exception):
     def __init__(self, msg):
@@ -612,36 +1714,144 @@ class Game(object):
                  WEST: constants.WEST, NORTH: constants.NORTH}
     WIND_ORDER = [EAST, SOUTH, WEST, NORTH]
     
-    def __init__(self):
+    def __init__(self, wall=None, event_log=None):
         self.wind = self.EAST
         self.round = 1
         self.bonus = 0
         self.active_player = 0
         self.players = []
-        self.wall = Wall(has_red_five=True) # TODO game config
+        # Pass a ShuffledWall for a physical, seeded wall
+        self.wall = wall if wall is not None else Wall(has_red_five=True) # TODO game config
+        self.call_computer = CallComputer(self.wall.has_red_five)
         self.dora_indicators = []
         self.remaining_draws = 0
         self.riichi_sticks = 0
         
         self.continuation = None
         self.pending_events = []
+        # (player idx, query) for the queries that are waiting on an answer
+        self.open_queries = []
+        # Answers to the call queries so far, see answer_call
+        self.arbiter = None
+        self._new_action = False
+        self._action_depth = 0
+        # Optional eventlog.EventLog that gets a copy of every event
+        self.event_log = event_log
 
         self.preset_tiles = None
 
     def _add_event(self, ev, player=None):
         idx = player.idx if player else None
+        if self._new_action:
+            self._new_action = False
+            self.open_queries = []
+        if isinstance(ev, QueryEvent):
+            self.open_queries.append((idx, ev))
         self.pending_events.append((idx, ev))
+        if self.event_log is not None:
+            self.event_log.append(idx, ev)
+
+    # Snapshots are for rolling back the game, e.g. when searching over
+    # actions. Only small lists are copied, the hands and the wall are
+    # shared until they change. The event log is not rolled back.
+    def snapshot(self):
+        state = dict(vars(self))
+        state['dora_indicators'] = tuple(self.dora_indicators)
+        state['pending_events'] = tuple(self.pending_events)
+        state['open_queries'] = tuple(self.open_queries)
+        if self.preset_tiles is not None:
+            state['preset_tiles'] = tuple(self.preset_tiles)
+        return GameSnapshot(
+            state, [p.snapshot() for p in self.players], self.wall.snapshot())
+
+    def restore(self, snapshot):
+        # A snapshot can be restored any number of times
+        vars(self).update(snapshot.state)
+        self.dora_indicators = list(self.dora_indicators)
+        self.pending_events = list(self.pending_events)
+        self.open_queries = list(self.open_queries)
+        if self.preset_tiles is not None:
+            self.preset_tiles = list(self.preset_tiles)
+        for p, state in zip(self.players, snapshot.players):
+            p.restore(state)
+        self.wall.restore(snapshot.wall)
 
     def pop_events(self):
         evs = self.pending_events
         self.pending_events = []
         return evs
 
+    def pop_frames(self):
+        # Pending events as one ready to send JSON frame per player
+        return EventFanout(len(self.players)).encode(self.pop_events())
+
+    def get_resume_view(self, player_idx):
+        return ResumeEvent(self, player_idx)
+
+    @game_action
     def run_continuation(self):
         if self.continuation:
             self.continuation()
         self.continuation = None
 
+    @game_action
+    def auto_answer(self):
+        # Answers the open queries as if nobody acted in time. Optional
+        # queries are passed, and a discard is the drawn tile, or the last
+        # allowed one if the drawn tile can't be discarded. Calls that were
+        # already answered still count.
+        for idx, query in self.open_queries:
+            if isinstance(query, DiscardQuery):
+                player = self.players[idx]
+                t136 = player.latest_draw
+                if t136 not in query.allowed:
+                    t136 = query.allowed[-1]
+                self.discard_tile(idx, t136)
+                return
+        arbiter = self._get_arbiter()
+        if arbiter.allowed:
+            for idx in arbiter.pending():
+                arbiter.answer(idx)
+            self.arbiter = None
+            arbiter.resolve()
+        else:
+            self.run_continuation()
+
+    def has_answered(self, player_idx):
+        # Whether the player's answer to the open call queries is already in
+        arbiter = self.arbiter
+        return (arbiter is not None and arbiter.open_queries is self.open_queries and
+                player_idx in arbiter.answers)
+
+    def _get_arbiter(self):
+        # A new arbiter for every new set of queries
+        if self.arbiter is None or self.arbiter.open_queries is not self.open_queries:
+            self.arbiter = CallArbiter(self)
+        return self.arbiter
+
+    @game_action
+    def answer_call(self, player_idx, method=None, *args):
+        # Answers a call or ron query with call_chi, call_pon or
+        # call_open_kan and the tiles, or with do_ron, or passes if method is
+        # None. Once the arbiter can tell which answers win they are made,
+        # without waiting for the others.
+        arbiter = self._get_arbiter()
+        if arbiter.answer(player_idx, method, *args):
+            self.arbiter = None
+            arbiter.resolve()
+
+    @game_action
+    def answer_query(self, player_idx, query_name, method, *args):
+        # Makes a turn action with the method and its arguments, if the player
+        # has an open query of that name to answer. Queries on the player's
+        # own turn have no from_who, so a call_query here is a closed or
+        # added kan.
+        if not any(idx == player_idx and query.name == query_name and
+                   getattr(query, 'from_who', None) is None
+                   for idx, query in self.open_queries):
+            raise InvalidActionError("P{} has no {} to answer".format(player_idx, query_name))
+        getattr(self, method)(*args)
+
     def _wait_for_queries(self, cont):
         if self._has_pending_queries():
             self.continuation = cont
@@ -662,6 +1872,7 @@ class Game(object):
         wind_ordinal = {self.EAST: 0, self.SOUTH: 10, self.WEST: 20, self.NORTH: 30}
         return wind_ordinal[wind] + round
 
+    @game_action
     def start_game(self, players, shuffle_players=True):
         # Randomize players
         self.players = players
@@ -698,15 +1909,15 @@ class Game(object):
     def _draw_tile(self, kind='wall', player=None):
 
         # TODO player handling
-        assert kind in ['hand', 'wall', 'dora', 'deadwall']
+        assert kind in ['hand', 'wall', 'dora', 'uradora', 'deadwall']
         
         if kind in ['wall', 'deadwall']:
             # Drawing from the wall or dead wall counts as a drawn tile
             self.remaining_draws -= 1
 
         if self.preset_tiles and kind != 'hand':
-            return Tile(self.wall.take(self.preset_tiles.pop(0)))
-        return Tile(self.wall.draw([]))
+            return Tile(self.wall.take(self.preset_tiles.pop(0), kind))
+        return Tile(self.wall.draw([], kind))
     
     def _assign_initial_hands(self):
         # 1. Ask players if there's anything it wants to pull manually.
@@ -717,7 +1928,7 @@ class Game(object):
         
         for p in self.players:
             while len(p.hand) < 13:
-                p.hand.append(self._draw_tile('hand', p))
+                p.add_tile(self._draw_tile('hand', p))
         
             p.calculate_shanten_and_ukeire()
 
@@ -753,6 +1964,7 @@ class Game(object):
 
         return True
 
+    @game_action
     def start_round(self, round):
         if round == 'same':
             pass
@@ -827,7 +2039,7 @@ class Game(object):
         if sum(len(p.melds) for p in self.players):
             return
         # Hand must have at least 9 honors or terminals
-        t34 = tc.to_34_array(player.hand)
+        t34 = player.hand.tiles34
         term_hon = [bool(n) for i, n in enumerate(t34) if mutil.is_terminal(i) or mutil.is_honor(i)]
         
         if sum(term_hon) < 9:
@@ -912,12 +2124,12 @@ class Game(object):
         c.is_haitei = self.remaining_draws == 0
         # Tenhou if this is the dealer and the first draw (no discards)
         c.is_tenhou = player.idx == self.dealer() and len(player.discards) == 0 and \
-                      Agari().is_agari(tc.to_34_array(player.hand))
+                      Agari().is_agari(player.hand.tiles34)
         # Chiihou if this is not the dealer, the first draw and no other player
         # has made any calls
         c.is_chiihou = player.idx != self.dealer() and len(player.discards) == 0 and \
                        sum(map(lambda p: len(p.melds), self.players)) == 0 and \
-                       Agari().is_agari(tc.to_34_array(player.hand))
+                       Agari().is_agari(player.hand.tiles34)
         
         return player.check_win(None, self.dora_indicators, c)
     
@@ -951,14 +2163,23 @@ class Game(object):
         c.is_chankan = chankan is not None
         c.is_houtei = self.remaining_draws == 0 and chankan is None # Don't think this is possible
         
-        if chankan is None:
-            ron_tile136 = discarding_player.discards[-1].tile
-        else:
-            # TODO: We don't know which kan... Maybe not important
-            ron_tile136 = chankan
+        ron_tile136 = self._get_ron_tile(discarding_player, chankan)
         return calling_player.check_win(ron_tile136, self.dora_indicators, c)
     
+    def _get_ron_tile(self, discarding_player, chankan=None):
+        if chankan is None:
+            return discarding_player.discards[-1].tile
+        # TODO: We don't know which kan... Maybe not important
+        return chankan
+    
     def _check_for_ron(self, calling_player, discarding_player, chankan=None):
+        # Only evaluate the hand if the tile is one of our waits. The wait mask
+        # is kept up to date every time our hand settles after a discard or kan
+        if calling_player == discarding_player:
+            return False
+        if not calling_player.is_waiting_on(self._get_ron_tile(discarding_player, chankan)):
+            return False
+        
         result = self._get_ron(calling_player, discarding_player, chankan)
         no_ron_errors = [
             HandCalculator.ERR_HAND_NOT_WINNING,
@@ -979,9 +2200,8 @@ class Game(object):
         if calling_player.is_furiten():
             return False
         
-        # Possible ron.
-        # TODO: chankan?
-        self._add_event(RonQuery(discarding_player.idx), calling_player)
+        # Possible ron
+        self._add_event(RonQuery(discarding_player.idx, chankan), calling_player)
         return True
     
     def _check_for_closed_or_added_kan(self, player):
@@ -990,7 +2210,7 @@ class Game(object):
             return
 
         # We can closed kan a group if we have 4 of the tile
-        hand34 = tc.to_34_array(player.hand)
+        hand34 = player.hand.tiles34
         possible_kan = []
         for t34 in range(34):
             if hand34[t34] != 4:
@@ -1008,14 +2228,9 @@ class Game(object):
             if m.kind != Meld.PON:
                 continue
             pon_t34 = m.tiles[0]//4
-            call_t34 = None
-            for t136 in player.hand:
-                if pon_t34 == t136 // 4:
-                    call_t34 = t136 // 4
-                    break
-            if call_t34 is None:
+            if hand34[pon_t34] == 0:
                 continue
-            possible_kan.append(call_t34)
+            possible_kan.append(pon_t34)
         
         if len(possible_kan) == 0:
             return
@@ -1026,88 +2241,61 @@ class Game(object):
             choices.append([t136, t136+1, t136+2, t136+3])
         self._add_event(CallQuery(CallQuery.KAN, choices, None, None), player)
     
-    def _check_for_open_kan(self, calling_player, discarding_player):
-        # Can't call our own tiles
-        if calling_player == discarding_player:
-            return
-        
-        # Must be tiles remaining in the wall
-        if self.remaining_draws == 0:
-            return
-        
-        # Can't call if riichi
-        if calling_player.is_riichi:
-            return
+    def _scan_reactions(self, discarding_player, allow_calls, allow_kan):
+        # Find every call and ron the other players can make on the latest
+        # discard, in one pass. The shared conditions are checked once, and
+        # each player's reaction index rules out the kinds they can't react
+        # to without looking at their hand.
+        # Returns the players that were asked for ron.
+        discard_idx = len(discarding_player.discards) - 1
+        disc136 = discarding_player.discards[discard_idx].tile
+        disc34 = disc136 // 4
+        # Must be tiles remaining in the wall to call
+        allow_calls = allow_calls and self.remaining_draws > 0
+        chi_idx = (discarding_player.idx + 1) % 4
 
-        # Hand must have 3 of the tile
-        disc34 = discarding_player.discards[-1].tile // 4
-        t34hand = tc.to_34_array(calling_player.hand)
-        if t34hand[disc34] < 3:
-            return
-        
-        # Let the player kan
-        self._add_event(CallQuery(
-            CallQuery.KAN, [[disc34*4, disc34*4+1, disc34*4+2, disc34*4+3]],
-            discarding_player.idx, len(discarding_player.discards)-1), calling_player)
-    
-    def _check_for_pon(self, calling_player, discarding_player):
-        # Can't call our own tiles
-        if calling_player == discarding_player:
-            return
-        
-        # Must be tiles remaining in the wall
-        if self.remaining_draws == 0:
-            return
-        
-        # Can't call if riichi
-        if calling_player.is_riichi:
-            return
+        ron_players = []
+        for other_pl in self.players:
+            # Can't react to our own tiles
+            if other_pl is discarding_player:
+                continue
+            reactions = other_pl.get_reaction_index()[disc34]
+            if reactions == 0:
+                continue
 
-        disc136 = discarding_player.discards[-1].tile
-        cc = CallComputer() # TODO: has_red_five
-        possible136 = cc.get_pon_sets(disc136, calling_player.hand)
-        
-        # If the calling player has no available sets, they can't call
-        if len(possible136) == 0:
-            return
-        
-        # Add the discarded tile to every possibility
-        possible136 = [p + [disc136] for p in possible136]
-        
-        # Let the player pon
-        self._add_event(CallQuery(
-            CallQuery.PON, possible136,
-            discarding_player.idx, len(discarding_player.discards)-1),
-            calling_player)
-    
-    def _check_for_chi(self, calling_player, discarding_player):
-        # Can only call if next player
-        if (discarding_player.idx + 1) % 4 != calling_player.idx:
-            return
-        
-        # Must be tiles remaining in the wall
-        if self.remaining_draws == 0:
-            return
-        
-        # Can't call if riichi
-        if calling_player.is_riichi:
-            return
+            # Can't call if riichi
+            if allow_calls and not other_pl.is_riichi:
+                if allow_kan and reactions & Player.REACT_KAN:
+                    self._add_event(CallQuery(
+                        CallQuery.KAN, [[disc34*4, disc34*4+1, disc34*4+2, disc34*4+3]],
+                        discarding_player.idx, discard_idx), other_pl)
+
+                if reactions & Player.REACT_PON:
+                    self._add_call_query(
+                        CallQuery.PON, self.call_computer.get_pon_sets(disc136, other_pl.hand),
+                        other_pl, discarding_player, discard_idx)
+
+                # Only the next player can chi
+                if reactions & Player.REACT_CHI and other_pl.idx == chi_idx:
+                    self._add_call_query(
+                        CallQuery.CHI, self.call_computer.get_chi_sets(disc136, other_pl.hand),
+                        other_pl, discarding_player, discard_idx)
+
+            if reactions & Player.REACT_RON and self._check_for_ron(other_pl, discarding_player):
+                ron_players.append(other_pl.idx)
+        return ron_players
 
-        disc136 = discarding_player.discards[-1].tile
-        cc = CallComputer() # TODO: has_red_five
-        possible136 = cc.get_chi_sets(disc136, calling_player.hand)
-        
+    def _add_call_query(self, kind, possible136, calling_player, discarding_player, discard_idx):
         # If the calling player has no available sets, they can't call
         if len(possible136) == 0:
             return
-        
+
         # Add the discarded tile to every possibility
+        disc136 = discarding_player.discards[discard_idx].tile
         possible136 = [p + [disc136] for p in possible136]
-        
-        # Let the player chi
+
         self._add_event(CallQuery(
-            CallQuery.CHI, possible136,
-            discarding_player.idx, len(discarding_player.discards)-1),
+            kind, possible136, discarding_player.idx, discard_idx),
             calling_player)
     
     def _check_for_riichi(self, player):
@@ -1127,55 +2315,48 @@ class Game(object):
         if any(map(lambda m: m.kind != Meld.CKAN, player.melds)):
             return
         
-        # If the complete hand is 0-shanten (tenpai) we can riichi
-        shan = Shanten()
-        if shan.calculate_shanten(tc.to_34_array(player.hand)) > 0:
-            return
-        
         # Figure out what we can drop for riichi
-        # Anything that doesn't lower the shanten is droppable
+        # Anything that leaves us 0-shanten (tenpai) is droppable
+        table = player.get_discard_table()
         droppable = []
         waits = []
-        for i in range(len(player.hand)):
-            hand_without_t = player.hand[:i] + player.hand[i+1:]
-            shanten, ukeire = get_shanten_and_ukeire(hand_without_t)
+        for t136 in player.hand:
+            shanten, ukeire, wait = table[t136 // 4]
             if shanten != 0:
                 continue
 
-            droppable.append(player.hand[i])
-            furi = player.is_furiten_for_waits(ukeire, [player.hand[i] // 4])
-            waits.append(Wait(ukeire, [True]*len(ukeire), furi))
+            droppable.append(t136)
+            waits.append(wait)
+        
+        # If no discard leaves us in tenpai, we can't riichi
+        if len(droppable) == 0:
+            return
         
         self._add_event(RiichiQuery(droppable, waits), player)
     
     def _ask_for_discard(self, player, kuikae34=None):
+        table = player.get_discard_table()
         droppable = []
         waits = []
-        for i in range(len(player.hand)):
-            if player.is_riichi and player.latest_draw != player.hand[i]:
+        for t136 in player.hand:
+            if player.is_riichi and player.latest_draw != t136:
                 # If we're riichi we have to discard the drawn tile
                 # Does the below calculation work even in riichi?
                 continue
             
             # Check kuikae
-            if kuikae34 and player.hand[i] // 4 in kuikae34:
+            if kuikae34 and t136 // 4 in kuikae34:
                 continue
             
-            hand_without_t = player.hand[:i] + player.hand[i+1:]
-            shanten, ukeire = get_shanten_and_ukeire(hand_without_t)
+            # Dropping this would put us in tenpai if there is a wait
+            shanten, ukeire, wait = table[t136 // 4]
             
-            wait = None
-            if shanten == 0:
-                # Dropping this would put us in tenpai with some wait
-                # TODO: has_yaku calculation
-                furi = player.is_furiten_for_waits(ukeire, [player.hand[i] // 4])
-                wait = Wait(ukeire, [True]*len(ukeire), furi)
-            
-            droppable.append(player.hand[i])
+            droppable.append(t136)
             waits.append(wait)
         
         self._add_event(DiscardQuery(droppable, waits), player)
     
+    @game_action
     def draw_tile(self, player_idx, dead_wall=False):
         # Many things can happen when you draw a tile
         #  If this is our winning tile, we can tsumo
@@ -1191,7 +2372,7 @@ class Game(object):
         player = self.players[self.active_player]
         
         t136 = self._draw_tile('wall' if not dead_wall else 'deadwall', player)
-        player.hand.append(t136)
+        player.add_tile(t136)
         player.latest_draw = t136
         player.latest_draw_was_dead_wall = dead_wall
         self._add_event(TileEvent(t136, player_idx))
@@ -1215,6 +2396,7 @@ class Game(object):
         # We need to ask the user to discard a tile.
         self._ask_for_discard(player)
     
+    @game_action
     def discard_tile(self, player_idx, t136, riichi=False):
         player = self.players[player_idx]
         
@@ -1240,10 +2422,10 @@ class Game(object):
                     player.idx, player.melds))
             
             # Dropping this tile must keep us in tenpai
-            hand_without_t = player.hand[:]
-            hand_without_t.remove(t136)
-            shan, uke = get_shanten_and_ukeire(hand_without_t)
+            shan, uke, wait = player.get_discard_table()[t136 // 4]
             if shan != 0:
+                hand_without_t = player.hand[:]
+                hand_without_t.remove(t136)
                 raise InvalidActionError("P{} shanten is {}, can't riichi with {}".format(
                     player.idx, shan, hand_without_t))
         
@@ -1257,7 +2439,7 @@ class Game(object):
             riichi
         ))
         player.discards.append(Discard(t136, player.latest_draw == t136, riichi))
-        player.hand.remove(t136)
+        player.remove_tile(t136)
         if not player.is_riichi:
             player.is_temp_furiten = False
         player.is_ippatsu = False
@@ -1300,26 +2482,10 @@ class Game(object):
             self._add_event(DoraEvent(t136))
             player.has_pending_dora = False
         
-        ron_players = []
-        for other_pl in self.players:
-            if riichi_count < 4 and (sum(kan_count) < 4 or kans_same_player):
-                # Check kan
-                # Any but us
-                if sum(kan_count) < 4:
-                    self._check_for_open_kan(other_pl, player)
-                
-                # Check pon
-                # Any but us
-                self._check_for_pon(other_pl, player)
-                
-                # Check chi
-                # Only next player
-                self._check_for_chi(other_pl, player)
-            
-            # Check ron
-            # Any but us
-            if self._check_for_ron(other_pl, player):
-                ron_players.append(other_pl.idx)
+        ron_players = self._scan_reactions(
+            player,
+            riichi_count < 4 and (sum(kan_count) < 4 or kans_same_player),
+            sum(kan_count) < 4)
         
         def disc():
             # Riichi points and stick should have been modified here, but it is not
@@ -1349,6 +2515,7 @@ class Game(object):
             self.draw_tile((player_idx + 1) % 4)
         self._wait_for_queries(disc)
     
+    @game_action
     def call_pon(self, tiles136, calling_player_idx, discarding_player_idx):
         calling_player = self.players[calling_player_idx]
         discarding_player = self.players[discarding_player_idx]
@@ -1387,10 +2554,13 @@ class Game(object):
         tiles_from_hand = tiles136[:]
         tiles_from_hand.remove(discard.tile)
         for t in tiles_from_hand:
-            calling_player.hand.remove(t)
+            calling_player.remove_tile(t)
         
-        # Set the discard as called
+        # Set the discard as called. Discards are shared with snapshots, so
+        # a copy is changed instead
+        discard = discard.clone()
         discard.call_tile(calling_player.idx)
+        discarding_player.discards[-1] = discard
         
         # Add the meld and send the event
         meld = Meld(Meld.PON, tiles136, discarding_player.idx, discard.tile)
@@ -1405,6 +2575,7 @@ class Game(object):
         # Player must now discard a tile
         self._ask_for_discard(calling_player, [discard.tile // 4])
 
+    @game_action
     def call_chi(self, tiles136, calling_player_idx, discarding_player_idx):
         calling_player = self.players[calling_player_idx]
         discarding_player = self.players[discarding_player_idx]
@@ -1454,10 +2625,13 @@ class Game(object):
         tiles_from_hand = tiles136[:]
         tiles_from_hand.remove(discard.tile)
         for t in tiles_from_hand:
-            calling_player.hand.remove(t)
+            calling_player.remove_tile(t)
         
-        # Set the discard as called
+        # Set the discard as called. Discards are shared with snapshots, so
+        # a copy is changed instead
+        discard = discard.clone()
         discard.call_tile(calling_player.idx)
+        discarding_player.discards[-1] = discard
         
         # Add the meld and send the event
         meld = Meld(Meld.CHI, tiles136, discarding_player.idx, discard.tile)
@@ -1487,6 +2661,7 @@ class Game(object):
         # Player must now discard a tile
         self._ask_for_discard(calling_player, kuikae)
 
+    @game_action
     def call_closed_or_added_kan(self, tiles136, player_idx):
         player = self.players[player_idx]
         
@@ -1509,7 +2684,7 @@ class Game(object):
         if all(t in player.hand for t in tiles136):
             closed = True
         elif any(meld.kind == Meld.PON and meld.tiles[0]//4 == tiles136[0]//4 for meld in player.melds) and \
-             any(t//4 == tiles136[0]//4 for t in player.hand):
+             player.hand.tiles34[tiles136[0]//4] > 0:
             closed = False
         else:
             raise InvalidActionError("P{} can't ckan or akan {}".format(
@@ -1518,7 +2693,7 @@ class Game(object):
         ron_players = []
         if closed:
             for t in tiles136:
-                player.hand.remove(t)
+                player.remove_tile(t)
             meld = Meld(Meld.CKAN, tiles136)
             player.melds.append(meld)
             self._add_event(CallEvent(meld.clone(), player.idx))
@@ -1528,14 +2703,16 @@ class Game(object):
             added_tile = None
             for t in tiles136:
                 if t in player.hand:
-                    player.hand.remove(t)
+                    player.remove_tile(t)
                     added_tile = t
-            meld = None
-            for m in player.melds:
+            meld_idx = None
+            for i, m in enumerate(player.melds):
                 if m.tiles[0]//4 == tiles136[0]//4:
-                    meld = m
-                    continue
+                    meld_idx = i
+            # Melds are shared with snapshots, so promote a copy
+            meld = player.melds[meld_idx].clone()
             meld.promote_to_akan(t)
+            player.melds[meld_idx] = meld
             self._add_event(CallEvent(meld.clone(), player.idx))
             
             # Check for chankan.
@@ -1572,6 +2749,7 @@ class Game(object):
 
         self._wait_for_queries(kan1)
 
+    @game_action
     def call_open_kan(self, tiles136, calling_player_idx, discarding_player_idx):
         calling_player = self.players[calling_player_idx]
         discarding_player = self.players[discarding_player_idx]
@@ -1610,10 +2788,13 @@ class Game(object):
         tiles_from_hand = tiles136[:]
         tiles_from_hand.remove(discard.tile)
         for t in tiles_from_hand:
-            calling_player.hand.remove(t)
+            calling_player.remove_tile(t)
         
-        # Set the discard as called
+        # Set the discard as called. Discards are shared with snapshots, so
+        # a copy is changed instead
+        discard = discard.clone()
         discard.call_tile(calling_player.idx)
+        discarding_player.discards[-1] = discard
         
         # Add the meld and send the event
         meld = Meld(Meld.MKAN, tiles136, discarding_player.idx, discard.tile)
@@ -1635,6 +2816,7 @@ class Game(object):
         
         self._wait_for_queries(kan1)
 
+    @game_action
     def do_9tile_draw(self, player_idx):
         player = self.players[player_idx]
         
@@ -1649,7 +2831,7 @@ class Game(object):
                 player.idx))
 
         # Hand must have at least 9 honors or terminals
-        t34 = tc.to_34_array(player.hand)
+        t34 = player.hand.tiles34
         term_hon = [bool(n) for i, n in enumerate(t34) if mutil.is_terminal(i) or mutil.is_honor(i)]
         
         if sum(term_hon) < 9:
@@ -1660,6 +2842,7 @@ class Game(object):
         self._add_event(DrawEvent(DrawEvent.TERMINAL))
         self.start_round('bonus')
 
+    @game_action
     def do_tsumo(self, player_idx):
         player = self.players[player_idx]
         
@@ -1679,7 +2862,7 @@ class Game(object):
             # TODO: Technically, we could have alternate logic for ura dora, since non-winning
             # players aren't getting any dora. But it's complicated for ron...
             for i in range(len(dora_ind)):
-                ura_dora_ind.append(self._draw_tile('dora'))
+                ura_dora_ind.append(self._draw_tile('uradora'))
             self.dora_indicators.extend(ura_dora_ind)
             result = self._get_tsumo(player, player.latest_draw_was_dead_wall)
         
@@ -1743,6 +2926,7 @@ class Game(object):
         else:
             self.start_round('next')
 
+    @game_action
     def do_ron(self, calling_player_idxs, discarding_player_idx, chankan136=None):
 
         discarding_player = self.players[discarding_player_idx]
@@ -1754,7 +2938,7 @@ class Game(object):
 
         # If this is chankan, the chankan tile must be in the discarder's melds
         if (chankan136 is not None and
-            not any(m.is_kan() and m.tiles[0]//34 == chankan136//4 for m in discarding_player.melds)):
+            not any(m.is_kan() and m.tiles[0]//4 == chankan136//4 for m in discarding_player.melds)):
             raise InvalidActionError("P{} has no {} kan in {}".format(
                     discarding_player_idx, Tile(chankan136), discarding_player.melds))
 
@@ -1791,7 +2975,7 @@ class Game(object):
         dora_ind = self.dora_indicators[:]
         ura_dora_ind = []
         for i in range(len(dora_ind)):
-            ura_dora_ind.append(self._draw_tile('dora'))
+            ura_dora_ind.append(self._draw_tile('uradora'))
 
         for calling_player_idx in calling_player_idxs:
             calling_player = self.players[calling_player_idx]
@@ -1896,7 +3080,58 @@ class Game(object):
             print("=========================================")
 
 
-class Lobby(object):
+class LobbyError(Exception):
     pass
 
 
+class Lobby(object):
+    # The rooms and players of a server. Room codes are handed out from a
+    # shuffled list of the free ones, and a released code is swapped to a
+    # random place in it, so both are O(1) no matter how many rooms are open.
+    # Rooms are anything with a code, players anything with a sid.
+    def __init__(self, codes=range(10000, 100000), rng=None):
+        self.rng = rng if rng is not None else random.Random()
+        self.free_codes = list(codes)
+        self.rng.shuffle(self.free_codes)
+        # Room by code
+        self.rooms = {}
+        # Player by sid
+        self.players = {}
+
+    def allocate_code(self):
+        if not self.free_codes:
+            raise LobbyError("No free room codes")
+        return str(self.free_codes.pop())
+
+    def release_code(self, code):
+        free = self.free_codes
+        free.append(int(code))
+        i = self.rng.randrange(len(free))
+        free[i], free[-1] = free[-1], free[i]
+
+    def open_room(self, make_room):
+        # make_room is called with the new code and returns the room
+        code = self.allocate_code()
+        room = make_room(code)
+        self.rooms[code] = room
+        return room
+
+    def close_room(self, code):
+        del self.rooms[code]
+        self.release_code(code)
+
+    def get_room(self, code):
+        return self.rooms.get(code)
+
+    def add_player(self, player):
+        if player.sid in self.players:
+            raise LobbyError("Player {} is already in a room".format(player.sid))
+        self.players[player.sid] = player
+
+    def remove_player(self, sid):
+        return self.players.pop(sid, None)
+
+    def get_player(self, sid):
+        return self.players.get(sid)
+
+
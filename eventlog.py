@@ -0,0 +1,373 @@
+import abc
+import struct
+
+from engine import (Meld, Win, Wait, DrawEvent, CallQuery, NewGameEvent,
+                    NewRoundEvent, TileEvent, DiscardEvent, CallEvent, WinEvent,
+                    GameOverEvent, DoraEvent, FuritenEvent, DiscardQuery,
+                    RiichiQuery, DrawQuery, TsumoQuery, RonQuery)
+from tile import Tile, Tile34
+
+# Compact binary log of (player idx, event) pairs, as kept in
+# Game.pending_events.
+#
+# A log starts with MAGIC and VERSION, followed by one record per event:
+#   player idx (1 byte, NONE for public events)
+#   event tag (1 byte, see EVENT_TYPES)
+#   the fields of the event, in the order listed in EVENT_TYPES
+#
+# Tiles are single bytes, lists are prefixed with a 1 byte length, and values
+# that may be None are either a reserved byte (tiles, small ints) or are
+# prefixed with a flag byte. Strings that can only take a few values are
+# stored as an index into a fixed list.
+
+MAGIC = b"TLOG"
+VERSION = 2
+NONE = 0xff
+
+class EventLogError(Exception):
+    pass
+
+
+# Codecs write a value to a bytearray, and read one from bytes at an offset,
+# returning the value and the offset after it.
+class Codec(abc.ABC):
+    @abc.abstractmethod
+    def write(self, buf, value):
+        pass
+
+    @abc.abstractmethod
+    def read(self, data, pos):
+        pass
+
+class Struct(Codec):
+    def __init__(self, fmt):
+        self.struct = struct.Struct("<" + fmt)
+
+    def write(self, buf, value):
+        buf += self.struct.pack(value)
+
+    def read(self, data, pos):
+        return self.struct.unpack_from(data, pos)[0], pos + self.struct.size
+
+class Byte(Codec):
+    # Tiles, seats and other small ints, with NONE for None
+    def __init__(self, wrap=int):
+        self.wrap = wrap
+
+    def write(self, buf, value):
+        buf.append(NONE if value is None else value)
+
+    def read(self, data, pos):
+        value = data[pos]
+        return None if value == NONE else self.wrap(value), pos + 1
+
+class Bytes(Codec):
+    # A list of tiles or other small ints
+    def __init__(self, wrap=int):
+        self.wrap = wrap
+
+    def write(self, buf, values):
+        buf.append(len(values))
+        buf += bytes(values)
+
+    def read(self, data, pos):
+        n = data[pos]
+        pos += 1
+        return [self.wrap(v) for v in data[pos:pos+n]], pos + n
+
+class Bool(Codec):
+    def write(self, buf, value):
+        buf.append(1 if value else 0)
+
+    def read(self, data, pos):
+        return data[pos] == 1, pos + 1
+
+class Str(Codec):
+    def write(self, buf, value):
+        raw = value.encode()
+        buf.append(len(raw))
+        buf += raw
+
+    def read(self, data, pos):
+        n = data[pos]
+        pos += 1
+        return bytes(data[pos:pos+n]).decode(), pos + n
+
+class Enum(Codec):
+    def __init__(self, values):
+        self.values = list(values)
+        self.index = {v: i for i, v in enumerate(self.values)}
+
+    def write(self, buf, value):
+        buf.append(self.index[value])
+
+    def read(self, data, pos):
+        return self.values[data[pos]], pos + 1
+
+class Optional(Codec):
+    def __init__(self, codec):
+        self.codec = codec
+
+    def write(self, buf, value):
+        if value is None:
+            buf.append(0)
+        else:
+            buf.append(1)
+            self.codec.write(buf, value)
+
+    def read(self, data, pos):
+        if data[pos] == 0:
+            return None, pos + 1
+        return self.codec.read(data, pos + 1)
+
+class List(Codec):
+    def __init__(self, codec):
+        self.codec = codec
+
+    def write(self, buf, values):
+        buf.append(len(values))
+        for v in values:
+            self.codec.write(buf, v)
+
+    def read(self, data, pos):
+        n = data[pos]
+        pos += 1
+        values = []
+        for i in range(n):
+            v, pos = self.codec.read(data, pos)
+            values.append(v)
+        return values, pos
+
+class Tuple(Codec):
+    def __init__(self, *codecs):
+        self.codecs = codecs
+
+    def write(self, buf, values):
+        for codec, v in zip(self.codecs, values):
+            codec.write(buf, v)
+
+    def read(self, data, pos):
+        values = []
+        for codec in self.codecs:
+            v, pos = codec.read(data, pos)
+            values.append(v)
+        return tuple(values), pos
+
+class Fields(Codec):
+    # Objects are rebuilt without calling __init__, by setting each field.
+    # Constants are shared by every object read, fresh holds a factory for
+    # each value that every object needs its own of.
+    def __init__(self, cls, fields, fresh=None, **constants):
+        self.cls = cls
+        self.fields = fields
+        self.fresh = fresh or {}
+        self.constants = constants
+
+    def write(self, buf, obj):
+        for name, codec in self.fields:
+            codec.write(buf, getattr(obj, name))
+
+    def read(self, data, pos):
+        obj = self.cls.__new__(self.cls)
+        for name, value in self.constants.items():
+            setattr(obj, name, value)
+        for name, make in self.fresh.items():
+            setattr(obj, name, make())
+        for name, codec in self.fields:
+            value, pos = codec.read(data, pos)
+            setattr(obj, name, value)
+        return obj, pos
+
+
+TILE = Byte(Tile)
+TILES = Bytes(Tile)
+SEAT = Byte()
+U16 = Struct("H")
+I32 = Struct("i")
+BOOL = Bool()
+STR = Str()
+
+WAIT = Fields(Wait, [
+    ('tiles', Bytes(Tile34)),
+    ('has_yaku', List(BOOL)),
+    ('is_furiten', BOOL)
+])
+
+MELD = Fields(Meld, [
+    ('kind', Enum([Meld.CHI, Meld.PON, Meld.CKAN, Meld.MKAN, Meld.AKAN])),
+    ('tiles', TILES),
+    ('called_from', SEAT),
+    ('called_tile', TILE)
+])
+
+WIN = Fields(Win, [
+    ('player_idx', SEAT),
+    ('hand', TILES),
+    ('win_tile', TILE),
+    ('melds', List(TILES)),
+    ('dora_ind', TILES),
+    ('ura_dora_ind', TILES),
+    ('han', U16),
+    ('fu', U16),
+    ('yaku', List(Tuple(STR, U16))),
+    ('level', Optional(STR)),
+    ('total', I32),
+    ('points', List(I32))
+])
+
+WAITS = List(Optional(WAIT))
+
+# The tag of an event type is its index in this list. New types must only
+# ever be added at the end, or old logs can't be read.
+EVENT_TYPES = [
+    (NewGameEvent, 'ev_new_game', [
+        ('player_names', List(STR)),
+        ('points', List(I32))
+    ]),
+    (NewRoundEvent, 'ev_new_round', [
+        ('wind', STR),
+        ('round', SEAT),
+        ('bonus', U16),
+        ('hands', List(TILES))
+    ]),
+    (TileEvent, 'ev_tile', [
+        ('tile', TILE),
+        ('player', SEAT)
+    ]),
+    (DiscardEvent, 'ev_discard', [
+        ('tile', TILE),
+        ('player', SEAT),
+        ('is_tsumogiri', BOOL),
+        ('is_riichi', BOOL)
+    ]),
+    (CallEvent, 'ev_call', [
+        ('meld', MELD),
+        ('player', SEAT)
+    ]),
+    (WinEvent, 'ev_win', [
+        ('win', WIN)
+    ]),
+    (GameOverEvent, 'ev_game_over', [
+        ('points', List(I32))
+    ]),
+    (DoraEvent, 'ev_dora', [
+        ('tile', TILE)
+    ]),
+    (DrawEvent, 'ev_draw', [
+        ('draw', Enum([DrawEvent.WIND, DrawEvent.TERMINAL, DrawEvent.RIICHI,
+                       DrawEvent.KAN, DrawEvent.EXHAUSTIVE])),
+        ('hands', Optional(List(Optional(TILES)))),
+        ('nagashi', Optional(List(BOOL))),
+        ('points', Optional(List(I32)))
+    ]),
+    (FuritenEvent, 'ev_furiten', [
+        ('is_furiten', BOOL)
+    ]),
+    (DiscardQuery, 'discard_query', [
+        ('optional', BOOL),
+        ('allowed', TILES),
+        ('waits', WAITS)
+    ]),
+    (RiichiQuery, 'riichi_query', [
+        ('optional', BOOL),
+        ('allowed', TILES),
+        ('waits', WAITS)
+    ]),
+    (DrawQuery, 'draw_query', [
+        ('optional', BOOL)
+    ]),
+    (TsumoQuery, 'tsumo_query', [
+        ('optional', BOOL)
+    ]),
+    (RonQuery, 'ron_query', [
+        ('optional', BOOL),
+        ('from_player', SEAT),
+        ('chankan', TILE)
+    ]),
+    (CallQuery, 'call_query', [
+        ('optional', BOOL),
+        ('kind', Enum([CallQuery.CHI, CallQuery.PON, CallQuery.KAN])),
+        ('choices', List(TILES)),
+        ('from_who', SEAT),
+        ('discard_idx', SEAT)
+    ]),
+]
+
+# Caches of the player views, set empty on every decoded event of a type
+def _fresh(cls):
+    if cls is NewRoundEvent:
+        return {'_views': dict}
+    if cls is TileEvent:
+        return {'_hidden': lambda: None}
+    return {}
+
+EVENT_CODECS = [Fields(cls, fields, _fresh(cls), name=name)
+                for cls, name, fields in EVENT_TYPES]
+EVENT_TAGS = {cls: tag for tag, (cls, name, fields) in enumerate(EVENT_TYPES)}
+
+
+def write_event(buf, player_idx, ev):
+    tag = EVENT_TAGS.get(type(ev))
+    if tag is None:
+        raise EventLogError("Can't log {}".format(type(ev).__name__))
+    buf.append(NONE if player_idx is None else player_idx)
+    buf.append(tag)
+    EVENT_CODECS[tag].write(buf, ev)
+
+def read_event(data, pos):
+    player_idx = data[pos]
+    tag = data[pos + 1]
+    if tag >= len(EVENT_CODECS):
+        raise EventLogError("Unknown event tag {} at {}".format(tag, pos + 1))
+    ev, pos = EVENT_CODECS[tag].read(data, pos + 2)
+    return (None if player_idx == NONE else player_idx, ev), pos
+
+def encode_events(events):
+    buf = bytearray(MAGIC)
+    buf.append(VERSION)
+    for player_idx, ev in events:
+        write_event(buf, player_idx, ev)
+    return bytes(buf)
+
+def decode_events(data):
+    return list(iter_events(data))
+
+def iter_events(data):
+    if data[:len(MAGIC)] != MAGIC:
+        raise EventLogError("Not an event log")
+    if data[len(MAGIC)] != VERSION:
+        raise EventLogError("Unsupported event log version {}".format(data[len(MAGIC)]))
+    pos = len(MAGIC) + 1
+    while pos < len(data):
+        try:
+            event, pos = read_event(data, pos)
+        except (IndexError, struct.error):
+            raise EventLogError("Truncated event log")
+        yield event
+
+
+class EventLog(object):
+    # An append-only binary log of a game's events. Pass one to Game to keep
+    # the whole event history at a few bytes per event, instead of the
+    # event objects.
+    def __init__(self):
+        self.data = bytearray(MAGIC)
+        self.data.append(VERSION)
+        self.count = 0
+
+    def append(self, player_idx, ev):
+        write_event(self.data, player_idx, ev)
+        self.count += 1
+
+    def extend(self, events):
+        for player_idx, ev in events:
+            self.append(player_idx, ev)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter_events(self.data)
+
+    def to_bytes(self):
+        return bytes(self.data)
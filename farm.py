@@ -0,0 +1,76 @@
+import argparse
+import multiprocessing
+import os
+import random
+import time
+
+from sim import Simulator, SimStats, SimReport, POLICIES, make_policies
+
+
+def shard_seed(seed, shard_idx):
+    # Seeding with a string is stable across processes and runs, so every
+    # shard plays the same games no matter which worker picks it up
+    return random.Random("{}-{}".format(seed, shard_idx)).getrandbits(64)
+
+def run_shard(args):
+    # Runs in a worker process. Only the aggregated records are sent back,
+    # never any events. Games that do not end are counted as aborted by the
+    # simulator, so one stuck game does not lose the rest of the run.
+    shard_idx, seed, n_games, policy, max_rounds = args
+    stats = SimStats()
+    seed = shard_seed(seed, shard_idx)
+    sim = Simulator(make_policies(policy, seed), seed, max_rounds, stats=stats)
+    sim.run(n_games)
+    return stats.to_record(), sim.report.to_record()
+
+
+class Farm(object):
+    # Shards a simulation over a pool of worker processes and merges the
+    # results as the shards finish.
+    def __init__(self, workers=None, seed=0, policy='efficiency', shard_size=4,
+                 max_rounds=100):
+        self.workers = workers or os.cpu_count()
+        self.seed = seed
+        self.policy = policy
+        self.shard_size = shard_size
+        self.max_rounds = max_rounds
+
+    def _shards(self, n_games):
+        shard_idx = 0
+        while n_games > 0:
+            n = min(n_games, self.shard_size)
+            yield (shard_idx, self.seed, n, self.policy, self.max_rounds)
+            shard_idx += 1
+            n_games -= n
+
+    def run(self, n_games, progress=None):
+        stats = SimStats()
+        report = SimReport()
+        start = time.perf_counter()
+        with multiprocessing.Pool(self.workers) as pool:
+            for stats_record, report_record in pool.imap_unordered(run_shard, self._shards(n_games)):
+                stats.merge(stats_record)
+                report.merge(report_record)
+                if progress is not None:
+                    progress(stats)
+        report.elapsed = time.perf_counter() - start
+        return stats, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel headless self-play")
+    parser.add_argument("-n", "--games", type=int, default=100)
+    parser.add_argument("-w", "--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shard-size", type=int, default=4)
+    parser.add_argument("--policy", choices=sorted(POLICIES), default='efficiency')
+    parser.add_argument("--max-rounds", type=int, default=100)
+    args = parser.parse_args()
+
+    farm = Farm(args.workers, args.seed, args.policy, args.shard_size, args.max_rounds)
+    stats, report = farm.run(args.games)
+    print(report)
+    print(stats)
+
+if __name__ == "__main__":
+    main()
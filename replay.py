@@ -0,0 +1,249 @@
+import argparse
+import random
+import struct
+
+from engine import Game, Player, ShuffledWall, NewRoundEvent
+from eventlog import Bytes, List, STR, SEAT, TILE, TILES, BOOL, U16
+
+
+# Games are recorded as the seed of their ShuffledWall, the player names and
+# the list of actions taken. Since the game is deterministic given the seed,
+# running the actions again rebuilds any point of the game exactly.
+
+# The tag of an action is its index in this list, new actions must only be
+# added at the end
+ACTIONS = [
+    ('run_continuation', []),
+    ('discard_tile', [SEAT, TILE, BOOL]),
+    ('call_pon', [TILES, SEAT, SEAT]),
+    ('call_chi', [TILES, SEAT, SEAT]),
+    ('call_open_kan', [TILES, SEAT, SEAT]),
+    ('call_closed_or_added_kan', [TILES, SEAT]),
+    ('do_ron', [Bytes(), SEAT, TILE]),
+    ('do_tsumo', [SEAT]),
+    ('do_9tile_draw', [SEAT]),
+]
+ACTION_TAGS = {name: tag for tag, (name, codecs) in enumerate(ACTIONS)}
+
+MAGIC = b"TREC"
+VERSION = 1
+COUNT = struct.Struct("<I")
+SEED = struct.Struct("<Q")
+ROUND = [STR, SEAT, U16]
+
+class ReplayError(Exception):
+    pass
+
+
+class GameRecord(object):
+    def __init__(self, seed, player_names, actions=None, rounds=None):
+        self.seed = seed
+        self.player_names = list(player_names)
+        # (action name, args)
+        self.actions = actions if actions is not None else []
+        # (wind, round, bonus, position) for every round, where position is
+        # the number of actions after which the round has started
+        self.rounds = rounds if rounds is not None else []
+
+    def encode(self):
+        buf = bytearray(MAGIC)
+        buf.append(VERSION)
+        buf += SEED.pack(self.seed)
+        List(STR).write(buf, self.player_names)
+        buf += COUNT.pack(len(self.rounds))
+        for wind, round, bonus, pos in self.rounds:
+            for codec, value in zip(ROUND, (wind, round, bonus)):
+                codec.write(buf, value)
+            buf += COUNT.pack(pos)
+        buf += COUNT.pack(len(self.actions))
+        for name, args in self.actions:
+            tag = ACTION_TAGS[name]
+            buf.append(tag)
+            for codec, value in zip(ACTIONS[tag][1], args):
+                codec.write(buf, value)
+        return bytes(buf)
+
+    @staticmethod
+    def decode(data):
+        if data[:len(MAGIC)] != MAGIC or data[len(MAGIC)] != VERSION:
+            raise ReplayError("Not a game record")
+        pos = len(MAGIC) + 1
+        try:
+            seed = SEED.unpack_from(data, pos)[0]
+            pos += SEED.size
+            player_names, pos = List(STR).read(data, pos)
+            rounds = []
+            n = COUNT.unpack_from(data, pos)[0]
+            pos += COUNT.size
+            for i in range(n):
+                values = []
+                for codec in ROUND:
+                    value, pos = codec.read(data, pos)
+                    values.append(value)
+                values.append(COUNT.unpack_from(data, pos)[0])
+                pos += COUNT.size
+                rounds.append(tuple(values))
+            actions = []
+            n = COUNT.unpack_from(data, pos)[0]
+            pos += COUNT.size
+            for i in range(n):
+                name, codecs = ACTIONS[data[pos]]
+                pos += 1
+                args = []
+                for codec in codecs:
+                    value, pos = codec.read(data, pos)
+                    args.append(value)
+                actions.append((name, tuple(args)))
+        except (IndexError, struct.error):
+            raise ReplayError("Truncated game record")
+        return GameRecord(seed, player_names, actions, rounds)
+
+
+class RecordingGame(Game):
+    # A game on a ShuffledWall seeded with the given seed, that records every
+    # action that succeeds. Actions that raise are not recorded.
+    def __init__(self, seed, event_log=None):
+        super().__init__(ShuffledWall(rng=random.Random(seed)), event_log)
+        self.record = GameRecord(seed, [])
+        self.started = False
+
+    def start_game(self, players, shuffle_players=True):
+        super().start_game(players, shuffle_players)
+        # After shuffling, so the replay can seat everyone in the same order
+        self.record.player_names = [p.name for p in self.players]
+        self.started = True
+
+    def _add_event(self, ev, player=None):
+        super()._add_event(ev, player)
+        if isinstance(ev, NewRoundEvent):
+            # A round starts during an action, which is recorded once it
+            # returns. The first round starts before any action.
+            pos = len(self.record.actions) + (1 if self.started else 0)
+            self.record.rounds.append((ev.wind, ev.round, ev.bonus, pos))
+
+    def _record(self, name, *args):
+        self.record.actions.append((name, args))
+
+    def run_continuation(self):
+        super().run_continuation()
+        self._record('run_continuation')
+
+    def discard_tile(self, player_idx, t136, riichi=False):
+        super().discard_tile(player_idx, t136, riichi)
+        self._record('discard_tile', player_idx, t136, riichi)
+
+    def call_pon(self, tiles136, calling_player_idx, discarding_player_idx):
+        super().call_pon(tiles136, calling_player_idx, discarding_player_idx)
+        self._record('call_pon', tiles136, calling_player_idx, discarding_player_idx)
+
+    def call_chi(self, tiles136, calling_player_idx, discarding_player_idx):
+        super().call_chi(tiles136, calling_player_idx, discarding_player_idx)
+        self._record('call_chi', tiles136, calling_player_idx, discarding_player_idx)
+
+    def call_open_kan(self, tiles136, calling_player_idx, discarding_player_idx):
+        super().call_open_kan(tiles136, calling_player_idx, discarding_player_idx)
+        self._record('call_open_kan', tiles136, calling_player_idx, discarding_player_idx)
+
+    def call_closed_or_added_kan(self, tiles136, player_idx):
+        super().call_closed_or_added_kan(tiles136, player_idx)
+        self._record('call_closed_or_added_kan', tiles136, player_idx)
+
+    def do_ron(self, calling_player_idxs, discarding_player_idx, chankan136=None):
+        super().do_ron(calling_player_idxs, discarding_player_idx, chankan136)
+        self._record('do_ron', calling_player_idxs, discarding_player_idx, chankan136)
+
+    def do_tsumo(self, player_idx):
+        super().do_tsumo(player_idx)
+        self._record('do_tsumo', player_idx)
+
+    def do_9tile_draw(self, player_idx):
+        super().do_9tile_draw(player_idx)
+        self._record('do_9tile_draw', player_idx)
+
+
+class Replayer(object):
+    # Rebuilds a recorded game at any position, i.e. after any number of
+    # actions. A snapshot is kept every checkpoint_interval actions on the
+    # way, so seeking only runs the actions after the nearest one.
+    # After a seek, game.pending_events holds the events of the last action.
+    def __init__(self, record, checkpoint_interval=32):
+        self.record = record
+        self.checkpoint_interval = checkpoint_interval
+        self.game = Game(ShuffledWall(rng=random.Random(record.seed)))
+        self.game.start_game(
+            [Player(self.game, name) for name in record.player_names], False)
+        self.position = 0
+        self.checkpoints = {0: self.game.snapshot()}
+
+    def __len__(self):
+        return len(self.record.actions)
+
+    def step(self):
+        if self.position >= len(self.record.actions):
+            raise ReplayError("At the end of the record")
+        name, args = self.record.actions[self.position]
+        self.game.pop_events()
+        getattr(self.game, name)(*args)
+        self.position += 1
+        if self.position % self.checkpoint_interval == 0 and \
+           self.position not in self.checkpoints:
+            self.checkpoints[self.position] = self.game.snapshot()
+
+    def seek(self, position):
+        if position < 0 or position > len(self.record.actions):
+            raise ReplayError("No position {} in {} actions".format(
+                position, len(self.record.actions)))
+        # Restore the closest checkpoint, unless we are already closer
+        checkpoint = position - position % self.checkpoint_interval
+        while checkpoint not in self.checkpoints:
+            checkpoint -= self.checkpoint_interval
+        if not checkpoint <= self.position <= position:
+            self.game.restore(self.checkpoints[checkpoint])
+            self.position = checkpoint
+        while self.position < position:
+            self.step()
+        return self.game
+
+    def find_turn(self, wind, round, bonus, turn):
+        # Position of a turn in a round, where turn n is right after the n'th
+        # discard of the round and turn 0 is the start of the round
+        starts = [pos for w, r, b, pos in self.record.rounds
+                  if (w, r, b) == (wind, round, bonus)]
+        if not starts:
+            raise ReplayError("No round {}{}-{}".format(wind, round, bonus))
+        pos = starts[0]
+        later = [p for w, r, b, p in self.record.rounds if p > pos]
+        end = later[0] if later else len(self.record.actions)
+        discards = 0
+        while discards < turn:
+            if pos >= end:
+                raise ReplayError("Round {}{}-{} has only {} discards".format(
+                    wind, round, bonus, discards))
+            if self.record.actions[pos][0] == 'discard_tile':
+                discards += 1
+            pos += 1
+        return pos
+
+    def seek_turn(self, wind, round, bonus, turn):
+        return self.seek(self.find_turn(wind, round, bonus, turn))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded game")
+    parser.add_argument("record")
+    parser.add_argument("--round", help="round to seek to, e.g. S4-0")
+    parser.add_argument("--turn", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.record, "rb") as f:
+        replayer = Replayer(GameRecord.decode(f.read()))
+    if args.round:
+        wind_round, bonus = args.round.split("-")
+        game = replayer.seek_turn(wind_round[0], int(wind_round[1:]), int(bonus), args.turn)
+    else:
+        game = replayer.seek(len(replayer))
+    print("Action {} of {}".format(replayer.position, len(replayer)))
+    game.dump()
+
+if __name__ == "__main__":
+    main()
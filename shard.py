@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+# Rooms can be spread over several server processes, called shards. A room
+# lives on the shard given by its code modulo the number of shards, and the
+# events of its players are handled there, whichever shard the players are
+# connected to. Shards talk over a bus that relays every message to every
+# shard: Socket.IO's own messages (emits, room changes), and route messages
+# that carry a client event to the shard owning the room.
+#
+# Messages are JSON objects. MemoryBus runs every shard in one process and is
+# enough for tests, and Hub relays messages between processes over a Unix
+# socket.
+
+# Seconds to wait before reconnecting to the hub
+RECONNECT_DELAY = 1
+
+class ShardError(Exception):
+    pass
+
+
+def shard_for(code, shards):
+    try:
+        return int(code) % shards
+    except ValueError:
+        raise ShardError("Invalid room code {!r}".format(code))
+
+
+class MemoryConnection(object):
+    def __init__(self, bus):
+        self.bus = bus
+        self.queue = asyncio.Queue()
+
+    async def send(self, message):
+        for conn in self.bus.connections:
+            conn.queue.put_nowait(message)
+
+    async def recv(self):
+        return await self.queue.get()
+
+class MemoryBus(object):
+    def __init__(self):
+        self.connections = []
+
+    async def connect(self):
+        conn = MemoryConnection(self)
+        self.connections.append(conn)
+        return conn
+
+
+class StreamConnection(object):
+    # One message per line, which is safe since JSON escapes newlines
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, message):
+        self.writer.write(message.encode() + b"\n")
+        await self.writer.drain()
+
+    async def recv(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Shard hub closed the connection")
+        return line.decode()
+
+class UnixBus(object):
+    def __init__(self, path):
+        self.path = path
+
+    async def connect(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        return StreamConnection(reader, writer)
+
+class Hub(object):
+    # Relays every line one shard sends to all connected shards
+    def __init__(self, path):
+        self.path = path
+        self.writers = set()
+        self.tasks = set()
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self._serve, self.path)
+
+    async def close(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self.writers.add(writer)
+        self.tasks.add(asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for w in list(self.writers):
+                    w.write(line)
+                await asyncio.gather(*[w.drain() for w in list(self.writers)],
+                                     return_exceptions=True)
+        finally:
+            self.writers.discard(writer)
+            self.tasks.discard(asyncio.current_task())
+            writer.close()
+
+
+class ShardManager(AsyncPubSubManager):
+    # Client manager for the Socket.IO server of one shard. Emits and room
+    # changes for clients connected to other shards go over the bus, and
+    # route messages for this shard are passed to on_route(event, sid, *args)
+    # in the order they were sent.
+    name = 'shard'
+
+    def __init__(self, shard, shards, bus, on_route=None, channel='tanoshii'):
+        super().__init__(channel=channel)
+        self.shard = shard
+        self.shards = shards
+        self.bus = bus
+        self.on_route = on_route
+        self.conn = None
+
+    async def _connection(self):
+        # Publishing and listening both need the connection, and either may
+        # start first
+        if self.conn is None:
+            self.conn = asyncio.ensure_future(self.bus.connect())
+        return await self.conn
+
+    async def route(self, shard, event, sid, *args):
+        await self._publish({
+            'method': 'route', 'shard': shard,
+            'event': event, 'sid': sid, 'args': list(args),
+            'host_id': self.host_id
+        })
+
+    async def _publish(self, data):
+        data = dict(data, channel=self.channel)
+        conn = await self._connection()
+        await conn.send(json.dumps(data))
+
+    async def _listen(self):
+        try:
+            conn = await self._connection()
+            while True:
+                data = json.loads(await conn.recv())
+                if data.get('channel') != self.channel:
+                    continue
+                if data.get('method') != 'route':
+                    yield data
+                elif data['shard'] == self.shard and self.on_route is not None:
+                    try:
+                        await self.on_route(data['event'], data['sid'], *data['args'])
+                    except Exception:
+                        logging.exception("Routed event %s failed", data['event'])
+        except OSError:
+            # Reconnect when listening again, which the manager does right
+            # after this raises
+            self.conn = None
+            await asyncio.sleep(RECONNECT_DELAY)
+            raise
@@ -0,0 +1,428 @@
+import argparse
+import random
+import time
+
+from engine import (Game, Player, ShuffledWall, QueryEvent, CallQuery,
+                    NewRoundEvent, GameOverEvent, WinEvent, DrawEvent)
+from replay import RecordingGame
+from bot import BotPlayer
+
+
+# Policies answer the queries a player gets. Every method gets the game, the
+# index of the player and the query. The discard query must be answered, the
+# others can be declined by returning None or False. Policies that make
+# random choices take an rng, see make_policies.
+class Policy(object):
+    uses_rng = False
+
+    def make_player(self, game, name):
+        return Player(game, name)
+
+    def record(self, player_idx, ev):
+        # Sees every event the seat of the policy gets
+        pass
+
+    # Discard the drawn tile if allowed, otherwise the last allowed tile
+    def discard(self, game, player_idx, query):
+        latest = game.players[player_idx].latest_draw
+        if latest in query.allowed:
+            return latest
+        return query.allowed[-1]
+
+    def riichi(self, game, player_idx, query):
+        return None
+
+    def tsumo(self, game, player_idx, query):
+        return True
+
+    def ron(self, game, player_idx, query):
+        return True
+
+    def draw(self, game, player_idx, query):
+        return False
+
+    def call(self, game, player_idx, query):
+        return None
+
+class TsumogiriPolicy(Policy):
+    # Only the default answers: tsumogiri, win whenever possible, never call
+    pass
+
+class EfficiencyPolicy(Policy):
+    # Discard for the lowest shanten and widest ukeire, riichi when possible
+    # and never call
+    def _best_discard(self, game, player_idx, allowed):
+        table = game.players[player_idx].get_discard_table()
+        def score(t136):
+            shanten, ukeire, wait = table[t136 // 4]
+            return (shanten, -len(ukeire))
+        return min(allowed, key=score)
+
+    def discard(self, game, player_idx, query):
+        return self._best_discard(game, player_idx, query.allowed)
+
+    def riichi(self, game, player_idx, query):
+        return self._best_discard(game, player_idx, query.allowed)
+
+class BotPolicy(Policy):
+    # Leaves every decision to a bot.BotPlayer in the seat
+    def make_player(self, game, name):
+        self.player = BotPlayer(game, name)
+        return self.player
+
+    def record(self, player_idx, ev):
+        self.player.record(player_idx, ev)
+
+    def discard(self, game, player_idx, query):
+        return self.player.choose_discard(query)
+
+    def riichi(self, game, player_idx, query):
+        return self.player.choose_riichi(query)
+
+    def tsumo(self, game, player_idx, query):
+        return self.player.wants_tsumo(query)
+
+    def ron(self, game, player_idx, query):
+        return self.player.wants_ron(query)
+
+    def draw(self, game, player_idx, query):
+        return self.player.wants_draw(query)
+
+    def call(self, game, player_idx, query):
+        return self.player.choose_call(query)
+
+class RandomPolicy(Policy):
+    # Random discards, and random calls with the given chance
+    uses_rng = True
+
+    def __init__(self, rng=None, call_chance=0.2):
+        self.rng = rng if rng is not None else random.Random()
+        self.call_chance = call_chance
+
+    def discard(self, game, player_idx, query):
+        return self.rng.choice(query.allowed)
+
+    def riichi(self, game, player_idx, query):
+        if self.rng.random() < 0.5:
+            return self.rng.choice(query.allowed)
+        return None
+
+    def call(self, game, player_idx, query):
+        if self.rng.random() < self.call_chance:
+            return self.rng.choice(query.choices)
+        return None
+
+
+class SimReport(object):
+    def __init__(self):
+        self.games = 0
+        self.rounds = 0
+        self.actions = 0
+        self.elapsed = 0.0
+        # Seeds of games that were given up on, so they can be played again
+        self.aborted = []
+        # Time and count per phase
+        self.phase_time = {}
+        self.phase_count = {}
+
+    def add_phase(self, phase, t):
+        self.phase_time[phase] = self.phase_time.get(phase, 0.0) + t
+        self.phase_count[phase] = self.phase_count.get(phase, 0) + 1
+
+    def to_record(self):
+        return {
+            "games": self.games,
+            "rounds": self.rounds,
+            "actions": self.actions,
+            "aborted": self.aborted,
+            "phase_time": self.phase_time,
+            "phase_count": self.phase_count
+        }
+
+    def merge(self, record):
+        # Elapsed time is not merged, reports from parallel runs overlap
+        self.games += record["games"]
+        self.rounds += record["rounds"]
+        self.actions += record["actions"]
+        self.aborted.extend(record["aborted"])
+        _merge_counts(self.phase_time, record["phase_time"])
+        _merge_counts(self.phase_count, record["phase_count"])
+
+    def games_per_second(self):
+        return self.games / self.elapsed if self.elapsed else 0.0
+
+    def rounds_per_second(self):
+        return self.rounds / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        lines = [
+            "{} games, {} rounds, {} actions in {:.2f}s".format(
+                self.games, self.rounds, self.actions, self.elapsed),
+            "{:.2f} games/s, {:.2f} rounds/s".format(
+                self.games_per_second(), self.rounds_per_second())
+        ]
+        if self.aborted:
+            lines.append("{} games aborted, seeds: {}".format(
+                len(self.aborted), " ".join(str(seed) for seed in self.aborted)))
+        for phase in sorted(self.phase_time, key=self.phase_time.get, reverse=True):
+            t = self.phase_time[phase]
+            n = self.phase_count[phase]
+            lines.append("  {:<12} {:8.3f}s {:8} calls {:9.1f}us/call".format(
+                phase, t, n, t / n * 1e6))
+        return "\n".join(lines)
+
+
+def _merge_counts(into, counts):
+    for k, n in counts.items():
+        into[k] = into.get(k, 0) + n
+
+class SimStats(object):
+    # Aggregated results of simulated games. Only plain counters are kept, so
+    # a record is small and cheap to send between processes.
+    POINTS_BUCKET = 1000
+
+    def __init__(self):
+        self.games = 0
+        self.rounds = 0
+        self.tsumo = 0
+        self.ron = 0
+        self.wins_by_seat = [0]*4
+        self.yaku = {}
+        self.han = {}
+        self.draws = {}
+        # Points per win, and points at the end of the game, in buckets
+        self.win_points = {}
+        self.final_points = {}
+
+    def record(self, player_idx, ev):
+        if isinstance(ev, NewRoundEvent):
+            self.rounds += 1
+        elif isinstance(ev, WinEvent):
+            win = ev.win
+            if win.win_tile is None:
+                self.tsumo += 1
+            else:
+                self.ron += 1
+            self.wins_by_seat[win.player_idx] += 1
+            for name, han in win.yaku:
+                self.yaku[name] = self.yaku.get(name, 0) + 1
+            self.han[win.han] = self.han.get(win.han, 0) + 1
+            bucket = win.total // self.POINTS_BUCKET * self.POINTS_BUCKET
+            self.win_points[bucket] = self.win_points.get(bucket, 0) + 1
+        elif isinstance(ev, DrawEvent):
+            self.draws[ev.draw] = self.draws.get(ev.draw, 0) + 1
+        elif isinstance(ev, GameOverEvent):
+            self.games += 1
+            for points in ev.points:
+                bucket = points // self.POINTS_BUCKET * self.POINTS_BUCKET
+                self.final_points[bucket] = self.final_points.get(bucket, 0) + 1
+
+    def to_record(self):
+        return dict(self.__dict__)
+
+    def merge(self, record):
+        self.games += record["games"]
+        self.rounds += record["rounds"]
+        self.tsumo += record["tsumo"]
+        self.ron += record["ron"]
+        for i, n in enumerate(record["wins_by_seat"]):
+            self.wins_by_seat[i] += n
+        for name in ["yaku", "han", "draws", "win_points", "final_points"]:
+            _merge_counts(getattr(self, name), record[name])
+
+    def win_rate(self):
+        return (self.tsumo + self.ron) / self.rounds if self.rounds else 0.0
+
+    def __str__(self):
+        lines = [
+            "{} games, {} rounds, win rate {:.3f} ({} tsumo, {} ron)".format(
+                self.games, self.rounds, self.win_rate(), self.tsumo, self.ron),
+            "wins by seat: {}".format(self.wins_by_seat),
+            "draws: {}".format(dict(sorted(self.draws.items())))
+        ]
+        total_wins = self.tsumo + self.ron
+        for name, n in sorted(self.yaku.items(), key=lambda y: -y[1]):
+            lines.append("  {:<20} {:8} {:6.3f}".format(name, n, n / total_wins))
+        return "\n".join(lines)
+
+
+class SimulationError(Exception):
+    pass
+
+class Simulator(object):
+    # Plays full games without any interaction, asking one policy per seat.
+    def __init__(self, policies=None, seed=None, max_rounds=100, stats=None, record=False):
+        self.policies = policies or [EfficiencyPolicy() for i in range(4)]
+        assert len(self.policies) == 4
+        self.rng = random.Random(seed)
+        self.max_rounds = max_rounds
+        self.report = SimReport()
+        # Optional SimStats that gets to see every event
+        self.stats = stats
+        # If set, every game is recorded for replay.Replayer into records
+        self.record = record
+        self.records = []
+
+    def _timed(self, phase, fun, *args):
+        start = time.perf_counter()
+        result = fun(*args)
+        self.report.add_phase(phase, time.perf_counter() - start)
+        return result
+
+    def _ask(self, method, game, player_idx, query):
+        policy = self.policies[player_idx]
+        return self._timed('policy', getattr(policy, method), game, player_idx, query)
+
+    def play_game(self, seed=None):
+        if seed is None:
+            seed = self.rng.getrandbits(64)
+        if self.record:
+            game = RecordingGame(seed)
+            self.records.append(game.record)
+        else:
+            game = Game(ShuffledWall(rng=random.Random(seed)))
+        players = [policy.make_player(game, "P{}".format(i))
+                   for i, policy in enumerate(self.policies)]
+        self._timed('start', game.start_game, players, False)
+
+        rounds = 0
+        while True:
+            evs = game.pop_events()
+            self.report.actions += 1
+            queries = []
+            for player_idx, ev in evs:
+                if self.stats is not None:
+                    self.stats.record(player_idx, ev)
+                # Players are not shuffled, so seat i has policy i
+                if player_idx is None:
+                    for policy in self.policies:
+                        policy.record(player_idx, ev)
+                else:
+                    self.policies[player_idx].record(player_idx, ev)
+                if isinstance(ev, NewRoundEvent):
+                    rounds += 1
+                    self.report.rounds += 1
+                elif isinstance(ev, GameOverEvent):
+                    self.report.games += 1
+                    return ev.points
+                elif isinstance(ev, QueryEvent):
+                    queries.append((player_idx, ev))
+
+            if rounds > self.max_rounds:
+                raise SimulationError("Game did not end after {} rounds".format(rounds))
+
+            if not queries:
+                if game.continuation is None:
+                    raise SimulationError("Game has no queries and no continuation")
+                self._timed('continue', game.run_continuation)
+                continue
+
+            discard = [q for q in queries if q[1].name == 'discard_query']
+            if discard:
+                self._play_turn(game, discard[0][0], [q for pl, q in queries if pl == discard[0][0]])
+            else:
+                self._play_reactions(game, queries)
+
+    def _play_turn(self, game, player_idx, queries):
+        by_name = {}
+        for q in queries:
+            if q.name == 'call_query':
+                by_name.setdefault(q.kind, q)
+            else:
+                by_name[q.name] = q
+
+        if 'tsumo_query' in by_name and self._ask('tsumo', game, player_idx, by_name['tsumo_query']):
+            self._timed('win', game.do_tsumo, player_idx)
+            return
+        if 'draw_query' in by_name and self._ask('draw', game, player_idx, by_name['draw_query']):
+            self._timed('draw', game.do_9tile_draw, player_idx)
+            return
+        if CallQuery.KAN in by_name:
+            choice = self._ask('call', game, player_idx, by_name[CallQuery.KAN])
+            if choice:
+                self._timed('kan', game.call_closed_or_added_kan, choice, player_idx)
+                return
+        if 'riichi_query' in by_name:
+            t136 = self._ask('riichi', game, player_idx, by_name['riichi_query'])
+            if t136 is not None:
+                self._timed('discard', game.discard_tile, player_idx, t136, True)
+                return
+        t136 = self._ask('discard', game, player_idx, by_name['discard_query'])
+        self._timed('discard', game.discard_tile, player_idx, t136)
+
+    def _play_reactions(self, game, queries):
+        # Ron beats kan and pon, which beat chi
+        rons = []
+        calls = []
+        for player_idx, q in queries:
+            if q.name == 'ron_query':
+                if self._ask('ron', game, player_idx, q):
+                    rons.append((player_idx, q))
+            elif q.name == 'call_query':
+                choice = self._ask('call', game, player_idx, q)
+                if choice:
+                    calls.append((player_idx, q, choice))
+
+        if rons:
+            query = rons[0][1]
+            self._timed('win', game.do_ron, [pl for pl, q in rons], query.from_player,
+                        query.chankan)
+            return
+
+        priority = {CallQuery.KAN: 0, CallQuery.PON: 0, CallQuery.CHI: 1}
+        calls.sort(key=lambda c: priority[c[1].kind])
+        if calls:
+            player_idx, q, choice = calls[0]
+            if q.kind == CallQuery.KAN:
+                self._timed('kan', game.call_open_kan, choice, player_idx, q.from_who)
+            elif q.kind == CallQuery.PON:
+                self._timed('call', game.call_pon, choice, player_idx, q.from_who)
+            else:
+                self._timed('call', game.call_chi, choice, player_idx, q.from_who)
+            return
+
+        # Everyone passed
+        self._timed('continue', game.run_continuation)
+
+    def run(self, n_games):
+        start = time.perf_counter()
+        for i in range(n_games):
+            # A game that gets stuck is noted and skipped, the rest still run
+            seed = self.rng.getrandbits(64)
+            try:
+                self.play_game(seed)
+            except SimulationError:
+                self.report.aborted.append(seed)
+        self.report.elapsed += time.perf_counter() - start
+        return self.report
+
+
+POLICIES = {
+    'bot': BotPolicy,
+    'efficiency': EfficiencyPolicy,
+    'tsumogiri': TsumogiriPolicy,
+    'random': RandomPolicy,
+}
+
+def make_policies(name, seed=None):
+    # One policy of the given name per seat. Each policy that takes an rng
+    # gets its own, derived from the seed, so a seeded run is reproducible.
+    policy = POLICIES[name]
+    if not policy.uses_rng:
+        return [policy() for i in range(4)]
+    if seed is None:
+        return [policy(rng=random.Random()) for i in range(4)]
+    return [policy(rng=random.Random("{}-{}".format(seed, i))) for i in range(4)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless self-play")
+    parser.add_argument("-n", "--games", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--policy", choices=sorted(POLICIES), default='efficiency')
+    args = parser.parse_args()
+
+    sim = Simulator(make_policies(args.policy, args.seed), args.seed)
+    print(sim.run(args.games))
+
+if __name__ == "__main__":
+    main()
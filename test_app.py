@@ -0,0 +1,362 @@
+import app
+import engine
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+class AppTestCase(unittest.IsolatedAsyncioTestCase):
+    # Records what is sent instead of sending it, with a lobby of its own and
+    # a room that the players join before every test
+    # Players in the room, or None for no room
+    players = 4
+
+    async def asyncSetUp(self):
+        self.sent = []
+        async def enter_room(sid, room):
+            pass
+        for patcher in [mock.patch.object(app.sio, 'emit', self.emit),
+                        mock.patch.object(app.sio, 'enter_room', enter_room),
+                        mock.patch.object(app.sio, 'leave_room', enter_room),
+                        mock.patch.multiple(app, routes={}, lobby=self.make_lobby())]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        if self.players is None:
+            return
+        self.room = app.lobby.open_room(app.Room)
+        self.addCleanup(self.room.close)
+        for i in range(self.players):
+            await self.room.join(app.Player("sid{}".format(i), "Player{}".format(i)))
+
+    async def emit(self, event, data=None, to=None, **kwargs):
+        self.sent.append((event, data, to))
+
+    def make_lobby(self):
+        return engine.Lobby()
+
+    def frames(self, event='game_events'):
+        return [(to, data) for ev, data, to in self.sent if ev == event]
+
+class RoomTest(AppTestCase):
+
+    async def test_start(self):
+        await self.room.start()
+        await self.room.drain()
+        self.assertEqual(sorted(pl.seat for pl in self.room.players), [0, 1, 2, 3])
+        self.assertEqual([pl.seat for pl in self.room.seats], [0, 1, 2, 3])
+        frames = self.frames()
+        self.assertEqual(sorted(to for to, data in frames),
+                         ["sid{}".format(i) for i in range(4)])
+        for to, data in frames:
+            names = [ev['name'] for ev in json.loads(data)]
+            self.assertIn('ev_new_game', names)
+            self.assertIn('ev_new_round', names)
+        with self.assertRaises(app.AppError):
+            await self.room.start()
+
+    async def test_actions_are_batched(self):
+        await self.room.start()
+        await self.room.drain()
+        game = self.room.game
+        active = self.room.seats[game.active_player]
+        tile = game.players[game.active_player].hand[-1]
+        self.sent.clear()
+
+        name, args = app.GAME_ACTIONS['discard'](active.seat, {'tile': tile})
+        self.room.submit(active.sid, getattr(game, name), *args)
+        self.room.submit(active.sid, game.run_continuation)
+        # Not the player's turn anymore
+        self.room.submit(active.sid, game.discard_tile, active.seat, tile)
+        await self.room.drain()
+
+        self.assertEqual(len(self.frames()), 4)
+        self.assertEqual(self.frames('server_error'), [(active.sid, mock.ANY)])
+        for to, data in self.frames():
+            names = [ev['name'] for ev in json.loads(data)]
+            self.assertIn('ev_discard', names)
+            self.assertIn('ev_tile', names)
+        self.assertEqual(game.record.actions[0][0], 'discard_tile')
+        self.assertEqual(len(game.record.actions), 2)
+
+    async def test_unasked_answers(self):
+        await self.room.start()
+        await self.room.drain()
+        game = self.room.game
+        queries = list(game.open_queries)
+        other = self.room.seats[(game.active_player + 1) % 4]
+        self.sent.clear()
+
+        # Nobody can pass or ron while only the discard query is open
+        for action in ['pass', 'ron']:
+            name, args = app.GAME_ACTIONS[action](other.seat, {})
+            self.room.submit(other.sid, getattr(game, name), *args)
+        await self.room.drain()
+
+        self.assertEqual(self.frames('server_error'), [(other.sid, mock.ANY)] * 2)
+        self.assertEqual(self.frames(), [])
+        self.assertEqual(game.open_queries, queries)
+        self.assertEqual(game.record.actions, [])
+
+    async def test_bots(self):
+        for i in range(1, 4):
+            await self.room.leave(self.room.players[i])
+        for i in range(1, 4):
+            await self.room.add_bot("Bot{}".format(i))
+        self.assertTrue(all(pl.bot for pl in self.room.players[1:]))
+        await self.room.start()
+        await self.room.drain()
+        game = self.room.game
+        human = self.room.players[0]
+        self.assertEqual(game.players[human.seat].name, human.name)
+        for turn in range(8):
+            # Only the player is left to answer, the bots did as soon as
+            # their queries opened
+            self.assertEqual(set(idx for idx, q in game.open_queries
+                                 if not game.has_answered(idx)), {human.seat})
+            self.room.submit(human.sid, game.auto_answer)
+            await self.room.drain()
+        # Counted from the record, as a round can end on the way
+        self.assertGreater(sum(1 for name, args in game.record.actions
+                               if name == 'discard_tile' and args[0] != human.seat), 8)
+        # Only the player gets the events
+        self.assertEqual(set(to for to, data in self.frames()), {human.sid})
+
+    async def test_discard_twice(self):
+        await self.room.start()
+        await self.room.drain()
+        game = self.room.game
+        # Play on until a discard can be called
+        for i in range(200):
+            calls = [q for idx, q in game.open_queries if q.name == 'call_query' and
+                     q.from_who is not None]
+            if calls and not any(q.name == 'discard_query' for idx, q in game.open_queries):
+                break
+            self.room.submit(None, game.auto_answer)
+            await self.room.drain()
+        else:
+            self.fail("No calls in 200 actions")
+        discarder = self.room.seats[calls[0].from_who]
+        hand = list(game.players[discarder.seat].hand)
+        queries = list(game.open_queries)
+        self.sent.clear()
+
+        for action in ['discard', 'tsumo', 'kan', 'nine_terminals']:
+            name, args = app.GAME_ACTIONS[action](discarder.seat, {'tile': hand[0], 'tiles': hand[:4]})
+            self.room.submit(discarder.sid, getattr(game, name), *args)
+        await self.room.drain()
+
+        self.assertEqual(self.frames('server_error'), [(discarder.sid, mock.ANY)] * 4)
+        self.assertEqual(self.frames(), [])
+        self.assertEqual(list(game.players[discarder.seat].hand), hand)
+        self.assertEqual(game.open_queries, queries)
+
+    async def test_handlers_do_not_wait(self):
+        await self.room.start()
+        await self.room.drain()
+        ran = []
+        self.room.submit(None, lambda: ran.append(1))
+        # submit only queues, the action runs on an engine thread later
+        self.assertEqual(ran, [])
+        await self.room.drain()
+        self.assertEqual(ran, [1])
+
+    async def test_close(self):
+        await self.room.start()
+        await self.room.drain()
+        worker = self.room.worker
+        self.room.close()
+        await asyncio.sleep(0)
+        self.assertTrue(worker.cancelled())
+        self.assertIsNone(self.room.worker)
+
+class RoutingTest(AppTestCase):
+    # As shard 0 of 2, with the routed events recorded instead of sent
+    players = None
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.routed = []
+        async def route(shard, event, sid, *args):
+            self.routed.append((shard, event, sid) + args)
+        manager = mock.Mock(route=route)
+        for patcher in [mock.patch.object(app.sio, 'manager', manager),
+                        mock.patch.multiple(app, SHARD=0, SHARDS=2)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_lobby(self):
+        return engine.Lobby(app.shard_codes(0, 2))
+
+    async def test_create_on_own_shard(self):
+        await app.create_game("sid0", "Host")
+        code, = app.lobby.rooms
+        self.assertEqual(int(code) % 2, 0)
+        self.assertEqual(app.routes, {"sid0": 0})
+        self.assertIn("sid0", app.lobby.players)
+        self.assertEqual(self.routed, [])
+
+    async def test_join_other_shard(self):
+        await app.join_game("sid1", "12345", "Guest")
+        self.assertEqual(self.routed, [(1, 'room_join', "sid1", 0, "12345", "Guest")])
+        await app.game_action("sid1", "pass")
+        await app.disconnect("sid1")
+        self.assertEqual(self.routed[1:], [(1, 'room_game_action', "sid1", "pass", None),
+                                           (1, 'room_leave', "sid1")])
+        self.assertEqual(app.routes, {})
+
+    async def test_join_own_shard(self):
+        await app.create_game("sid0", "Host")
+        code, = app.lobby.rooms
+        await app.join_game("sid1", code, "Guest")
+        self.assertEqual(self.routed, [])
+        self.assertEqual(app.lobby.players["sid1"].room, app.lobby.rooms[code])
+
+        # A failed join is forgotten by the shard the client is on
+        missing = "10000" if code != "10000" else "10002"
+        await app.join_game("sid2", missing, "Other")
+        self.assertNotIn("sid2", app.routes)
+        self.assertIn(('server_error', 'Room does not exist', "sid2"), self.sent)
+        await app.join_game("sid3", "abc", "Other")
+        self.assertNotIn("sid3", app.routes)
+
+class UpdateTest(AppTestCase):
+    players = 0
+
+    async def emit(self, event, data=None, to=None, skip_sid=None, **kwargs):
+        self.sent.append((event, data, to, skip_sid))
+
+    async def tick(self):
+        await asyncio.sleep(app.UPDATE_INTERVAL * 2)
+
+    def updates(self):
+        sent = [(ev, data, to, skip) for ev, data, to, skip in self.sent
+                if ev in ('room_update', 'room_diff')]
+        self.sent.clear()
+        return sent
+
+    async def test_coalesced(self):
+        pls = [app.Player("sid{}".format(i), "Player{}".format(i)) for i in range(4)]
+        for pl in pls:
+            await self.room.join(pl)
+        self.assertEqual(self.updates(), [])
+        await self.tick()
+        (ev, data, to, skip), = self.updates()
+        self.assertEqual((ev, sorted(to)), ('room_update', ["sid0", "sid1", "sid2", "sid3"]))
+        self.assertEqual([pl['name'] for pl in data['players']],
+                         ["Player0", "Player1", "Player2", "Player3"])
+        self.assertTrue(data['players'][0]['host'])
+
+        # The host leaves and a new player joins in the same tick
+        await self.room.leave(pls[0])
+        await self.room.leave(pls[2])
+        await self.room.join(app.Player("sid4", "Player4"))
+        await self.tick()
+        updates = self.updates()
+        self.assertEqual(len(updates), 2)
+        full, = [u for u in updates if u[0] == 'room_update']
+        diff, = [u for u in updates if u[0] == 'room_diff']
+        self.assertEqual(full[2], ["sid4"])
+        self.assertEqual(diff[2:], (self.room.name, ["sid4"]))
+        self.assertEqual(sorted(diff[1]['players']), ["0", "1", "2"])
+        self.assertIsNone(diff[1]['players']["2"])
+        self.assertEqual(diff[1]['players']["0"]['name'], "Player4")
+        self.assertTrue(diff[1]['players']["1"]['host'])
+        self.assertNotIn('config', diff[1])
+
+        await self.tick()
+        self.assertEqual(self.updates(), [])
+
+class ResumeTest(AppTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        await self.room.start()
+        await self.room.drain()
+        self.sent.clear()
+
+    def views(self, sid):
+        return [json.loads(data) for to, data in self.frames() if to == sid]
+
+    async def test_resume(self):
+        pl = app.lobby.get_player("sid1")
+        await app.room_leave("sid1")
+        self.assertIsNone(pl.sid)
+        self.assertIs(self.room.players[pl.slot], pl)
+        self.assertFalse(self.room.get_state()["players"][pl.slot]["connected"])
+
+        # The game goes on without the player
+        game = self.room.game
+        active = game.active_player
+        self.room.submit(None, game.discard_tile, active, game.players[active].hand[0])
+        await self.room.drain()
+        self.assertEqual(self.views(None), [])
+
+        await app.room_resume("sid9", 0, self.room.name, "bad token")
+        self.assertIn(('server_error', "There is no seat to resume", "sid9"), self.sent)
+        await app.room_resume("sid9", 0, self.room.name, pl.token)
+        await self.room.drain()
+        self.assertEqual(pl.sid, "sid9")
+        self.assertIs(app.lobby.get_player("sid9"), pl)
+        self.assertIsNone(pl.expiry)
+        (view,), = self.views("sid9")
+        self.assertEqual(view["name"], "ev_resume")
+        self.assertEqual(view["seat"], pl.seat)
+        self.assertEqual(view["hand"], list(game.players[pl.seat].hand))
+        self.assertEqual(len(view["discards"][active]), 1)
+
+        # Only once
+        await app.room_resume("sid10", 0, self.room.name, pl.token)
+        self.assertIn(('server_error', "There is no seat to resume", "sid10"), self.sent)
+
+    async def test_expire(self):
+        pl = app.lobby.get_player("sid2")
+        with mock.patch.object(app, 'GRACE_PERIOD', 0.01):
+            await app.room_leave("sid2")
+            await asyncio.sleep(0.05)
+        self.assertIsNone(self.room.players[pl.slot])
+        self.assertNotIn(pl.token, self.room.tokens)
+        await app.room_resume("sid9", 0, self.room.name, pl.token)
+        self.assertIsNone(app.lobby.get_player("sid9"))
+
+        # The seat is empty, but the game has started without it
+        with self.assertRaises(app.AppError):
+            await self.room.join(app.Player("sid9", "Player9"))
+        self.assertIsNone(self.room.players[pl.slot])
+        self.assertIsNone(app.lobby.get_player("sid9"))
+
+class TimeoutTest(AppTestCase):
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        wheel = app.TimerWheel(tick=0.01)
+        self.addCleanup(wheel.close)
+        for patcher in [mock.patch.object(app, 'timers', wheel),
+                        mock.patch.object(app, 'QUERY_TIMEOUT', 0.05)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_auto_discard(self):
+        await self.room.start()
+        await self.room.drain()
+        game = self.room.game
+        dealer = game.players[game.dealer()]
+        drawn = dealer.latest_draw
+        self.assertIsNotNone(self.room.query_timer)
+
+        await asyncio.sleep(0.2)
+        await self.room.drain()
+        self.assertEqual(dealer.discards[0].tile, drawn)
+        self.assertEqual(game.record.actions[0][0], 'discard_tile')
+        self.assertGreater(len(game.record.actions), 1)
+
+    async def test_answered_in_time(self):
+        await self.room.start()
+        await self.room.drain()
+        game = self.room.game
+        dealer = game.players[game.dealer()]
+        timer = self.room.query_timer
+        self.room.submit(None, game.discard_tile, dealer.idx, dealer.hand[0])
+        await self.room.drain()
+        self.assertIsNot(self.room.query_timer, timer)
+        self.assertEqual(dealer.discards[0].tile, game.record.actions[0][1][1])
+
+if __name__ == "__main__":
+    unittest.main()
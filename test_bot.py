@@ -0,0 +1,210 @@
+from bot import SafetyIndex, GENBUTSU, SUJI, KABE, UNSAFE, BotPlayer
+from engine import (Game, Player, ShuffledWall, NewRoundEvent, DiscardEvent, CallEvent,
+                    DoraEvent, GameOverEvent, Meld, Discard, Wait, DiscardQuery,
+                    RiichiQuery, CallQuery)
+from sim import Simulator, EfficiencyPolicy, BotPolicy
+from tile import tt, tile34_string_to_136_array
+import random
+import unittest
+
+def t34(name):
+    return tt(name + "0") // 4
+
+class SafetyIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = SafetyIndex(0)
+        self.index.record(None, NewRoundEvent('E', 1, 0, [[]] * 4))
+
+    def discard(self, player, name, copy=0, riichi=False):
+        self.index.record(None, DiscardEvent(tt(name + str(copy)), player, False, riichi))
+
+    def test_genbutsu_and_suji(self):
+        self.discard(1, "1m")
+        self.discard(1, "7m")
+        self.discard(2, "5p")
+        table = self.index.get_safety(1)
+        self.assertEqual(table[t34("1m")], GENBUTSU)
+        self.assertEqual(table[t34("7m")], GENBUTSU)
+        self.assertEqual(table[t34("4m")], SUJI)
+        self.assertEqual(table[t34("5m")], UNSAFE)
+        self.assertEqual(table[t34("5p")], UNSAFE)
+        self.assertEqual(self.index.get_safety(2)[t34("2p")], SUJI)
+        self.assertEqual(self.index.get_safety(2)[t34("8p")], SUJI)
+        self.assertEqual(self.index.get_safety(2)[t34("4m")], UNSAFE)
+
+        self.discard(1, "2m")
+        self.assertEqual(self.index.get_safety(1)[t34("5m")], UNSAFE)
+        self.discard(1, "8m")
+        self.assertEqual(self.index.get_safety(1)[t34("5m")], SUJI)
+
+    def test_riichi(self):
+        self.discard(3, "9p")
+        self.discard(2, "3s", riichi=True)
+        self.discard(3, "6s")
+        self.discard(1, "ew")
+        table = self.index.get_safety(2)
+        self.assertEqual(table[t34("3s")], GENBUTSU)
+        self.assertEqual(table[t34("6s")], GENBUTSU)
+        self.assertEqual(table[t34("ew")], GENBUTSU)
+        self.assertEqual(table[t34("9p")], UNSAFE)
+        # 6s is suji of 3s
+        self.assertEqual(table[t34("9s")], SUJI)
+
+        danger = self.index.get_danger()
+        self.assertEqual(danger[t34("6s")], GENBUTSU)
+        self.assertEqual(danger[t34("5m")], UNSAFE)
+
+    def test_kabe(self):
+        # All four 8p: one discard, a pon of it and one in hand
+        self.discard(2, "8p", 0)
+        self.index.record(None, CallEvent(
+            Meld(Meld.PON, [tt("8p0"), tt("8p1"), tt("8p2")], 2, tt("8p0")), 3))
+        self.assertEqual(self.index.visible[t34("8p")], 3)
+        self.assertEqual(self.index.get_safety(1)[t34("9p")], UNSAFE)
+        hand34 = [0] * 34
+        hand34[t34("8p")] = 1
+        table = self.index.get_safety(1, hand34)
+        self.assertEqual(table[t34("9p")], KABE)
+        self.assertEqual(table[t34("7p")], UNSAFE)
+
+        # Honors with 3 visible
+        self.index.record(None, DoraEvent(tt("ww0")))
+        self.discard(1, "ww", 1)
+        self.discard(3, "ww", 2)
+        self.assertEqual(self.index.get_safety(2)[t34("ww")], KABE)
+
+    def test_added_kan(self):
+        meld = Meld(Meld.PON, [tt("5s0"), tt("5s1"), tt("5s2")], 1, tt("5s0"))
+        self.discard(1, "5s")
+        self.index.record(None, CallEvent(meld, 2))
+        meld = meld.clone()
+        meld.promote_to_akan(tt("5s3"))
+        self.index.record(None, CallEvent(meld, 2))
+        self.assertEqual(self.index.visible[t34("5s")], 4)
+        self.assertEqual(self.index.get_safety(3)[t34("6s")], UNSAFE)
+        self.assertEqual(self.index.get_safety(3)[t34("4s")], UNSAFE)
+
+    def test_new_round(self):
+        self.discard(1, "1m")
+        self.index.record(None, NewRoundEvent('E', 2, 0, [[]] * 4))
+        self.assertEqual(self.index.get_safety(1)[t34("1m")], UNSAFE)
+        self.assertEqual(sum(self.index.visible), 0)
+
+    def test_game(self):
+        # Fed every event of a simulated game, the genbutsu of each player
+        # covers everything they discarded this round
+        class Feed(object):
+            def __init__(self):
+                self.index = SafetyIndex(0)
+                self.discards = [set() for i in range(4)]
+            def record(self, player_idx, ev):
+                if player_idx not in (None, 0):
+                    return
+                self.index.record(player_idx, ev)
+                if isinstance(ev, NewRoundEvent):
+                    self.discards = [set() for i in range(4)]
+                elif isinstance(ev, DiscardEvent):
+                    self.discards[ev.player].add(ev.tile // 4)
+                    for opp in range(4):
+                        table = self.index.get_safety(opp)
+                        for k in self.discards[opp]:
+                            assert table[k] == GENBUTSU
+        Simulator([EfficiencyPolicy() for i in range(4)], seed=3, stats=Feed()).play_game()
+
+class BotPlayerTest(unittest.TestCase):
+    def setUp(self):
+        self.game = Game()
+        self.game.remaining_draws = 50
+        self.bot = BotPlayer(self.game, "Bot")
+        self.game.players = [self.bot] + [Player(self.game, "P{}".format(i)) for i in range(1, 4)]
+        for i, pl in enumerate(self.game.players):
+            pl.idx = i
+        self.bot.record(None, NewRoundEvent('E', 1, 0, [[]] * 4))
+
+    def deal(self, hand_str):
+        for t136 in tile34_string_to_136_array(hand_str):
+            self.bot.add_tile(t136)
+
+    def see(self, player, name, copy, riichi=False):
+        self.bot.record(None, DiscardEvent(tt(name + str(copy)), player, False, riichi))
+
+    def discard(self):
+        return self.bot.choose_discard(DiscardQuery(list(self.bot.hand), [])) // 4
+
+    def test_efficiency(self):
+        self.deal("1m2m3m4m5m6m7m8m9m5p5p3s4sew")
+        self.assertEqual(self.discard(), t34("ew"))
+
+    def test_remaining_tiles(self):
+        # 3s5s and 5s7s wait on one kind each, the one with more left is kept
+        self.deal("1m2m3m4m5m6m7m8m9m5p5p3s5s7s")
+        for copy in range(3):
+            self.see(1, "4s", copy)
+        self.assertEqual(self.discard(), t34("3s"))
+
+        self.setUp()
+        self.deal("1m2m3m4m5m6m7m8m9m5p5p3s5s7s")
+        for copy in range(3):
+            self.see(1, "6s", copy)
+        self.assertEqual(self.discard(), t34("7s"))
+
+    def test_fold(self):
+        self.deal("1m4m7m2p5p8p3s6s9sewswwwnwrd")
+        self.assertNotEqual(self.discard(), t34("5p"))
+        self.see(1, "5p", 1, riichi=True)
+        self.assertEqual(self.discard(), t34("5p"))
+
+    def test_riichi(self):
+        self.deal("1m2m3m4m5m6m7m8m9m5p5p3s5s7s")
+        waits = [Wait([tt("4s0") // 4], [True], False), Wait([tt("6s0") // 4], [True], False)]
+        query = RiichiQuery([tt("7s0"), tt("3s0")], waits)
+        for copy in range(3):
+            self.see(1, "6s", copy)
+        self.assertEqual(self.bot.choose_riichi(query), tt("7s0"))
+        # Every tile of both waits is visible
+        self.see(3, "6s", 3)
+        for copy in range(4):
+            self.see(2, "4s", copy)
+        self.assertIsNone(self.bot.choose_riichi(query))
+
+    def test_calls(self):
+        self.deal("1m2m5m6m7m2p3p4p8s8swdrdrd")
+        self.game.players[2].discards.append(Discard(tt("rd2")))
+        pon = CallQuery(CallQuery.PON, [[tt("rd0"), tt("rd1"), tt("rd2")]], 2, 0)
+        self.assertEqual(self.bot.choose_call(pon), [tt("rd0"), tt("rd1"), tt("rd2")])
+
+        # No yaku for a chi
+        self.game.players[3].discards.append(Discard(tt("3m0")))
+        chi = CallQuery(CallQuery.CHI, [[tt("1m0"), tt("2m0"), tt("3m0")]], 3, 0)
+        self.assertIsNone(self.bot.choose_call(chi))
+        # Unless there is a yakuhai pon already
+        self.bot.remove_tile(tt("rd0"))
+        self.bot.remove_tile(tt("rd1"))
+        self.bot.remove_tile(tt("8s1"))
+        self.bot.melds.append(Meld(Meld.PON, [tt("rd0"), tt("rd1"), tt("rd2")], 2, tt("rd2")))
+        self.assertEqual(self.bot.choose_call(chi), [tt("1m0"), tt("2m0"), tt("3m0")])
+
+    def test_game(self):
+        sim = Simulator([BotPolicy() for i in range(4)], seed=4)
+        self.assertEqual(sim.run(1).games, 1)
+
+    def test_act(self):
+        # Bots in every seat play a whole game by answering their own queries
+        game = Game(ShuffledWall(rng=random.Random(5)))
+        bots = [BotPlayer(game, "B{}".format(i)) for i in range(4)]
+        game.start_game(bots)
+        self.assertEqual(sorted(bot.safety.player_idx for bot in bots), [0, 1, 2, 3])
+        self.assertTrue(all(bot.safety.player_idx == bot.idx for bot in bots))
+        for i in range(10000):
+            for idx, ev in game.pop_events():
+                if isinstance(ev, GameOverEvent):
+                    return
+                for bot in bots:
+                    if idx is None or idx == bot.idx:
+                        bot.record(idx, ev.get_for_player(bot.idx))
+            if not any(bot.act() for bot in bots):
+                game.run_continuation()
+        self.fail("Game did not end")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,12 @@
 
-from engine import Game, Player, PreHandPlayer
+from engine import Game, Player, PreHandPlayer, Hand, get_shanten_and_ukeire, get_shanten34
+from engine import LRUCache, hand_value_cache, hand_config_key, FenwickTree, Wall, ShuffledWall, NoValidTilesError, WallError
+from engine import EventFanout, CallComputer, Lobby, LobbyError, InvalidActionError
+from engine import CallArbiter, CallQuery, RonQuery, DiscardQuery, Meld
+import copy
+import json
+import pickle
+from mahjong.shanten import Shanten
 from mahjong.tile import TilesConverter as tc
 import random
 from tile import tt
@@ -121,6 +128,663 @@ class DrawTest(unittest.TestCase):
         evs = g.pop_events()
         self.assertTrue(any(ev.name == 'draw_event' and ev.kind == 'wind' for ev in evs))
 
+class ShantenTest(unittest.TestCase):
+    def test_incremental_matches_full(self):
+        rng = random.Random(1)
+        shan = Shanten()
+        for i in range(20):
+            tiles = rng.sample(range(136), 14)
+            state = Hand(tiles[:13])
+            # Draw the last tile and discard a random one
+            state.append(tiles[13])
+            dropped = tiles.pop(rng.randrange(14))
+            state.remove(dropped)
+
+            tiles34 = tc.to_34_array(tiles)
+            expected = shan.calculate_shanten(tiles34)
+            uke = []
+            for t in range(34):
+                tiles34[t] += 1
+                if shan.calculate_shanten(tiles34) < expected:
+                    uke.append(t)
+                tiles34[t] -= 1
+            self.assertEqual(state.get_shanten_and_ukeire(), (expected, uke))
+
+    def test_discard_table(self):
+        rng = random.Random(2)
+        for i in range(10):
+            tiles = rng.sample(range(136), 14)
+            state = Hand(tiles)
+            table = state.get_discard_table()
+            self.assertEqual(sorted(table), sorted(set(t // 4 for t in tiles)))
+            for j, t136 in enumerate(tiles):
+                self.assertEqual(table[t136 // 4],
+                                 get_shanten_and_ukeire(tiles[:j] + tiles[j+1:]))
+
+    def test_any_size(self):
+        rng = random.Random(3)
+        shan = Shanten()
+        # Mostly one suit, for more interesting shapes
+        pool = [t for t in range(136) if t // 4 < 9 or rng.random() < 0.4]
+        for size in [14, 13, 11, 10, 8, 7, 5, 4, 2, 1]:
+            for i in range(30):
+                tiles34 = tc.to_34_array(rng.sample(pool, size))
+                # Chiitoitsu and kokushi only for closed hands
+                if size >= 13:
+                    expected = shan.calculate_shanten(tiles34)
+                else:
+                    expected = shan.calculate_shanten_for_regular_hand(tiles34)
+                self.assertEqual(get_shanten34(tiles34), expected, tiles34)
+
+    def test_special_hands(self):
+        chiitoi = Hand(tile.tile34_string_to_136_array("1m1m4m4m7p7p2s2s9s9sewswwd"))
+        self.assertEqual(chiitoi.get_shanten_and_ukeire()[0], 1)
+        kokushi = Hand(tile.tile34_string_to_136_array("1m9m1p9p1s9sewswwwnwwdgdrd"))
+        self.assertEqual(kokushi.get_shanten_and_ukeire(),
+                         (0, [0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]))
+
+    def test_no_fifth_tile(self):
+        # A fifth 2m would make 123m 222m, but all four are already held
+        hand = Hand(tile.tile34_string_to_136_array("1m1m2m2m2m2m3m3m5m7m8m9mrd"))
+        self.assertEqual(hand.get_shanten_and_ukeire(), (1, [0, 2, 3, 4, 5, 6, 33]))
+
+class HandTest(unittest.TestCase):
+    def check_counts(self, hand):
+        self.assertEqual(hand.tiles34, tc.to_34_array(hand))
+        self.assertEqual(hand.mask, sum(1 << t for t in hand))
+        self.assertEqual(sum(hand.tiles37), len(hand))
+        self.assertEqual(hand.tiles37[34], int(16 in hand))
+        self.assertEqual(hand.tiles37[4] + hand.tiles37[34], hand.tiles34[4])
+
+    def test_add_remove(self):
+        rng = random.Random(3)
+        for i in range(20):
+            tiles = rng.sample(range(136), 14)
+            hand = Hand(tiles[:13])
+            self.check_counts(hand)
+            hand.append(tiles[13])
+            hand.remove(tiles[rng.randrange(14)])
+            self.check_counts(hand)
+            first = hand[0]
+            self.assertEqual(hand.pop(0), first)
+            self.assertNotIn(first, hand)
+            self.check_counts(hand)
+            self.assertEqual([t for t in range(136) if t in hand], sorted(hand))
+
+    def test_invalid(self):
+        hand = Hand([0, 1, 2])
+        self.assertRaises(ValueError, hand.append, 1)
+        self.assertRaises(ValueError, hand.remove, 3)
+        self.assertRaises(TypeError, hand.__setitem__, 0, 3)
+        self.assertNotIn(None, hand)
+        self.assertNotIn(136, hand)
+        self.assertEqual(hand, [0, 1, 2])
+        self.assertEqual(type(hand[:]), list)
+
+    def test_pickle(self):
+        hand = Hand([16, 17, 40])
+        for copied in [pickle.loads(pickle.dumps(hand)), copy.deepcopy(hand)]:
+            self.assertEqual(copied, hand)
+            self.assertEqual(copied.tiles37, hand.tiles37)
+            self.assertEqual(copied.mask, hand.mask)
+
+class HandValueCacheTest(unittest.TestCase):
+    def test_lru(self):
+        c = LRUCache(2)
+        c.put("a", 1)
+        c.put("b", 2)
+        self.assertEqual(c.get("a"), 1)
+        c.put("c", 3)
+        # b was least recently used
+        self.assertIsNone(c.get("b"))
+        self.assertEqual(c.get("c"), 3)
+        self.assertEqual(c.stats(), {"hits": 2, "misses": 1, "size": 2, "maxsize": 2})
+
+    def test_check_win_is_cached(self):
+        g = Game()
+        p = PreHandPlayer(g, "A", "123m456p789s1122z")
+        g.wall.reset()
+        p.populate_initial_hand()
+        hand_value_cache.clear()
+        first = p.check_win(tt("nw1"), [tt("1m1")], g._get_base_hand_config())
+        # Another copy of the same tile is the same hand for the calculator
+        second = p.check_win(tt("nw2"), [tt("1m2")], g._get_base_hand_config())
+        self.assertEqual(hand_value_cache.hits, 1)
+        self.assertEqual(hand_value_cache.misses, 1)
+        self.assertEqual((first.han, first.fu, first.cost), (second.han, second.fu, second.cost))
+        # Each caller gets a copy
+        self.assertIsNot(first, second)
+        win = p.check_win(tt("ew1"), [tt("1m1")], g._get_base_hand_config())
+        win.cost["main"] = 0
+        win.yaku.clear()
+        again = p.check_win(tt("ew2"), [tt("1m2")], g._get_base_hand_config())
+        self.assertEqual(again.cost["main"], 2600)
+        self.assertEqual(len(again.yaku), 2)
+
+    def test_hand_config_key(self):
+        g = Game()
+        base = g._get_base_hand_config()
+        for field, value in [("is_open_riichi", True), ("paarenchan", 1), ("is_tsumo", True)]:
+            c = g._get_base_hand_config()
+            setattr(c, field, value)
+            self.assertNotEqual(hand_config_key(c), hand_config_key(base), field)
+        self.assertEqual(hand_config_key(g._get_base_hand_config()), hand_config_key(base))
+
+class WaitMaskTest(unittest.TestCase):
+    def test_wait_mask(self):
+        g = Game()
+        p = PreHandPlayer(g, "A", "123m456p789s1122z")
+        g.wall.reset()
+        p.populate_initial_hand()
+        p.calculate_shanten_and_ukeire()
+        self.assertTrue(p.is_waiting_on(tt("ew3")))
+        self.assertTrue(p.is_waiting_on(tt("sw0")))
+        self.assertFalse(p.is_waiting_on(tt("ww0")))
+        self.assertFalse(p.is_waiting_on(tt("1m0")))
+
+        # Not in tenpai after swapping a tile
+        p.remove_tile(tt("ew0"))
+        p.add_tile(tt("rd0"))
+        p.calculate_shanten_and_ukeire()
+        self.assertEqual(p.wait_mask, 0)
+
+class WallTest(unittest.TestCase):
+    def test_fenwick_find(self):
+        tree = FenwickTree([2, 0, 3, 1])
+        self.assertEqual(tree.total, 6)
+        self.assertEqual([tree.find(x) for x in range(6)], [0, 0, 2, 2, 2, 3])
+        tree.add(1, 2)
+        tree.add(2, -3)
+        self.assertEqual([tree.find(x) for x in range(5)], [0, 0, 1, 1, 3])
+
+    def test_draw_whole_wall(self):
+        w = Wall()
+        w.reset()
+        tiles = w.draw_many(136, [])
+        self.assertEqual(sorted(tiles), list(range(136)))
+        self.assertRaises(NoValidTilesError, w.draw, [])
+
+    def test_draw_with_prob_sets(self):
+        w = Wall()
+        w.reset()
+        only_man = [1.0]*9 + [0.0]*25 + [1.0, 0.0, 0.0]
+        tiles = w.draw_many(36, [only_man, [2.0]*37])
+        self.assertTrue(all(t // 4 < 9 for t in tiles))
+        self.assertRaises(NoValidTilesError, w.draw, [only_man])
+        # The unbiased draw still sees the rest of the wall
+        self.assertGreaterEqual(w.draw([]) // 4, 9)
+        w.replace_many(tiles)
+        self.assertEqual(sum(w.available), 135)
+
+    def test_weighted_trees_bounded(self):
+        w = Wall()
+        w.reset()
+        for i in range(Wall.MAX_WEIGHTED_TREES + 4):
+            weights = [1.0]*37
+            weights[i] = 2.0
+            w.draw([weights])
+        self.assertEqual(len(w.weighted), Wall.MAX_WEIGHTED_TREES)
+        self.assertEqual(sum(w.available), 136 - Wall.MAX_WEIGHTED_TREES - 4)
+
+class ShuffledWallTest(unittest.TestCase):
+    def test_layout(self):
+        w = ShuffledWall(rng=random.Random(1))
+        w.reset()
+        live = w.draw_many(122, [])
+        self.assertRaises(NoValidTilesError, w.draw, [])
+        rinshan = [w.draw([], 'deadwall') for i in range(4)]
+        self.assertRaises(NoValidTilesError, w.draw, [], 'deadwall')
+        dora = [w.draw([], 'dora') for i in range(5)]
+        ura = [w.draw([], 'uradora') for i in range(5)]
+        self.assertEqual(sorted(live + rinshan + dora + ura), list(range(136)))
+        self.assertEqual(dora, w.tiles[126::2])
+        self.assertEqual(ura, w.tiles[127::2])
+        self.assertEqual(sum(w.available), 0)
+
+    def test_reproducible(self):
+        a = ShuffledWall(rng=random.Random(5))
+        b = ShuffledWall(rng=random.Random(5))
+        a.reset()
+        b.reset()
+        self.assertEqual(a.draw_many(20, []), b.draw_many(20, []))
+        # Any round can be replayed from its round seed
+        a.reset()
+        tiles = a.draw_many(20, [])
+        b.reset(a.round_seed)
+        self.assertEqual(b.draw_many(20, []), tiles)
+
+    def test_take_and_prob_sets(self):
+        w = ShuffledWall(rng=random.Random(2))
+        w.reset()
+        self.assertEqual(w.take(tt("rd1")) // 4, tt("rd0") // 4)
+        only_pin = [0.0]*9 + [1.0]*9 + [0.0]*19
+        for i in range(5):
+            self.assertEqual(w.draw([only_pin]) // 4 // 9, 1)
+        self.assertEqual(w.live_pos, 6)
+        # The wall still holds every tile exactly once
+        self.assertEqual(sorted(w.tiles), list(range(136)))
+
+    def test_replace(self):
+        w = ShuffledWall(rng=random.Random(3))
+        w.reset()
+        order = w.tiles[:]
+        live = w.draw_many(3, [])
+        rinshan = w.draw([], 'deadwall')
+        dora = w.draw([], 'dora')
+        # Out of order, or never drawn
+        self.assertRaises(WallError, w.replace, live[0])
+        self.assertRaises(WallError, w.replace, w.tiles[w.live_pos])
+        # Each tile goes back where it came from
+        w.replace(dora)
+        w.replace(rinshan)
+        w.replace_many(reversed(live))
+        self.assertEqual(w.tiles, order)
+        self.assertEqual((w.live_pos, sum(w.available)), (0, 136))
+        self.assertEqual(w.draw([], 'deadwall'), rinshan)
+        self.assertEqual(w.draw([], 'dora'), dora)
+
+    def test_draw_many_rollback(self):
+        w = ShuffledWall(rng=random.Random(4))
+        w.reset()
+        only_honors = [0.0]*27 + [1.0]*7 + [0.0]*3
+        self.assertRaises(NoValidTilesError, w.draw_many, 29, [only_honors])
+        self.assertEqual((w.live_pos, sum(w.available)), (0, 136))
+        self.assertEqual(sorted(w.tiles), list(range(136)))
+        # The live wall is drawn from the front again
+        self.assertEqual(w.draw_many(3, []), w.tiles[:3])
+
+    def test_game_is_reproducible(self):
+        def play(seed):
+            g = Game(ShuffledWall(rng=random.Random(seed)))
+            g.start_game([Player(g, n) for n in "ABCD"], False)
+            log = []
+            for i in range(16):
+                evs = g.pop_events()
+                log.extend(evs)
+                discards = [(pl, ev) for pl, ev in evs if ev.name == 'discard_query']
+                if not discards:
+                    g.run_continuation()
+                    continue
+                pl, q = discards[0]
+                g.discard_tile(pl, q.allowed[-1])
+            return repr(log), [p.hand for p in g.players]
+        self.assertEqual(play(3), play(3))
+
+class CallComputerTest(unittest.TestCase):
+    def test_pon_and_chi(self):
+        cc = CallComputer()
+        # 0 is the red five
+        hand = Hand([tt("5m0"), tt("5m1"), tt("4m0"), tt("7m0"), tt("6m0")])
+        self.assertEqual(cc.get_pon_sets(tt("5m2"), hand), [[tt("5m1"), tt("5m0")]])
+        self.assertEqual(cc.get_pon_sets(tt("4m1"), hand), [])
+        self.assertEqual(cc.get_chi_sets(tt("5m2"), hand),
+                         [[tt("4m0"), tt("6m0")], [tt("6m0"), tt("7m0")]])
+        hand = [tt("5m0"), tt("5m1"), tt("6m0"), tt("3m0")]
+        self.assertEqual(cc.get_chi_sets(tt("4m1"), hand), [
+            [tt("3m0"), tt("5m1")], [tt("3m0"), tt("5m0")],
+            [tt("5m1"), tt("6m0")], [tt("6m0"), tt("5m0")]])
+        self.assertEqual(cc.get_chi_sets(tt("ew0"), [tt("ew1"), tt("ew2")]), [])
+
+    def test_no_red_five(self):
+        cc = CallComputer(False)
+        hand = Hand([tt("5m0"), tt("5m1"), tt("6m0")])
+        self.assertEqual(cc.get_pon_sets(tt("5m2"), hand), [[tt("5m0"), tt("5m1")]])
+        self.assertEqual(cc.get_chi_sets(tt("4m1"), hand), [[tt("5m0"), tt("6m0")]])
+
+class ReactionTest(unittest.TestCase):
+    def test_reaction_index(self):
+        g = Game()
+        p = Player(g, "A")
+        for t136 in [tt("3m0"), tt("4m0"), tt("9p0"), tt("9p1"), tt("9p2"), tt("ew0")]:
+            p.add_tile(t136)
+        index = p.get_reaction_index()
+        self.assertEqual(index[tt("2m0")//4], Player.REACT_CHI)
+        self.assertEqual(index[tt("5m0")//4], Player.REACT_CHI)
+        self.assertEqual(index[tt("6m0")//4], 0)
+        self.assertEqual(index[tt("9p0")//4], Player.REACT_PON | Player.REACT_KAN)
+        self.assertEqual(index[tt("8p0")//4], 0)
+        self.assertEqual(index[tt("ew0")//4], 0)
+        p.add_tile(tt("ew1"))
+        self.assertEqual(p.get_reaction_index()[tt("ew0")//4], Player.REACT_PON)
+        p.wait_mask = 1 << (tt("1s0")//4)
+        p.reaction_index = None
+        self.assertEqual(p.get_reaction_index()[tt("1s0")//4], Player.REACT_RON)
+
+    def test_scan_matches_call_computer(self):
+        g = Game(ShuffledWall(rng=random.Random(4)))
+        g.start_game([Player(g, n) for n in "ABCD"], False)
+        cc = CallComputer()
+        checked = 0
+        for i in range(60):
+            evs = g.pop_events()
+            discards = [(pl, ev) for pl, ev in evs if ev.name == 'discard_query']
+            if not discards:
+                g.run_continuation()
+                continue
+            pl, q = discards[0]
+            g.discard_tile(pl, q.allowed[-1])
+            if g.remaining_draws == 0:
+                break
+            disc136 = g.players[pl].discards[-1].tile
+            calls = [(idx, ev.kind, ev.choices) for idx, ev in g.pending_events
+                     if ev.name == 'call_query']
+            expected = []
+            for other in g.players:
+                if other.idx == pl:
+                    continue
+                if other.hand.tiles34[disc136//4] == 3:
+                    expected.append((other.idx, 'kan', [[disc136//4*4 + j for j in range(4)]]))
+                pons = cc.get_pon_sets(disc136, other.hand)
+                if pons:
+                    expected.append((other.idx, 'pon', [p + [disc136] for p in pons]))
+                chis = cc.get_chi_sets(disc136, other.hand)
+                if chis and other.idx == (pl + 1) % 4:
+                    expected.append((other.idx, 'chi', [p + [disc136] for p in chis]))
+            self.assertEqual(calls, expected)
+            checked += len(calls)
+        self.assertGreater(checked, 0)
+
+class SnapshotTest(unittest.TestCase):
+    def step(self, g, pick):
+        # Play one action, picking the discard with pick(allowed)
+        evs = g.pop_events()
+        for pl, ev in evs:
+            if ev.name == 'discard_query':
+                g.discard_tile(pl, pick(ev.allowed))
+                return evs
+        g.run_continuation()
+        return evs
+
+    def state(self, g):
+        return repr((
+            g.wind, g.round, g.bonus, g.active_player, g.remaining_draws,
+            g.dora_indicators, g.pending_events,
+            [(p.points, sorted(p.hand), p.hand.tiles37, p.hand.mask, p.discards,
+              p.melds, p.shanten, p.is_riichi) for p in g.players],
+            g.wall.available, g.wall.counts.tree))
+
+    def play(self, g, n, pick):
+        return [repr(self.step(g, pick)) + self.state(g) for i in range(n)]
+
+    def check_rollback(self, g):
+        for i in range(20):
+            self.step(g, lambda allowed: allowed[-1])
+        snap = g.snapshot()
+        before = self.state(g)
+        first = self.play(g, 60, lambda allowed: allowed[-1])
+        # A different branch, then back to the first one twice
+        g.restore(snap)
+        self.assertEqual(self.state(g), before)
+        self.play(g, 60, lambda allowed: allowed[0])
+        for i in range(2):
+            g.restore(snap)
+            self.assertEqual(self.play(g, 60, lambda allowed: allowed[-1]), first)
+
+    def test_shuffled_wall(self):
+        g = Game(ShuffledWall(rng=random.Random(6)))
+        g.start_game([Player(g, n) for n in "ABCD"], False)
+        self.check_rollback(g)
+
+    def test_random_wall(self):
+        # Every draw uses the rng, so its state has to be rolled back too
+        g = Game(Wall(rng=random.Random(7)))
+        g.start_game([Player(g, n) for n in "ABCD"], False)
+        self.check_rollback(g)
+
+    def test_calls_are_not_shared(self):
+        g = Game(ShuffledWall(rng=random.Random(8)))
+        g.start_game([Player(g, n) for n in "ABCD"], False)
+        # Play until someone can pon, then take the pon in a branch
+        for i in range(200):
+            pons = [(pl, ev) for pl, ev in g.pending_events
+                    if ev.name == 'call_query' and ev.kind == 'pon']
+            if pons:
+                break
+            self.step(g, lambda allowed: allowed[-1])
+        self.assertTrue(pons)
+        snap = g.snapshot()
+        before = self.state(g)
+        pl, q = pons[0]
+        discarder = g.players[q.from_who]
+        g.call_pon(q.choices[0], pl, q.from_who)
+        self.assertEqual(discarder.discards[-1].called, pl)
+        g.restore(snap)
+        self.assertIsNone(discarder.discards[-1].called)
+        self.assertEqual(self.state(g), before)
+
+class FanoutTest(unittest.TestCase):
+    def test_frames(self):
+        g = Game(ShuffledWall(rng=random.Random(1)))
+        g.start_game([Player(g, n) for n in "ABCD"], False)
+        fanout = EventFanout(4)
+        frames = [json.loads(f) for f in fanout.encode(g.pop_events())]
+
+        # new game, 4 hands, dora, drawn and hidden tile, discard query
+        self.assertEqual(fanout.encode_count, 9)
+        for i, frame in enumerate(frames):
+            names = [ev["name"] for ev in frame]
+            self.assertEqual(names[:4], ["ev_new_game", "ev_new_round", "ev_dora", "ev_tile"])
+            self.assertEqual(frame[1]["hand"], g.players[i].hand[:13])
+            self.assertNotIn("hands", frame[1])
+            if i == g.dealer():
+                self.assertEqual(frame[3]["tile"], g.players[i].latest_draw)
+                self.assertEqual(names[-1], "discard_query")
+            else:
+                self.assertIsNone(frame[3]["tile"])
+                self.assertNotIn("discard_query", names)
+
+class ResumeTest(unittest.TestCase):
+    def make_game(self):
+        g = Game(ShuffledWall(rng=random.Random(3)))
+        g.start_game([Player(g, n) for n in "ABCD"], False)
+        g.pop_events()
+        return g
+
+    def test_open_queries(self):
+        g = self.make_game()
+        dealer = g.players[g.dealer()]
+        (idx, query), = [(idx, q) for idx, q in g.open_queries if q.name == 'discard_query']
+        self.assertEqual(idx, dealer.idx)
+
+        # Failed actions leave the queries open
+        self.assertRaises(InvalidActionError, g.discard_tile, (dealer.idx + 1) % 4,
+                          g.players[(dealer.idx + 1) % 4].hand[0])
+        self.assertIn((idx, query), g.open_queries)
+
+        snap = g.snapshot()
+        g.discard_tile(dealer.idx, query.allowed[-1])
+        self.assertNotIn((idx, query), g.open_queries)
+        g.run_continuation()
+        active = g.active_player
+        self.assertEqual([(i, q.name) for i, q in g.open_queries if q.name == 'discard_query'],
+                         [(active, 'discard_query')])
+        g.restore(snap)
+        self.assertIn((idx, query), g.open_queries)
+
+    def test_view(self):
+        g = self.make_game()
+        dealer = g.dealer()
+        g.discard_tile(dealer, g.players[dealer].hand[0])
+        g.run_continuation()
+        for i in range(4):
+            view = json.loads(g.get_resume_view(i).encode())
+            self.assertEqual(view["name"], "ev_resume")
+            self.assertEqual(view["seat"], i)
+            self.assertEqual(view["hand"], list(g.players[i].hand))
+            self.assertEqual(view["hand_sizes"], [len(p.hand) for p in g.players])
+            self.assertEqual(view["dora"], g.dora_indicators)
+            self.assertEqual(view["discards"][dealer][0]["tile"], g.players[dealer].discards[0].tile)
+            self.assertEqual(view["active_player"], g.active_player)
+            names = [q["name"] for q in view["queries"]]
+            self.assertEqual("discard_query" in names, i == g.active_player)
+            self.assertNotIn("hands", view)
+            self.assertLess(len(g.get_resume_view(i).encode()), 2048)
+
+    def test_auto_answer(self):
+        g = self.make_game()
+        dealer = g.players[g.dealer()]
+        drawn = dealer.latest_draw
+        g.auto_answer()
+        self.assertEqual(dealer.discards[-1].tile, drawn)
+        events = g.pop_events()
+        if g.continuation is not None:
+            # Calls or ron on the discard are passed
+            self.assertTrue(all(q.optional for idx, q in g.open_queries))
+            g.auto_answer()
+            events = g.pop_events()
+        self.assertIn('discard_query', [ev.name for idx, ev in events])
+        self.assertEqual([idx for idx, q in g.open_queries if q.name == 'discard_query'],
+                         [g.active_player])
+
+class ArbiterTest(unittest.TestCase):
+    class StubGame(object):
+        # Records the actions the arbiter makes
+        def __init__(self, queries):
+            self.open_queries = queries
+            self.made = []
+        def __getattr__(self, name):
+            return lambda *args: self.made.append((name,) + args)
+
+    # P0 discarded 3m. P1 can chi, P2 can pon and P3 can ron.
+    CHI = CallQuery(CallQuery.CHI, [[4, 8, 0]], 0, 5)
+    PON = CallQuery(CallQuery.PON, [[1, 2, 0]], 0, 5)
+
+    def arbiter(self, *queries):
+        game = self.StubGame(list(queries))
+        return game, CallArbiter(game)
+
+    def test_pon_beats_chi(self):
+        game, arb = self.arbiter((1, self.CHI), (2, self.PON))
+        self.assertFalse(arb.answer(1, 'call_chi', [0, 4, 8]))
+        self.assertEqual(arb.pending(), [2])
+        self.assertTrue(arb.answer(2, 'call_pon', [0, 1, 2]))
+        arb.resolve()
+        self.assertEqual(game.made, [('call_pon', [0, 1, 2], 2, 0)])
+
+    def test_no_wait_for_lower(self):
+        game, arb = self.arbiter((1, self.CHI), (2, self.PON))
+        self.assertTrue(arb.answer(2, 'call_pon', [2, 1, 0]))
+        arb.resolve()
+        self.assertEqual(game.made, [('call_pon', [2, 1, 0], 2, 0)])
+
+    def test_pass(self):
+        game, arb = self.arbiter((1, self.CHI), (2, self.PON))
+        self.assertFalse(arb.answer(1, 'call_chi', [0, 4, 8]))
+        self.assertTrue(arb.answer(2))
+        arb.resolve()
+        self.assertEqual(game.made, [('call_chi', [0, 4, 8], 1, 0)])
+
+        game, arb = self.arbiter((1, self.CHI), (2, self.PON))
+        arb.answer(2)
+        self.assertTrue(arb.answer(1))
+        arb.resolve()
+        self.assertEqual(game.made, [('run_continuation',)])
+
+    def test_ron(self):
+        game, arb = self.arbiter((1, self.CHI), (2, self.PON), (2, RonQuery(0)), (3, RonQuery(0)))
+        self.assertFalse(arb.answer(2, 'call_pon', [0, 1, 2]))
+        # P1 can only chi, so there is no need to wait for them
+        self.assertTrue(arb.answer(3, 'do_ron'))
+        arb.resolve()
+        self.assertEqual(game.made, [('do_ron', [3], 0, None)])
+
+        # Every ron goes through, in turn order
+        game, arb = self.arbiter((2, RonQuery(0)), (3, RonQuery(0)), (1, self.CHI))
+        self.assertFalse(arb.answer(3, 'do_ron'))
+        self.assertTrue(arb.answer(2, 'do_ron'))
+        arb.resolve()
+        self.assertEqual(game.made, [('do_ron', [2, 3], 0, None)])
+
+    def test_chankan(self):
+        # The robbed tile comes from the query, whatever the answer says
+        game, arb = self.arbiter((2, RonQuery(0, 16)), (3, RonQuery(0, 16)))
+        arb.answer(2, 'do_ron', 99)
+        self.assertTrue(arb.answer(3, 'do_ron'))
+        arb.resolve()
+        self.assertEqual(game.made, [('do_ron', [2, 3], 0, 16)])
+
+        # The tile is checked against the kan of the same kind
+        g = Game(ShuffledWall(rng=random.Random(1)))
+        g.start_game([Player(g, n) for n in "ABCD"], False)
+        g.players[0].melds.append(Meld(Meld.AKAN, [tt("5s1"), tt("5s2"), tt("5s3"), tt("5s0")], 1, tt("5s1")))
+        self.assertRaisesRegex(InvalidActionError, "has no", g.do_ron, [1], 0, tt("6s0"))
+        self.assertRaisesRegex(InvalidActionError, "can't ron", g.do_ron, [1], 0, tt("5s0"))
+
+    def test_closer_pon_wins(self):
+        # P2 and P3 both hold a pair of the discard
+        pon3 = CallQuery(CallQuery.PON, [[1, 3, 0]], 0, 5)
+        game, arb = self.arbiter((3, pon3), (2, self.PON))
+        self.assertFalse(arb.answer(3, 'call_pon', [0, 1, 3]))
+        self.assertTrue(arb.answer(2, 'call_pon', [0, 1, 2]))
+        arb.resolve()
+        self.assertEqual(game.made, [('call_pon', [0, 1, 2], 2, 0)])
+
+    def test_invalid(self):
+        game, arb = self.arbiter((1, self.CHI), (2, self.PON), (1, DiscardQuery([5], [None])))
+        self.assertRaises(InvalidActionError, arb.answer, 0, 'call_pon', [0, 1, 2])
+        self.assertRaises(InvalidActionError, arb.answer, 1, 'call_pon', [0, 1, 2])
+        self.assertRaises(InvalidActionError, arb.answer, 1, 'call_chi', [0, 4, 12])
+        arb.answer(1)
+        self.assertRaises(InvalidActionError, arb.answer, 1, 'call_chi', [0, 4, 8])
+
+    def test_game(self):
+        # Answering every call on a real game
+        g = Game(ShuffledWall(rng=random.Random(4)))
+        g.start_game([Player(g, n) for n in "ABCD"], False)
+        answered = 0
+        while g.remaining_draws > 0 and answered < 3:
+            g.pop_events()
+            callers = set(idx for idx, q in g.open_queries
+                          if q.name in ('call_query', 'ron_query') and idx != g.active_player)
+            if callers and not any(q.name == 'discard_query' for idx, q in g.open_queries):
+                for idx in sorted(callers):
+                    g.answer_call(idx)
+                answered += 1
+                self.assertIsNone(g.arbiter)
+                self.assertIn('discard_query', [q.name for idx, q in g.open_queries])
+            else:
+                g.auto_answer()
+        self.assertEqual(answered, 3)
+
+class LobbyTest(unittest.TestCase):
+    class Room(object):
+        def __init__(self, code):
+            self.code = code
+
+    class Client(object):
+        def __init__(self, sid):
+            self.sid = sid
+
+    def test_codes(self):
+        lobby = Lobby(range(100, 110), random.Random(1))
+        rooms = [lobby.open_room(self.Room) for i in range(10)]
+        codes = [r.code for r in rooms]
+        self.assertEqual(sorted(codes), [str(c) for c in range(100, 110)])
+        self.assertNotEqual(codes, sorted(codes))
+        self.assertRaises(LobbyError, lobby.open_room, self.Room)
+        for r in rooms:
+            self.assertIs(lobby.get_room(r.code), r)
+
+        lobby.close_room(codes[3])
+        self.assertIsNone(lobby.get_room(codes[3]))
+        self.assertEqual(lobby.open_room(self.Room).code, codes[3])
+
+        for code in codes[:5]:
+            lobby.close_room(code)
+        reopened = [lobby.open_room(self.Room).code for i in range(5)]
+        self.assertEqual(sorted(reopened), sorted(codes[:5]))
+        self.assertEqual(len(lobby.rooms), 10)
+
+    def test_players(self):
+        lobby = Lobby(range(10))
+        a = self.Client("a")
+        lobby.add_player(a)
+        self.assertIs(lobby.get_player("a"), a)
+        self.assertRaises(LobbyError, lobby.add_player, self.Client("a"))
+        self.assertIs(lobby.remove_player("a"), a)
+        self.assertIsNone(lobby.get_player("a"))
+        self.assertIsNone(lobby.remove_player("a"))
+
 class EngineTest(unittest.TestCase):
     def test_start_game(self):
         g = TestGame([
@@ -0,0 +1,76 @@
+from engine import (Game, Player, ShuffledWall, DiscardEvent, NewRoundEvent, TileEvent,
+                    Meld, Discard, Wait, Win)
+from eventlog import EventLog, EventLogError, encode_events, decode_events
+from sim import Simulator, EfficiencyPolicy, RandomPolicy
+import random
+import unittest
+
+class Recorder(object):
+    # Stands in for SimStats to collect every event of a simulated game
+    def __init__(self):
+        self.events = []
+
+    def record(self, player_idx, ev):
+        self.events.append((player_idx, ev))
+
+class EventLogTest(unittest.TestCase):
+    def assertSameEvents(self, decoded, events):
+        self.assertEqual(len(decoded), len(events))
+        for (idx, ev), (dec_idx, dec) in zip(events, decoded):
+            self.assertEqual(dec_idx, idx)
+            self.assertIs(type(dec), type(ev))
+            self.assertEqual(dec.encode(), ev.encode())
+
+    def test_full_game(self):
+        recorder = Recorder()
+        policies = [EfficiencyPolicy(), RandomPolicy(random.Random(1), 0.5),
+                    EfficiencyPolicy(), RandomPolicy(random.Random(2), 0.5)]
+        Simulator(policies, seed=5, stats=recorder).play_game()
+        events = recorder.events
+        names = set(ev.name for idx, ev in events)
+        for name in ["ev_new_round", "ev_call", "ev_draw", "ev_game_over", "call_query"]:
+            self.assertIn(name, names)
+
+        data = encode_events(events)
+        self.assertSameEvents(decode_events(data), events)
+        # A few bytes per event
+        self.assertLess(len(data), 16 * len(events))
+
+    def test_game_log(self):
+        log = EventLog()
+        g = Game(ShuffledWall(rng=random.Random(2)), log)
+        g.start_game([Player(g, n) for n in "ABCD"], False)
+        events = g.pop_events()
+        self.assertEqual(len(log), len(events))
+        self.assertSameEvents(list(log), events)
+        # Views of decoded events work like the originals
+        dec = list(log)
+        self.assertEqual(dec[1][1].get_for_player(2).encode(),
+                         events[1][1].get_for_player(2).encode())
+
+    def test_views_per_event(self):
+        events = [(None, NewRoundEvent('E', 1, 0, [[0, 1], [2, 3], [4, 5], [6, 7]])),
+                  (None, TileEvent(8, 0)),
+                  (None, NewRoundEvent('E', 2, 0, [[9, 10], [11, 12], [13, 14], [15, 16]])),
+                  (None, TileEvent(17, 1))]
+        dec = decode_events(encode_events(events))
+        for player_idx in range(4):
+            for (idx, ev), (dec_idx, dec_ev) in zip(events, dec):
+                self.assertEqual(dec_ev.get_for_player(player_idx).encode(),
+                                 ev.get_for_player(player_idx).encode())
+        self.assertEqual(dec[2][1].get_for_player(1).hand, [11, 12])
+        self.assertIsNot(dec[1][1].get_for_player(2), dec[3][1].get_for_player(2))
+
+    def test_errors(self):
+        self.assertRaises(EventLogError, decode_events, b"XXXX\x01")
+        data = encode_events([(0, DiscardEvent(5, 0, True))])
+        self.assertRaises(EventLogError, decode_events, data[:-1])
+
+    def test_slots(self):
+        for obj in [DiscardEvent(5, 0, True), Meld(Meld.PON, [0, 1, 2], 1, 2),
+                    Discard(5), Wait([1], [True], False),
+                    Win(0, [], None, [], [], [], 1, 30, [], "", 1000, [])]:
+            self.assertFalse(hasattr(obj, "__dict__"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+from replay import GameRecord, Replayer, ReplayError
+from sim import Simulator, EfficiencyPolicy, RandomPolicy
+import random
+import unittest
+
+class Recorder(object):
+    # Stands in for SimStats to collect every event of a simulated game
+    def __init__(self):
+        self.events = []
+
+    def record(self, player_idx, ev):
+        self.events.append((player_idx, ev))
+
+def state(game):
+    return repr((
+        game.wind, game.round, game.bonus, game.active_player,
+        game.remaining_draws, game.dora_indicators, game.pending_events,
+        [(p.points, p.hand, p.discards, p.melds) for p in game.players]))
+
+class ReplayTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.recorder = Recorder()
+        policies = [EfficiencyPolicy(), RandomPolicy(random.Random(1), 0.5),
+                    EfficiencyPolicy(), RandomPolicy(random.Random(2), 0.5)]
+        sim = Simulator(policies, seed=11, stats=cls.recorder, record=True)
+        sim.play_game()
+        cls.record = sim.records[0]
+
+    def test_encode(self):
+        data = self.record.encode()
+        decoded = GameRecord.decode(data)
+        self.assertEqual(decoded.seed, self.record.seed)
+        self.assertEqual(decoded.player_names, self.record.player_names)
+        self.assertEqual(decoded.rounds, self.record.rounds)
+        self.assertEqual(decoded.actions,
+                         [(name, tuple(args)) for name, args in self.record.actions])
+        self.assertLess(len(data), 8 * len(self.record.actions))
+        self.assertRaises(ReplayError, GameRecord.decode, data[:-1])
+
+    def test_replay_events(self):
+        replayer = Replayer(GameRecord.decode(self.record.encode()))
+        events = replayer.game.pop_events()
+        for i in range(len(replayer)):
+            replayer.step()
+            events.extend(replayer.game.pending_events)
+        self.assertEqual(repr(events), repr(self.recorder.events))
+
+    def test_seek(self):
+        replayer = Replayer(self.record, checkpoint_interval=16)
+        n = len(replayer)
+        for pos in [n // 2, 10, n, 40, 41, 16, 0, n - 1]:
+            linear = Replayer(self.record, checkpoint_interval=n + 1)
+            self.assertEqual(state(replayer.seek(pos)), state(linear.seek(pos)))
+            self.assertEqual(replayer.position, pos)
+        self.assertRaises(ReplayError, replayer.seek, n + 1)
+
+    def test_seek_turn(self):
+        replayer = Replayer(self.record)
+        wind, round, bonus, start = self.record.rounds[1]
+        game = replayer.seek_turn(wind, round, bonus, 0)
+        self.assertEqual(replayer.position, start)
+        self.assertIn('ev_new_round', [ev.name for pl, ev in game.pending_events])
+
+        game = replayer.seek_turn(wind, round, bonus, 7)
+        self.assertEqual(sum(len(p.discards) for p in game.players), 7)
+        self.assertEqual(self.record.actions[replayer.position - 1][0], 'discard_tile')
+        self.assertRaises(ReplayError, replayer.seek_turn, wind, round, bonus, 500)
+        self.assertRaises(ReplayError, replayer.seek_turn, 'N', 4, 9, 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+from shard import Hub, MemoryBus, ShardError, ShardManager, UnixBus, shard_for
+import asyncio
+import os
+import socketio
+import tempfile
+import unittest
+
+class ShardTest(unittest.IsolatedAsyncioTestCase):
+    async def make_shards(self, bus, count=2):
+        self.routed = [[] for i in range(count)]
+        self.sent = [[] for i in range(count)]
+        servers = []
+        for i in range(count):
+            async def on_route(event, sid, *args, i=i):
+                self.routed[i].append((event, sid) + args)
+            sio = socketio.AsyncServer(
+                async_mode='asgi', client_manager=ShardManager(i, count, bus, on_route))
+            async def send(eio_sid, pkt, i=i):
+                self.sent[i].append((eio_sid, pkt.data))
+            sio._send_eio_packet = send
+            sio.manager.initialize()
+            self.addCleanup(sio.manager.thread.cancel)
+            servers.append(sio)
+        return servers
+
+    async def settle(self):
+        for i in range(20):
+            await asyncio.sleep(0)
+
+    async def check_shards(self, bus):
+        a, b = await self.make_shards(bus)
+        sid = await b.manager.connect("eio1", "/")
+        await self.settle()
+
+        await a.emit("hello", "there", to=sid)
+        await self.settle()
+        self.assertEqual(len(self.sent[1]), 1)
+        self.assertIn("hello", self.sent[1][0][1])
+        self.assertEqual(self.sent[0], [])
+
+        await a.enter_room(sid, "12345")
+        await self.settle()
+        await a.emit("room_update", {}, to="12345")
+        await self.settle()
+        self.assertEqual(len(self.sent[1]), 2)
+
+        await a.manager.route(1, "room_join", sid, 0, "12345", "Name")
+        await a.manager.route(1, "room_leave", sid)
+        await self.settle()
+        self.assertEqual(self.routed, [[], [
+            ("room_join", sid, 0, "12345", "Name"), ("room_leave", sid)]])
+
+    async def test_memory_bus(self):
+        await self.check_shards(MemoryBus())
+
+    async def test_unix_bus(self):
+        path = os.path.join(tempfile.mkdtemp(), "hub.sock")
+        hub = Hub(path)
+        await hub.start()
+        self.addAsyncCleanup(hub.close)
+        bus = UnixBus(path)
+        a, b = await self.make_shards(bus)
+        # Wait for both shards to connect to the hub
+        for i in range(100):
+            if len(hub.writers) == 2:
+                break
+            await asyncio.sleep(0.01)
+        sid = await b.manager.connect("eio1", "/")
+        await a.manager.route(1, "room_leave", sid)
+        await a.emit("hello", "there", to=sid)
+        for i in range(100):
+            if self.routed[1] and self.sent[1]:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.routed, [[], [("room_leave", sid)]])
+        self.assertEqual(len(self.sent[1]), 1)
+
+    def test_shard_for(self):
+        self.assertEqual(shard_for("12345", 4), 1)
+        self.assertEqual(shard_for("12345", 1), 0)
+        self.assertRaises(ShardError, shard_for, "abc", 4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+from sim import Simulator, EfficiencyPolicy, SimulationError, SimStats, make_policies, Policy
+from farm import Farm, shard_seed
+import unittest
+
+
+class CountingPolicy(EfficiencyPolicy):
+    def __init__(self):
+        self.asked = {}
+
+    def _count(self, name):
+        self.asked[name] = self.asked.get(name, 0) + 1
+
+    def discard(self, game, player_idx, query):
+        self._count('discard')
+        assert query.name == 'discard_query'
+        return super().discard(game, player_idx, query)
+
+    def call(self, game, player_idx, query):
+        self._count('call')
+        assert query.name == 'call_query'
+        return None
+
+class SimulatorTest(unittest.TestCase):
+    def test_play_game(self):
+        policies = [CountingPolicy() for i in range(4)]
+        sim = Simulator(policies, seed=1)
+        report = sim.run(1)
+        self.assertEqual(report.games, 1)
+        self.assertGreater(report.rounds, 0)
+        self.assertGreater(report.phase_count['discard'], 0)
+        # Riichi discards are answered by the riichi query instead
+        self.assertLessEqual(sum(p.asked['discard'] for p in policies),
+                             report.phase_count['discard'])
+        self.assertIn("games/s", str(report))
+
+    def test_seeded_policies(self):
+        def draws(seed):
+            return [p.rng.random() for p in make_policies('random', seed)]
+        self.assertEqual(draws(5), draws(5))
+        self.assertNotEqual(draws(5), draws(6))
+        self.assertEqual(len(set(draws(5))), 4)
+        self.assertIsInstance(make_policies('tsumogiri', 5)[0], Policy)
+
+    def test_stuck_game(self):
+        sim = Simulator(seed=1, max_rounds=0)
+        self.assertRaises(SimulationError, sim.play_game)
+
+    def test_aborted_games(self):
+        sim = Simulator(seed=1, max_rounds=0)
+        report = sim.run(2)
+        self.assertEqual(report.games, 0)
+        self.assertEqual(len(report.aborted), 2)
+        self.assertIn("2 games aborted", str(report))
+
+        # An aborted game can be played again from its seed
+        again = Simulator(seed=1, max_rounds=0)
+        self.assertRaises(SimulationError, again.play_game, report.aborted[1])
+        self.assertEqual(again.report.rounds * 2, report.rounds)
+
+class StatsTest(unittest.TestCase):
+    def test_stats(self):
+        stats = SimStats()
+        sim = Simulator(seed=2, stats=stats)
+        sim.run(1)
+        self.assertEqual(stats.games, 1)
+        self.assertEqual(stats.rounds, sim.report.rounds)
+        self.assertEqual(sum(stats.wins_by_seat), stats.tsumo + stats.ron)
+        self.assertEqual(sum(stats.final_points.values()), 4)
+
+        merged = SimStats()
+        merged.merge(stats.to_record())
+        merged.merge(stats.to_record())
+        self.assertEqual(merged.rounds, stats.rounds * 2)
+        self.assertEqual(merged.draws, {k: n * 2 for k, n in stats.draws.items()})
+
+    def test_farm(self):
+        stats, report = Farm(workers=2, seed=3, shard_size=1).run(2)
+        self.assertEqual(stats.games, 2)
+        self.assertEqual(report.games, 2)
+        self.assertEqual(stats.rounds, report.rounds)
+
+    def test_farm_aborted(self):
+        stats, report = Farm(workers=2, seed=3, shard_size=1, max_rounds=0).run(3)
+        self.assertEqual(report.games, 0)
+        self.assertEqual(len(report.aborted), 3)
+        self.assertEqual(stats.rounds, report.rounds)
+
+    def test_shard_seeds(self):
+        self.assertEqual(shard_seed(1, 0), shard_seed(1, 0))
+        self.assertNotEqual(shard_seed(1, 0), shard_seed(1, 1))
+        self.assertNotEqual(shard_seed(1, 0), shard_seed(2, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
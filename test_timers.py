@@ -0,0 +1,50 @@
+from timers import TimerWheel
+import asyncio
+import unittest
+
+class TimerWheelTest(unittest.IsolatedAsyncioTestCase):
+    async def test_advance(self):
+        wheel = TimerWheel(tick=1, size=4)
+        self.addCleanup(wheel.close)
+        fired = []
+        for delay in [1, 2, 3.5, 4, 9]:
+            wheel.schedule(delay, fired.append, delay)
+        cancelled = wheel.schedule(2, fired.append, "cancelled")
+        wheel.cancel(cancelled)
+        self.assertEqual(len(wheel), 5)
+
+        ticks = []
+        for i in range(10):
+            wheel.advance()
+            ticks.append(list(fired))
+        self.assertEqual(ticks[0], [1])
+        self.assertEqual(ticks[1], [1, 2])
+        self.assertEqual(ticks[3], [1, 2, 3.5, 4])
+        self.assertEqual(ticks[7], [1, 2, 3.5, 4])
+        self.assertEqual(ticks[8], [1, 2, 3.5, 4, 9])
+        self.assertEqual(len(wheel), 0)
+
+    async def test_task(self):
+        wheel = TimerWheel(tick=0.01)
+        self.addCleanup(wheel.close)
+        done = asyncio.get_running_loop().create_future()
+        wheel.schedule(0.03, done.set_result, True)
+        task = wheel.task
+        for i in range(10):
+            wheel.schedule(0.02, lambda: None)
+        # One task for every timer
+        self.assertIs(wheel.task, task)
+        self.assertTrue(await asyncio.wait_for(done, 1))
+
+    async def test_errors(self):
+        wheel = TimerWheel(tick=1)
+        self.addCleanup(wheel.close)
+        fired = []
+        wheel.schedule(1, lambda: 1 / 0)
+        wheel.schedule(1, fired.append, 1)
+        with self.assertLogs(level='ERROR'):
+            wheel.advance()
+        self.assertEqual(fired, [1])
+
+if __name__ == "__main__":
+    unittest.main()
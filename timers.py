@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import math
+
+# A timing wheel, that runs the timers of the whole process with one task.
+# Timers are put in the slot of the tick they are due at, so scheduling and
+# cancelling are O(1), and every tick only looks at one slot. Timers further
+# away than one turn of the wheel wait for the number of turns in rounds.
+
+class Timer(object):
+    __slots__ = ('callback', 'args', 'rounds', 'slot')
+
+    def __init__(self, callback, args, rounds, slot):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.slot = slot
+
+
+class TimerWheel(object):
+    def __init__(self, tick=0.1, size=512):
+        self.tick = tick
+        self.size = size
+        # Timers in a slot are kept in a dict, so they run in order
+        self.slots = [{} for i in range(size)]
+        self.cursor = 0
+        self.task = None
+
+    def __len__(self):
+        return sum(len(s) for s in self.slots)
+
+    def schedule(self, delay, callback, *args):
+        # Calls callback(*args) on the event loop after delay seconds, rounded
+        # up to a whole tick
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self.cursor + ticks) % self.size
+        timer = Timer(callback, args, (ticks - 1) // self.size, slot)
+        self.slots[slot][timer] = None
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        return timer
+
+    def cancel(self, timer):
+        self.slots[timer.slot].pop(timer, None)
+
+    def advance(self):
+        # Moves on by one tick, calling the timers that are due
+        self.cursor = (self.cursor + 1) % self.size
+        slot = self.slots[self.cursor]
+        due = [t for t in slot if t.rounds == 0]
+        for t in slot:
+            t.rounds -= 1
+        for t in due:
+            del slot[t]
+        for t in due:
+            try:
+                t.callback(*t.args)
+            except Exception:
+                logging.exception("Timer callback failed")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        try:
+            while True:
+                next_tick += self.tick
+                await asyncio.sleep(max(0, next_tick - loop.time()))
+                self.advance()
+        finally:
+            self.task = None
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()